@@ -987,6 +987,7 @@ async function storeChartGenerationMetadata(params) {
     selection,
     aggregation,
     spec,
+    dataMapping,
     sqlFields,
     specFields,
     execution_time_ms
@@ -1003,8 +1004,8 @@ async function storeChartGenerationMetadata(params) {
         chart_type, columns_used, model_used, execution_time_ms,
         was_successful, sql_query, field_mappings, confidence_score,
         generated_sql_query, sql_fields, spec_fields, fields_compatible,
-        dynamic_fetch_ready
-      ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15, $16, $17)
+        dynamic_fetch_ready, data_mapping
+      ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15, $16, $17, $18)
       RETURNING generation_id
     `, [
       user_id || 'anonymous', // user_id from request
@@ -1023,7 +1024,8 @@ async function storeChartGenerationMetadata(params) {
       JSON.stringify(sqlFields),
       JSON.stringify(specFields),
       fieldsCompatible,
-      true // dynamic_fetch_ready - Phase 1 is ready for dynamic fetching
+      true, // dynamic_fetch_ready - Phase 1 is ready for dynamic fetching
+      dataMapping ? JSON.stringify(dataMapping) : null // data_mapping - materialized by the datasets getChartData action
     ]);
     
     console.log('Chart generation metadata stored with ID:', insertResult.rows[0].generation_id);
@@ -1326,6 +1328,7 @@ async function processChartGeneration(event, streamThought = null) {
     selection,
     aggregation,
     spec: specOut.spec,
+    dataMapping: specOut.dataMapping,
     sqlFields,
     specFields,
     execution_time_ms: executionTime
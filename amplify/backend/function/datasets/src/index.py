@@ -1,22 +1,136 @@
 import json
+import base64
 import boto3
 import uuid
 import os
 import csv
+import gzip
+import hashlib
 import io
+import math
+import multiprocessing
+import multiprocessing.connection
+import queue
+import random
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import numpy as np
 import pandas as pd
 import psycopg2
+from psycopg2.extras import execute_values
 import requests
 from datetime import datetime, date
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import decimal
 
-# Initialize S3 client
-s3_client = boto3.client('s3')
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:
+    pa = None  # Arrow responses fall back to JSON
+
+try:
+    import sqlglot
+    from sqlglot import exp
+except ImportError:
+    sqlglot = None  # SQL validation falls back to keyword checks
+    print("WARNING: sqlglot is not installed; executeSQL validation falls back to keyword checks "
+          "and LIMIT/FETCH are not clamped in the query itself")
+
+try:
+    from pandas.tseries.api import guess_datetime_format
+except ImportError:
+    # pandas < 2.0 only exposes the format guesser privately
+    from pandas._libs.tslibs.parsing import guess_datetime_format
+
+# Parallel S3 download configuration
+S3_PART_SIZE = int(os.environ.get('S3_PART_SIZE', str(8 * 1024 * 1024)))
+S3_DOWNLOAD_CONCURRENCY = int(os.environ.get('S3_DOWNLOAD_CONCURRENCY', '8'))
+S3_MULTIPART_THRESHOLD = int(os.environ.get('S3_MULTIPART_THRESHOLD', str(16 * 1024 * 1024)))
+
+# Initialize S3 client with enough pooled HTTP connections for the concurrent ranged GETs
+s3_client = boto3.client('s3', config=Config(max_pool_connections=max(10, S3_DOWNLOAD_CONCURRENCY)))
+sqs_client = boto3.client('sqs') if os.environ.get('INGESTION_QUEUE_URL') else None
 
 # Configuration
 BUCKET_NAME = 'chartz-datasets'
 EXPIRATION_TIME = 3600  # 1 hour
+DATASETS_KMS_KEY_ID = 'arn:aws:kms:eu-west-2:252326958099:key/602a7058-adf6-48c5-80bf-39ea7956742f'
+
+# Dataset listing: keyset pages, revalidated against user_profiles.dataset_list_version
+DATASET_LIST_PAGE_SIZE = int(os.environ.get('DATASET_LIST_PAGE_SIZE', '100'))
+DATASET_LIST_MAX_PAGE_SIZE = 500
+
+# Content-hash deduplication: identical files share one ingested table, copied on write
+DEDUP_ACROSS_USERS = os.environ.get('DEDUP_ACROSS_USERS', 'false').lower() == 'true'  # also match other users' files
+CONTENT_HASH_PATTERN = re.compile(r'[0-9a-f]{64}')  # hex SHA-256
+# The upload form only hashes files up to this size, so parallel loads of larger ones skip the extra hashing pass
+CONTENT_HASH_MAX_BYTES = int(os.environ.get('CONTENT_HASH_MAX_BYTES', str(512 * 1024 * 1024)))
+
+# Bulk load configuration
+BULK_LOAD_METHOD = os.environ.get('BULK_LOAD_METHOD', 'copy')  # 'copy' or 'insert'
+COPY_BATCH_ROWS = int(os.environ.get('COPY_BATCH_ROWS', '50000'))
+
+# Streaming ingestion configuration
+CSV_CHUNK_ROWS = int(os.environ.get('CSV_CHUNK_ROWS', '50000'))
+SAMPLE_ROWS = int(os.environ.get('SAMPLE_ROWS', '50000'))  # reservoir size for field statistics
+SAMPLE_MIN_CONFIDENCE = float(os.environ.get('SAMPLE_MIN_CONFIDENCE', '0.95'))  # below this, count distinct exactly
+HLL_PRECISION = 12  # 4096 registers, ~1.6% standard error on distinct counts
+
+# Parallel ingestion: large files are split into line-aligned byte ranges loaded by worker processes
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', str(os.cpu_count() or 1)))
+INGEST_PARALLEL_THRESHOLD = int(os.environ.get('INGEST_PARALLEL_THRESHOLD', str(64 * 1024 * 1024)))
+
+# Cardinality ratios where classify_field changes its answer, per logical type
+ROLE_THRESHOLDS = {
+    'TEXT': (0.95, 0.5, 0.2),
+    'INTEGER': (0.95, 0.1),
+    'DECIMAL': (0.95, 0.1),
+}
+TYPE_PROBE_ROWS = 100  # leading values checked before a full-column type pass
+TYPE_CANDIDATES = ('NUMERIC', 'DATE', 'BOOLEAN')  # checked in this order; anything else is TEXT
+
+# COPY representation for every spelling detect_column_type accepts as boolean
+BOOLEAN_COPY_VALUES = {'true': 't', '1': 't', 'yes': 't', 'false': 'f', '0': 'f', 'no': 'f'}
+
+# information_schema data_type of a user table column -> (logical, postgres) type after narrowing
+POSTGRES_COLUMN_TYPES = {
+    'smallint': ('INTEGER', 'SMALLINT'),
+    'integer': ('INTEGER', 'INTEGER'),
+    'bigint': ('INTEGER', 'BIGINT'),
+    'numeric': ('DECIMAL', 'DECIMAL'),
+    'date': ('DATE', 'DATE'),
+    'timestamp without time zone': ('DATE', 'TIMESTAMP'),
+    'timestamp with time zone': ('DATE', 'TIMESTAMP WITH TIME ZONE'),
+    'boolean': ('BOOLEAN', 'BOOLEAN'),
+    'text': ('TEXT', 'TEXT'),
+}
+
+# Type narrowing: integer and datetime storage picked from the observed values instead of INTEGER/TIMESTAMPTZ
+INTEGER_TYPE_RANGES = [
+    ('SMALLINT', -2 ** 15, 2 ** 15 - 1),
+    ('INTEGER', -2 ** 31, 2 ** 31 - 1),
+    ('BIGINT', -2 ** 63, 2 ** 63 - 1),
+]
+INTEGER_TYPE_DIGITS = {'SMALLINT': 5, 'INTEGER': 10, 'BIGINT': 19}
+MULTI_CHUNK_INTEGER_FLOOR = 'INTEGER'  # SMALLINT only when the first chunk is the whole file
+TEMPORAL_TYPE_ORDER = ['DATE', 'TIMESTAMP', 'TIMESTAMP WITH TIME ZONE']
+TEMPORAL_COPY_FORMATS = {
+    'DATE': '%Y-%m-%d',
+    'TIMESTAMP': '%Y-%m-%d %H:%M:%S.%f',
+    'TIMESTAMP WITH TIME ZONE': '%Y-%m-%d %H:%M:%S.%f+00',
+}
+LEGACY_COLUMN_TYPES = {'INTEGER': 'INTEGER', 'DATE': 'TIMESTAMP WITH TIME ZONE'}
+
+# Partitioned storage for very large uploads: no per-row created_at or primary key
+PARTITIONED_STORAGE_THRESHOLD = int(os.environ.get('PARTITIONED_STORAGE_THRESHOLD', str(256 * 1024 * 1024)))
+PARTITION_HASH_COUNT = int(os.environ.get('PARTITION_HASH_COUNT', '8'))  # hash partitions when there's no temporal column
+PARTITION_MAX_RANGES = 240  # monthly partitions per table; later months share the default partition
 
 # Database configuration
 DB_CONFIG = {
@@ -24,9 +138,113 @@ DB_CONFIG = {
     'port': "5432",
     'dbname': "chartz",
     'user': "postgres",
-    'password': "ppddA4all.P"  # Set via environment variable
+    'password': "ppddA4all.P",  # Set via environment variable
+    'connect_timeout': 5,
+    # TCP keepalives let the pool notice sockets RDS or a NAT dropped while the container was frozen
+    'keepalives': 1,
+    'keepalives_idle': 30,
+    'keepalives_interval': 10,
+    'keepalives_count': 3
+}
+
+# Connection pool configuration
+DB_POOL_MAX_IDLE = int(os.environ.get('DB_POOL_MAX_IDLE', '4'))
+DB_HEALTHCHECK_INTERVAL = int(os.environ.get('DB_HEALTHCHECK_INTERVAL', '30'))  # idle seconds before a ping
+
+# Indexing stage after ingestion, on the columns chart SQL filters and groups by
+INDEX_BUDGET = int(os.environ.get('INDEX_BUDGET', '4'))  # indexes per dataset table
+INDEX_MIN_ROWS = int(os.environ.get('INDEX_MIN_ROWS', '10000'))  # smaller tables scan faster than they index
+INDEX_MAX_DIMENSION_CARDINALITY = 0.2  # dimensions above this cardinality ratio are left unindexed
+INDEX_MAINTENANCE_WORK_MEM = os.environ.get('INDEX_MAINTENANCE_WORK_MEM', '256MB')
+
+# Background ingestion configuration
+INGESTION_QUEUE_URL = os.environ.get('INGESTION_QUEUE_URL')  # SQS queue the function also consumes
+# In-process stand-in for local runs only: a deployed Lambda freezes the thread once it has responded
+INGESTION_LOCAL_QUEUE = os.environ.get('INGESTION_LOCAL_QUEUE', 'false').lower() == 'true'
+PROGRESS_UPDATE_INTERVAL = 5  # seconds between progress writes while ingesting
+# A 'processing' dataset with no progress for this long was abandoned by a timed-out or crashed run;
+# longer than the function's 900s timeout, so no live invocation can still own it
+INGESTION_STALE_AFTER = int(os.environ.get('INGESTION_STALE_AFTER', '960'))
+
+# Diagnostic health checks, run on demand by the 'health' action and cached per container
+HEALTH_EGRESS_URL = os.environ.get('HEALTH_EGRESS_URL', 'http://www.google.com')
+HEALTH_CHECK_TIMEOUT = 2  # seconds
+
+# getData paging: pages are read through a server-side cursor in batches
+GETDATA_MAX_PAGE_ROWS = int(os.environ.get('GETDATA_MAX_PAGE_ROWS', '10000'))
+GETDATA_FETCH_BATCH = 2000
+
+# Columnar responses for getData/executeSQL, negotiated per request
+ARROW_STREAM_CONTENT_TYPE = 'application/vnd.apache.arrow.stream'
+
+# JSON result encoding: PostgreSQL type OIDs whose values json can't encode natively
+JSON_COLUMN_CONVERTERS = {
+    1700: float,  # numeric
+    1082: lambda value: value.isoformat(),  # date
+    1083: lambda value: value.isoformat(),  # time
+    1114: lambda value: value.isoformat(),  # timestamp
+    1184: lambda value: value.isoformat(),  # timestamptz
+    1266: lambda value: value.isoformat(),  # timetz
+    1186: str,  # interval
+}
+# Bodies at least this large are gzipped for clients that accept it; 0 disables (needs binary media types on the API)
+RESPONSE_GZIP_MIN_BYTES = int(os.environ.get('RESPONSE_GZIP_MIN_BYTES', '0'))
+
+# executeSQL result cache: an LRU per warm container plus an optional shared Postgres tier
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+RESULT_CACHE_MAX_ENTRY_BYTES = int(os.environ.get('RESULT_CACHE_MAX_ENTRY_BYTES', str(4 * 1024 * 1024)))
+RESULT_CACHE_SHARED = os.environ.get('RESULT_CACHE_SHARED', 'true').lower() == 'true'  # query_result_cache table
+RESULT_CACHE_SHARED_MAX_BYTES = int(os.environ.get('RESULT_CACHE_SHARED_MAX_BYTES', str(1024 * 1024 * 1024)))
+RESULT_CACHE_EVICTION_SAMPLE = float(os.environ.get('RESULT_CACHE_EVICTION_SAMPLE', '0.05'))  # shared stores that check the budget
+RESULT_CACHE_EVICTION_TARGET = 0.9  # eviction trims the shared tier to this fraction of its budget
+RESULT_CACHE_TOUCH_INTERVAL = 60  # seconds; a shared entry's last_hit_at is refreshed at most this often
+
+# Admission control for user SQL; user_profiles columns override these per user
+QUERY_TIMEOUT_MS = int(os.environ.get('QUERY_TIMEOUT_MS', '5000'))  # same as the chartgenerator execute_sql tool
+QUERY_MAX_COST = float(os.environ.get('QUERY_MAX_COST', '1000000'))  # planner cost units; above this a query is rejected
+QUERY_MAX_PLAN_ROWS = int(os.environ.get('QUERY_MAX_PLAN_ROWS', '100000'))  # estimated rows above this get clamped
+
+# SQL validation: user queries are parsed once per normalized text and checked structurally
+SQL_PARSE_CACHE_SIZE = 1024
+SQL_FORBIDDEN_KEYWORDS = ['insert', 'update', 'delete', 'merge', 'drop', 'alter', 'create', 'truncate',
+                          'grant', 'revoke', 'copy', 'into', 'call', 'do', 'vacuum', 'lock']  # keyword fallback only
+SQL_FORBIDDEN_FUNCTIONS = {'set_config', 'nextval', 'setval', 'dblink', 'dblink_exec', 'lo_import', 'lo_export',
+                           'query_to_xml', 'current_setting'}  # plus every pg_* function
+
+# Saved charts served from materialized snapshots
+CHART_BATCH_MAX = 50  # charts per getChartData request, e.g. one dashboard
+
+# Actions that read or write Postgres; everything else never opens a connection
+DB_ACTIONS = {'upload', 'getData', 'executeSQL', 'enqueueIngest', 'status', 'getChartData', 'materializeChart'}
+
+# Module-level state survives across warm invocations of the same container
+_idle_connections = []  # (connection, last released at)
+_pool_lock = threading.Lock()
+_pool_metrics = {
+    'connections_created': 0,
+    'connections_reused': 0,
+    'stale_connections_replaced': 0,
+    'health_checks': 0,
+    'connection_errors': 0,
+    'in_use': 0
+}
+_health_cache = None
+_inherited_clients = None  # a forked worker's copies of the parent's connections, kept open but unused
+_result_cache = OrderedDict()  # cache key -> (dataset_id, result, size in bytes), least recently used first
+_result_cache_bytes = 0
+_result_cache_lock = threading.Lock()
+_result_cache_metrics = {
+    'memory_hits': 0,
+    'shared_hits': 0,
+    'misses': 0,
+    'stores': 0,
+    'evictions': 0
 }
 
+# In-process stand-in for the SQS ingestion queue, drained by a daemon thread (local runs only)
+_local_ingestion_queue = queue.Queue()
+_local_ingestion_worker = None
+
 def json_serializer(obj):
     """JSON serializer for datetime and decimal objects"""
     if isinstance(obj, (datetime, date)):
@@ -36,77 +254,913 @@ def json_serializer(obj):
     raise TypeError(f"Object of type {type(obj)} is not JSON serializable")
 
 def test_internet_connectivity():
-    url = "http://www.google.com"
-    timeout = 5
+    """Check outbound internet access from the Lambda's VPC"""
+    _ = requests.get(HEALTH_EGRESS_URL, timeout=HEALTH_CHECK_TIMEOUT)
+    print("Internet connection is available")
+
+def test_database_connectivity():
+    """Check that a pooled Postgres connection can run a query"""
+    conn = get_db_connection()
     try:
-        _ = requests.get(url, timeout=timeout)
-        print("Internet connection is available")
-    except requests.ConnectionError:
-        print("No internet connection available")
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1")
+        cursor.close()
+    finally:
+        release_db_connection(conn)
+
+def test_sql_parser():
+    """Check that executeSQL validates with the sqlglot parser rather than the keyword fallback"""
+    if sqlglot is None:
+        raise Exception("sqlglot is not installed; executeSQL is using the keyword fallback")
+
+def test_s3_connectivity():
+    """Check that the datasets bucket is reachable with this function's role"""
+    s3_client.head_bucket(Bucket=BUCKET_NAME)
+
+def timed_check(check):
+    """Run one health check and report whether it passed and how long it took"""
+    start = time.monotonic()
+    try:
+        check()
+        result = {'ok': True}
+    except Exception as e:
+        print(f"Health check {check.__name__} failed: {e}")
+        result = {'ok': False, 'error': str(e)}
+    result['latencyMs'] = int((time.monotonic() - start) * 1000)
+    return result
+
+def run_health_checks(refresh=False):
+    """Check DB, S3 and egress reachability and the SQL parser once per container and cache the result
+    
+    The checks run in parallel so the slowest one bounds the whole report.
+    """
+    global _health_cache
+    if _health_cache is not None and not refresh:
+        return _health_cache
+    
+    checks = {
+        'database': test_database_connectivity,
+        's3': test_s3_connectivity,
+        'egress': test_internet_connectivity,
+        'sqlParser': test_sql_parser
+    }
+    with ThreadPoolExecutor(max_workers=len(checks)) as executor:
+        futures = {name: executor.submit(timed_check, check) for name, check in checks.items()}
+        results = {name: future.result() for name, future in futures.items()}
+    
+    _health_cache = {
+        'status': 'ok' if all(result['ok'] for result in results.values()) else 'degraded',
+        'checks': results,
+        'checkedAt': datetime.utcnow().isoformat() + 'Z'
+    }
+    return _health_cache
+
+def connection_is_healthy(conn, last_used):
+    """Check an idle pooled connection, pinging it only when it sat idle for a while"""
+    if conn.closed:
+        return False
+    if time.monotonic() - last_used < DB_HEALTHCHECK_INTERVAL:
+        return True
+    _pool_metrics['health_checks'] += 1
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1")
+        cursor.close()
+        conn.rollback()
+        return True
+    except psycopg2.Error as e:
+        print(f"Pooled connection failed health check: {e}")
+        return False
 
 def get_db_connection():
-    """Establish database connection"""
+    """Check out a database connection, reusing a warm pooled one when it is still healthy"""
+    while True:
+        with _pool_lock:
+            if not _idle_connections:
+                break
+            conn, last_used = _idle_connections.pop()
+        if connection_is_healthy(conn, last_used):
+            _pool_metrics['connections_reused'] += 1
+            _pool_metrics['in_use'] += 1
+            return conn
+        _pool_metrics['stale_connections_replaced'] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+    
     try:
         conn = psycopg2.connect(**DB_CONFIG)
+        _pool_metrics['connections_created'] += 1
+        _pool_metrics['in_use'] += 1
         print("Connection established against DB")
         return conn
     except psycopg2.Error as e:
+        _pool_metrics['connection_errors'] += 1
         print(f"Database connection error: {e}")
         raise
 
-def detect_column_type(series):
-    """Detect the best PostgreSQL type for a pandas Series"""
+def release_db_connection(conn):
+    """Return a connection to the pool so the next warm invocation can reuse it"""
+    if conn is None:
+        return
+    _pool_metrics['in_use'] -= 1
+    if conn.closed:
+        return
+    try:
+        # Never hand an open transaction to the next request
+        conn.rollback()
+    except psycopg2.Error as e:
+        print(f"Discarding connection that failed to roll back: {e}")
+        conn.close()
+        return
+    with _pool_lock:
+        if len(_idle_connections) < DB_POOL_MAX_IDLE:
+            _idle_connections.append((conn, time.monotonic()))
+            return
+    conn.close()
+
+def get_pool_metrics():
+    """Snapshot of the connection pool counters for this container"""
+    with _pool_lock:
+        idle = len(_idle_connections)
+    return dict(_pool_metrics, idle=idle)
+
+def request_header(event, name):
+    """Case-insensitive lookup of a request header, '' when absent"""
+    for header, value in (event.get('headers') or {}).items():
+        if header.lower() == name:
+            return value or ''
+    return ''
+
+def etag_matches(if_none_match, etag):
+    """If-None-Match check per RFC 9110: a list of entity tags, compared weakly, or '*' for any"""
+    if if_none_match.strip() == '*':
+        return True
+    # Entity tags are quoted and may contain commas, so match them rather than split on commas
+    return any(candidate == etag for candidate in re.findall(r'(?:W/)?("[^"]*")', if_none_match))
+
+def wants_arrow(event, body):
+    """Whether the client asked for an Arrow IPC stream (format 'arrow' or the Accept header)"""
+    if pa is None:
+        return False
+    if body.get('format') == 'arrow':
+        return True
+    return ARROW_STREAM_CONTENT_TYPE in request_header(event, 'accept')
+
+def encode_result_columns(description, rows):
+    """Column-major, JSON-ready values for cursor rows
+    
+    Each column is converted once according to its type OID from cursor.description,
+    so json.dumps never has to call back into Python for a cell.
+    """
+    columns = [list(values) for values in zip(*rows)] if rows else [[] for _ in description]
+    for i, column in enumerate(description):
+        convert = JSON_COLUMN_CONVERTERS.get(column[1])
+        if convert:
+            columns[i] = [None if value is None else convert(value) for value in columns[i]]
+    return columns
+
+def json_response(payload, cors_headers, event, status_code=200):
+    """Proxy response with a compact JSON body, gzipped when large and the client accepts it"""
+    body = json.dumps(payload, default=json_serializer, separators=(',', ':'))
+    if RESPONSE_GZIP_MIN_BYTES and len(body) >= RESPONSE_GZIP_MIN_BYTES and 'gzip' in request_header(event, 'accept-encoding'):
+        return {
+            'statusCode': status_code,
+            'headers': {**cors_headers, 'Content-Type': 'application/json', 'Content-Encoding': 'gzip'},
+            'body': base64.b64encode(gzip.compress(body.encode('utf-8'), compresslevel=6)).decode('ascii'),
+            'isBase64Encoded': True
+        }
+    return {
+        'statusCode': status_code,
+        'headers': cors_headers,
+        'body': body
+    }
+
+def build_arrow_table(column_names, rows, metadata):
+    """Build an Arrow table column by column straight from cursor rows
+    
+    pyarrow converts datetimes, Decimals and the rest natively; a column it can't
+    type (mixed values, decimals beyond 38 digits) is sent as strings. The response
+    fields that aren't data travel as JSON in the schema metadata.
+    """
+    columns = list(zip(*rows)) if rows else [() for _ in column_names]
+    arrays = []
+    for values in columns:
+        try:
+            arrays.append(pa.array(values))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            arrays.append(pa.array([None if value is None else str(value) for value in values], type=pa.string()))
+    table = pa.Table.from_arrays(arrays, names=list(column_names))
+    return table.replace_schema_metadata({'response': json.dumps(metadata, default=json_serializer)})
+
+def arrow_response(table, cors_headers):
+    """Serialize an Arrow table as an IPC stream in a base64-encoded Lambda proxy response"""
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return {
+        'statusCode': 200,
+        'headers': {**cors_headers, 'Content-Type': ARROW_STREAM_CONTENT_TYPE},
+        'body': base64.b64encode(sink.getvalue().to_pybytes()).decode('ascii'),
+        'isBase64Encoded': True
+    }
+
+def normalize_sql(sql):
+    """Collapse whitespace outside string literals and drop a trailing semicolon"""
+    collapsed = re.sub(r"('(?:[^']|'')*')|\s+", lambda match: match.group(1) or ' ', sql.strip())
+    return collapsed.rstrip(';').strip()
+
+def result_cache_key(dataset_id, ingestion_date, sql, limit):
+    """Cache key for a query result; ingestion_date versions it so a re-ingested dataset never hits old entries"""
+    version = ingestion_date.isoformat() if ingestion_date else ''
+    raw = '\x1f'.join([str(dataset_id), version, str(limit), normalize_sql(sql)])
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def remember_result(cache_key, dataset_id, result, size):
+    """Add a result to the in-process LRU, evicting the least recently used past RESULT_CACHE_MAX_BYTES"""
+    global _result_cache_bytes
+    with _result_cache_lock:
+        if cache_key in _result_cache:
+            return
+        _result_cache[cache_key] = (str(dataset_id), result, size)
+        _result_cache_bytes += size
+        while _result_cache_bytes > RESULT_CACHE_MAX_BYTES:
+            _, (_, _, evicted_size) = _result_cache.popitem(last=False)
+            _result_cache_bytes -= evicted_size
+            _result_cache_metrics['evictions'] += 1
+
+def get_cached_result(conn, cache_key):
+    """Look a query result up in memory, then in the shared table; returns (result, tier) or (None, None)"""
+    with _result_cache_lock:
+        entry = _result_cache.get(cache_key)
+        if entry:
+            _result_cache.move_to_end(cache_key)
+            _result_cache_metrics['memory_hits'] += 1
+            return entry[1], 'memory'
+    
+    if RESULT_CACHE_SHARED:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                SELECT dataset_id, result,
+                       last_hit_at < CURRENT_TIMESTAMP - make_interval(secs => %s) AS needs_touch
+                FROM query_result_cache
+                WHERE cache_key = %s
+            """, (RESULT_CACHE_TOUCH_INTERVAL, cache_key))
+            row = cursor.fetchone()
+            if row and row[2]:
+                # Hits stay reads: the recency eviction goes by is refreshed once per interval, and
+                # skipped when another container is already refreshing it
+                cursor.execute("""
+                    UPDATE query_result_cache
+                    SET last_hit_at = CURRENT_TIMESTAMP,
+                        hit_count = hit_count + 1
+                    WHERE cache_key IN (
+                        SELECT cache_key FROM query_result_cache
+                        WHERE cache_key = %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                """, (cache_key,))
+            conn.commit()
+        except psycopg2.Error as e:
+            print(f"Shared result cache lookup failed: {e}")
+            conn.rollback()
+            row = None
+        finally:
+            cursor.close()
+        if row:
+            _result_cache_metrics['shared_hits'] += 1
+            result = json.loads(row[1])
+            remember_result(cache_key, row[0], result, len(row[1]))
+            return result, 'shared'
+    
+    _result_cache_metrics['misses'] += 1
+    return None, None
+
+def store_cached_result(conn, cache_key, dataset_id, result):
+    """Keep a query result in both cache tiers unless it's bigger than RESULT_CACHE_MAX_ENTRY_BYTES"""
+    payload = json.dumps(result, separators=(',', ':'))
+    if len(payload) > RESULT_CACHE_MAX_ENTRY_BYTES:
+        return
+    remember_result(cache_key, dataset_id, result, len(payload))
+    _result_cache_metrics['stores'] += 1
+    if not RESULT_CACHE_SHARED:
+        return
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            INSERT INTO query_result_cache (cache_key, dataset_id, result, size_bytes)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (cache_key) DO NOTHING
+        """, (cache_key, dataset_id, payload, len(payload)))
+        conn.commit()
+        if random.random() < RESULT_CACHE_EVICTION_SAMPLE:
+            evict_shared_results(conn)
+    except psycopg2.Error as e:
+        print(f"Shared result cache store failed: {e}")
+        conn.rollback()
+    finally:
+        cursor.close()
+
+def evict_shared_results(conn):
+    """Trim the shared tier back under its budget, keeping the most recently hit entries
+    
+    Only a sample of stores calls this, so the table can briefly overshoot the budget;
+    trimming to RESULT_CACHE_EVICTION_TARGET of it leaves room for the stores until the next check.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM query_result_cache")
+        if cursor.fetchone()[0] <= RESULT_CACHE_SHARED_MAX_BYTES:
+            conn.commit()
+            return
+        cursor.execute("""
+            DELETE FROM query_result_cache
+            WHERE cache_key IN (
+                SELECT cache_key FROM (
+                    SELECT cache_key, SUM(size_bytes) OVER (ORDER BY last_hit_at DESC, cache_key) AS running_bytes
+                    FROM query_result_cache
+                ) ranked
+                WHERE running_bytes > %s
+            )
+        """, (int(RESULT_CACHE_SHARED_MAX_BYTES * RESULT_CACHE_EVICTION_TARGET),))
+        print(f"Evicted {cursor.rowcount} shared cached results over budget")
+        conn.commit()
+    except psycopg2.Error as e:
+        print(f"Shared result cache eviction failed: {e}")
+        conn.rollback()
+    finally:
+        cursor.close()
+
+def invalidate_result_cache(conn, dataset_id):
+    """Forget cached query results for a dataset; the shared delete commits with the caller's transaction"""
+    global _result_cache_bytes
+    with _result_cache_lock:
+        for cache_key in [key for key, entry in _result_cache.items() if entry[0] == str(dataset_id)]:
+            _result_cache_bytes -= _result_cache.pop(cache_key)[2]
+    if RESULT_CACHE_SHARED:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM query_result_cache WHERE dataset_id = %s", (dataset_id,))
+        cursor.close()
+
+def get_result_cache_metrics():
+    """Hit/miss counters and size of this container's result cache"""
+    with _result_cache_lock:
+        return dict(_result_cache_metrics, entries=len(_result_cache), bytes=_result_cache_bytes)
+
+def limited_statement(statement, limit):
+    """Clamp a parsed query's LIMIT/FETCH to limit, adding a LIMIT when there is none"""
+    requested = None
+    # sqlglot parses FETCH FIRST n ROWS ONLY into the limit arg as an exp.Fetch
+    clause = statement.args.get('limit')
+    if isinstance(clause, exp.Fetch):
+        # FETCH FIRST ROW ONLY, without a count, is one row
+        requested = clause.args.get('count') or exp.Literal.number(1)
+    elif clause is not None:
+        requested = clause.expression
+    if isinstance(requested, exp.Literal) and requested.is_int and int(requested.this) <= limit:
+        limit = int(requested.this)
+    return statement.limit(limit)
+
+def folded_name(identifier):
+    """Name an identifier refers to in PostgreSQL, where unquoted names fold to lower case"""
+    if identifier is None:
+        return ''
+    if isinstance(identifier, exp.Identifier) and identifier.quoted:
+        return identifier.name
+    return identifier.name.lower()
+
+@lru_cache(maxsize=SQL_PARSE_CACHE_SIZE)
+def parse_select_sql(sql, table_name, limit):
+    """Parse a normalized query and check it is one read-only SELECT over table_name
+    
+    Returns (error, sql to run); the SQL to run is regenerated from the AST with its
+    LIMIT clamped to limit. Results are cached, so a repeated query is only parsed once.
+    """
+    try:
+        statements = [statement for statement in sqlglot.parse(sql, read='postgres') if statement is not None]
+    except sqlglot.errors.ParseError as e:
+        print(f"SQL parse failed: {e}")
+        return 'Could not parse the SQL query', None
+    if len(statements) != 1:
+        return 'Only a single SQL statement is allowed', None
+    statement = statements[0]
+    if not isinstance(statement, exp.Query):
+        return 'Only SELECT queries and CTEs (WITH) are allowed', None
+    if statement.find(exp.DML, exp.DDL, exp.Command, exp.Into, exp.Lock):
+        return 'Query contains forbidden operations', None
+    
+    for function in statement.find_all(exp.Anonymous):
+        name = function.name.lower()
+        if name.startswith('pg_') or name in SQL_FORBIDDEN_FUNCTIONS:
+            return f"Function {name} is not allowed", None
+    
+    cte_names = {cte.alias_or_name.lower() for cte in statement.find_all(exp.CTE)}
+    for table in statement.find_all(exp.Table):
+        if not table.db and table.name.lower() in cte_names:
+            continue
+        schema = folded_name(table.args.get('db'))
+        if folded_name(table.this) != table_name or table.catalog or schema not in ('', 'public'):
+            return f"Query may only read from {table_name}", None
+    
+    return None, limited_statement(statement, limit).sql(dialect='postgres')
+
+def check_select_keywords(sql, limit):
+    """Keyword checks used when sqlglot isn't installed; returns (error, sql to run)"""
+    # String literals can't contain statements, so they are blanked before matching keywords
+    code = re.sub(r"'(?:[^']|'')*'", "''", sql).lower()
+    if not (code.startswith('select') or code.startswith('with')):
+        return 'Only SELECT queries and CTEs (WITH) are allowed', None
+    if ';' in code:
+        return 'Only a single SQL statement is allowed', None
+    found_dangerous = [kw for kw in SQL_FORBIDDEN_KEYWORDS if re.search(rf'\b{kw}\b', code)]
+    if found_dangerous or re.search(r'\bpg_\w+|\binformation_schema\b', code):
+        print(f"Found dangerous keywords: {found_dangerous}")
+        return 'Query contains forbidden operations', None
+    
+    trailing_limit = re.search(r'\blimit\s+(\d+)\s*$', code)
+    if trailing_limit and int(trailing_limit.group(1)) <= limit:
+        return None, sql
+    if trailing_limit:
+        return None, f"{sql[:trailing_limit.start()]}LIMIT {limit}"
+    return None, f"SELECT * FROM ({sql}) AS limited_query LIMIT {limit}"
+
+def validate_select_sql(sql, table_name, limit):
+    """SQL safety checks for a user query; returns (error, sql to run) with the row limit applied"""
+    sql = normalize_sql(sql)
+    if sqlglot is None:
+        print("WARNING: validating SQL with the keyword fallback because sqlglot is not installed")
+        return check_select_keywords(sql, limit)
+    return parse_select_sql(sql, table_name, int(limit))
+
+def result_data(column_names, columns, layout):
+    """Objects ready for chart consumption by default, or {column: [values]} for layout 'columns'"""
+    if layout == 'columns':
+        return dict(zip(column_names, columns))
+    return [dict(zip(column_names, values)) for values in zip(*columns)]
+
+def chart_queries(data_mapping, generated_sql_query):
+    """The queries a saved chart runs, as {query key: (sql, spec target)}"""
+    data_mapping = data_mapping or {}
+    if data_mapping.get('queries'):
+        return {key: (query.get('sql'), query.get('target'))
+                for key, query in data_mapping['queries'].items() if query.get('sql')}
+    sql = data_mapping.get('sql') or generated_sql_query
+    return {'main': (sql, data_mapping.get('target'))} if sql else {}
+
+def query_budgets(cost_budget=None, row_budget=None, timeout_ms=None):
+    """Admission budgets for a user's queries, falling back to the Lambda defaults"""
+    return {
+        'max_cost': float(cost_budget) if cost_budget is not None else QUERY_MAX_COST,
+        'max_rows': int(row_budget) if row_budget is not None else QUERY_MAX_PLAN_ROWS,
+        'timeout_ms': int(timeout_ms) if timeout_ms is not None else QUERY_TIMEOUT_MS
+    }
+
+def admit_query(cursor, sql, budgets, context):
+    """EXPLAIN-based admission control for a read-only query, inside the caller's transaction
+    
+    Sets the statement timeout for the rest of the transaction, then compares the planner's
+    estimates with the budgets. Returns (decision, sql to run, estimate) where decision is
+    'admitted', 'downgraded' (the result is clamped to the row budget) or 'rejected'.
+    Every decision is logged as one JSON line for tuning the limits.
+    """
+    cursor.execute(f"SET LOCAL statement_timeout = {int(budgets['timeout_ms'])}")
+    sql = sql.strip().rstrip(';')
+    cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}")
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    plan = plan[0]['Plan']
+    estimate = {'cost': plan['Total Cost'], 'rows': plan['Plan Rows']}
+    
+    if estimate['cost'] > budgets['max_cost']:
+        decision = 'rejected'
+    elif estimate['rows'] > budgets['max_rows']:
+        decision = 'downgraded'
+        sql = f"SELECT * FROM ({sql}) AS admitted_query LIMIT {budgets['max_rows']}"
+    else:
+        decision = 'admitted'
+    print(json.dumps({
+        'event': 'query_admission',
+        **context,
+        'decision': decision,
+        'estimated_cost': estimate['cost'],
+        'estimated_rows': estimate['rows'],
+        **budgets
+    }, default=str))
+    return decision, sql, estimate
+
+def run_chart_query(conn, sql, table_name, limit, budgets=None):
+    """Run one read-only chart query and return it as a column-major result"""
+    error, sql = validate_select_sql(sql, table_name, limit)
+    if error:
+        raise ValueError(error)
+    cursor = conn.cursor()
+    try:
+        decision, sql, estimate = admit_query(cursor, sql, budgets or query_budgets(), {'source': 'chart_snapshot'})
+        if decision == 'rejected':
+            raise ValueError(f"Query rejected: estimated cost {estimate['cost']} is over the budget")
+        cursor.execute(sql)
+        rows = cursor.fetchall()
+        description = cursor.description or []
+        return {
+            'columns': [desc[0] for desc in description],
+            'values': encode_result_columns(description, rows),
+            'sql': sql
+        }
+    finally:
+        cursor.close()
+
+def load_chart_snapshots(conn, generation_ids, limit, refresh=False):
+    """Results for saved charts, read from their snapshots in one query
+    
+    A snapshot is recomputed only when it is missing, its dataset has been re-ingested
+    since it was taken, or refresh is set. Returns ({generation_id: chart}, {generation_id: error}).
+    """
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT cg.generation_id, cg.data_mapping, cg.generated_sql_query, cg.result_snapshot,
+               cg.snapshot_ingestion_date IS NOT DISTINCT FROM d.ingestion_date AS snapshot_fresh,
+               d.ingestion_date, d.table_name, up.query_cost_budget, up.query_row_budget, up.query_timeout_ms
+        FROM chart_generations cg
+        JOIN datasets d ON d.dataset_id = cg.dataset_id
+        LEFT JOIN user_profiles up ON up.user_id = d.user_id
+        WHERE cg.generation_id = ANY(%s::uuid[]) AND d.ingestion_status = 'completed'
+    """, (list(generation_ids),))
+    rows = cursor.fetchall()
+    conn.commit()
+    
+    charts, errors = {}, {}
+    for generation_id, data_mapping, generated_sql_query, snapshot, snapshot_fresh, ingestion_date, table_name, *budget_overrides in rows:
+        generation_id = str(generation_id)
+        queries = chart_queries(data_mapping, generated_sql_query)
+        refreshed = False
+        if refresh or not snapshot or not snapshot_fresh or set(snapshot) != set(queries):
+            try:
+                budgets = query_budgets(*budget_overrides)
+                snapshot = {key: run_chart_query(conn, sql, table_name, limit, budgets) for key, (sql, _) in queries.items()}
+                cursor.execute("""
+                    UPDATE chart_generations
+                    SET result_snapshot = %s,
+                        snapshot_ingestion_date = %s,
+                        snapshot_refreshed_at = CURRENT_TIMESTAMP
+                    WHERE generation_id = %s
+                """, (json.dumps(snapshot), ingestion_date, generation_id))
+                conn.commit()
+                refreshed = True
+            except (psycopg2.Error, ValueError) as e:
+                print(f"Failed to materialize chart {generation_id}: {e}")
+                conn.rollback()
+                errors[generation_id] = str(e)
+                continue
+        charts[generation_id] = {
+            'queries': {key: dict(snapshot[key], target=target) for key, (_, target) in queries.items()},
+            'refreshed': refreshed
+        }
+    
+    for generation_id in generation_ids:
+        if str(generation_id) not in charts and str(generation_id) not in errors:
+            errors[str(generation_id)] = 'Chart not found or dataset not completed ingestion'
+    cursor.close()
+    return charts, errors
+
+def find_snapshot_result(conn, generation_id, dataset_id, sql):
+    """The result for this SQL from a saved chart's snapshot, if the snapshot is still fresh
+    
+    The chart must be over the requested dataset and belong to its owner, so a generation
+    id can't be used to read another chart's rows.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT cg.result_snapshot
+            FROM chart_generations cg
+            JOIN datasets d ON d.dataset_id = cg.dataset_id AND d.user_id = cg.user_id
+            WHERE cg.generation_id = %s
+              AND cg.dataset_id = %s
+              AND cg.snapshot_ingestion_date IS NOT DISTINCT FROM d.ingestion_date
+        """, (generation_id, dataset_id))
+        row = cursor.fetchone()
+    except psycopg2.Error as e:
+        print(f"Chart snapshot lookup failed: {e}")
+        conn.rollback()
+        return None
+    finally:
+        cursor.close()
+    normalized = normalize_sql(sql)
+    for result in ((row[0] if row else None) or {}).values():
+        if normalize_sql(result['sql']) == normalized:
+            return result
+    return None
+
+def encode_page_token(table_name, last_id):
+    """Opaque getData continuation token pointing just past the last row returned"""
+    token = json.dumps({'table': table_name, 'after': last_id}).encode('utf-8')
+    return base64.urlsafe_b64encode(token).decode('ascii')
+
+def decode_page_token(token, table_name):
+    """Return the id a getData page continues after, rejecting tokens for other tables"""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+        last_id = int(position['after'])
+    except (ValueError, TypeError, KeyError, AttributeError):
+        raise ValueError('Invalid cursor')
+    if position.get('table') != table_name:
+        raise ValueError('Cursor belongs to a different table')
+    return last_id
+
+def dataset_list_etag(cursor, user_id, page_token, limit):
+    """ETag for one page of a user's dataset list, from the version counter a trigger on datasets keeps"""
+    cursor.execute("SELECT dataset_list_version FROM user_profiles WHERE user_id = %s", (user_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    raw = '\x1f'.join([str(row[0]), user_id, page_token or '', str(limit)])
+    return '"' + hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32] + '"'
+
+def encode_dataset_list_token(upload_date, dataset_id):
+    """Opaque dataset list continuation token pointing just past the last dataset returned"""
+    token = json.dumps({'upload_date': upload_date.isoformat(), 'dataset_id': str(dataset_id)}).encode('utf-8')
+    return base64.urlsafe_b64encode(token).decode('ascii')
+
+def decode_dataset_list_token(token):
+    """Return the (upload_date, dataset_id) a dataset list page continues after"""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+        return datetime.fromisoformat(position['upload_date']), str(uuid.UUID(position['dataset_id']))
+    except (ValueError, TypeError, KeyError, AttributeError):
+        raise ValueError('Invalid cursor')
+
+def parse_datetime_series(series, datetime_format=None):
+    """Parse a column to UTC timestamps, using the detected format when there is one"""
+    parsed = pd.to_datetime(series, format=datetime_format, errors='coerce', utc=True)
+    unparsed = parsed.isna() & series.notna()
+    if datetime_format and unparsed.any():
+        # Values written in some other format fall back to per-element parsing
+        parsed[unparsed] = pd.to_datetime(series[unparsed], errors='coerce', utc=True)
+    return parsed
+
+def is_integral(values):
+    """Check a float array holds only whole numbers, deciding from the leading values when they have a fraction"""
+    if not (np.mod(values[:TYPE_PROBE_ROWS], 1) == 0).all():
+        return False
+    return bool((np.mod(values, 1) == 0).all())
+
+def infer_values_type(values, type_hints, candidates=TYPE_CANDIDATES):
+    """Type check for a non-null object Series, trying the candidate types in order
+    
+    Every check stops at the first value that doesn't fit, so a wrong candidate costs
+    little even on a full column.
+    """
+    for candidate in candidates:
+        if candidate == 'NUMERIC':
+            try:
+                numeric = pd.to_numeric(values)
+            except (ValueError, TypeError):
+                continue
+            if is_integral(numeric.to_numpy(dtype=float)):
+                return 'INTEGER', 'INTEGER'
+            return 'DECIMAL', 'DECIMAL'
+        if candidate == 'DATE':
+            # A cached or guessed format keeps parsing vectorized; without one the column isn't a date
+            datetime_format = type_hints.get('datetime_format') or guess_datetime_format(str(values.iloc[0]))
+            if not datetime_format:
+                continue
+            try:
+                # utc=True like parse_datetime_series, so offsets that change mid-column (DST) still parse
+                pd.to_datetime(values, format=datetime_format, utc=True)
+            except (ValueError, TypeError, OverflowError):
+                continue
+            type_hints['datetime_format'] = datetime_format
+            return 'DATE', 'TIMESTAMP WITH TIME ZONE'
+        if candidate == 'BOOLEAN':
+            # Booleans have a handful of distinct spellings, so only those are normalised
+            distinct = pd.Series(pd.unique(values)).astype(str).str.strip().str.lower()
+            if distinct.isin(BOOLEAN_COPY_VALUES.keys()).all():
+                return 'BOOLEAN', 'BOOLEAN'
+    
+    # Default to text
+    return 'TEXT', 'TEXT'
+
+def detect_column_type(series, type_hints=None):
+    """Detect the best PostgreSQL type for a pandas Series
+    
+    type_hints is an optional per-column dict that caches the detected datetime
+    format, so later chunks of the same column skip format guessing.
+    """
+    if type_hints is None:
+        type_hints = {}
+    
     # Remove nulls for type detection
     non_null_series = series.dropna()
     
     if len(non_null_series) == 0:
         return 'TEXT', 'TEXT'
     
-    # Try numeric types first
-    try:
-        pd.to_numeric(non_null_series)
-        # Check if all values are integers
-        if all(float(val).is_integer() for val in non_null_series if pd.notna(val)):
+    # Columns pandas already parsed need no conversion
+    if pd.api.types.is_bool_dtype(non_null_series) or pd.api.types.infer_dtype(non_null_series) == 'boolean':
+        return 'BOOLEAN', 'BOOLEAN'
+    if pd.api.types.is_integer_dtype(non_null_series):
+        return 'INTEGER', 'INTEGER'
+    if pd.api.types.is_float_dtype(non_null_series):
+        if is_integral(non_null_series.to_numpy()):
             return 'INTEGER', 'INTEGER'
-        else:
-            return 'DECIMAL', 'DECIMAL'
-    except (ValueError, TypeError):
-        pass
+        return 'DECIMAL', 'DECIMAL'
     
-    # Try datetime
-    try:
-        pd.to_datetime(non_null_series)
-        return 'DATE', 'TIMESTAMP WITH TIME ZONE'
-    except (ValueError, TypeError):
-        pass
+    # The leading values pick the type; the full column is only checked against that type,
+    # and against later candidates if some value further down doesn't fit it
+    probe_type = infer_values_type(non_null_series.iloc[:TYPE_PROBE_ROWS], type_hints)
+    if probe_type[0] == 'TEXT' or len(non_null_series) <= TYPE_PROBE_ROWS:
+        return probe_type
+    candidate = 'NUMERIC' if probe_type[0] in ('INTEGER', 'DECIMAL') else probe_type[0]
+    return infer_values_type(non_null_series, type_hints, TYPE_CANDIDATES[TYPE_CANDIDATES.index(candidate):])
+
+def dataset_table_name(dataset_id):
+    """Table a dataset is loaded into, derived from its id (same as generate_dataset_table_name in SQL)"""
+    return 'ds_' + uuid.UUID(str(dataset_id)).hex
+
+def clean_column_name(col_name):
+    """Turn a CSV header into the column name used in the user's table"""
+    safe_col_name = str(col_name).replace(' ', '_').replace('-', '_').lower()
+    return ''.join(c for c in safe_col_name if c.isalnum() or c == '_')
+
+def temporal_type(values, datetime_format):
+    """DATE, TIMESTAMP or TIMESTAMP WITH TIME ZONE for a column of datetime strings"""
+    if datetime_format:
+        has_zone = '%z' in datetime_format or '%Z' in datetime_format
+        has_time = any(directive in datetime_format for directive in ('%H', '%I', '%M', '%S'))
+    else:
+        text = values.astype(str).str.strip()
+        has_zone = text.str.contains(r'(?:[+-]\d{2}:?\d{2}|Z|UTC|GMT)$', regex=True).any()
+        has_time = text.str.contains(r'\d:\d{2}', regex=True).any()
+    if has_zone:
+        return 'TIMESTAMP WITH TIME ZONE'
+    return 'TIMESTAMP' if has_time else 'DATE'
+
+def narrow_column_type(column_type, series, type_hints=None):
+    """Type-narrowing stage after detect_column_type: the smallest storage that holds every observed value
     
-    # Try boolean
-    if set(non_null_series.astype(str).str.lower().unique()).issubset({'true', 'false', '1', '0', 'yes', 'no'}):
-        return 'BOOLEAN', 'BOOLEAN'
+    Integers get SMALLINT/INTEGER/BIGINT from their min/max and datetimes DATE, TIMESTAMP
+    or TIMESTAMP WITH TIME ZONE. Decimals stay DECIMAL: NUMERIC(p,s) is stored the same
+    way as an unbounded NUMERIC, so bounding it saves nothing.
+    """
+    logical_type = column_type[0]
+    values = series.dropna()
+    if len(values) == 0 or logical_type not in ('INTEGER', 'DATE'):
+        return column_type
+    if logical_type == 'DATE':
+        return 'DATE', temporal_type(values, (type_hints or {}).get('datetime_format'))
     
-    # Default to text
-    return 'TEXT', 'TEXT'
+    values = pd.to_numeric(values, errors='coerce').dropna()
+    if len(values) == 0:
+        return column_type
+    low, high = values.min(), values.max()
+    for postgres_type, type_min, type_max in INTEGER_TYPE_RANGES:
+        if type_min <= low and high <= type_max:
+            return 'INTEGER', postgres_type
+    return 'DECIMAL', 'DECIMAL'
+
+def detect_storage_type(series, type_hints):
+    """detect_column_type followed by the type-narrowing stage"""
+    return narrow_column_type(detect_column_type(series, type_hints), series, type_hints)
 
-def create_user_table(conn, table_name, columns_info):
-    """Create a dynamic table for user's CSV data"""
+def initial_storage_type(series, type_hints, whole_file):
+    """Storage type a new table column is created with, from the first chunk of the CSV
+    
+    When more chunks follow, integers start at MULTI_CHUNK_INTEGER_FLOOR so a column whose
+    first rows happen to be small doesn't need rewriting as soon as a larger value turns up.
+    """
+    column_type = detect_storage_type(series, type_hints)
+    floor = INTEGER_TYPE_DIGITS[MULTI_CHUNK_INTEGER_FLOOR]
+    if not whole_file and column_type[0] == 'INTEGER' and INTEGER_TYPE_DIGITS[column_type[1]] < floor:
+        return 'INTEGER', MULTI_CHUNK_INTEGER_FLOOR
+    return column_type
+
+def choose_storage_layout(file_size_bytes, sample, column_names, column_types):
+    """Storage layout for a new dataset table: a plain heap, or partitioned for very large uploads
+    
+    Partitioned tables are range partitioned by month on the temporal column with the
+    fewest nulls in the sample, or hash partitioned on id when there is none.
+    """
+    if file_size_bytes < PARTITIONED_STORAGE_THRESHOLD:
+        return {'mode': 'heap'}
+    temporal = [col_name for col_name, (logical_type, _) in zip(column_names, column_types) if logical_type == 'DATE']
+    if temporal:
+        key_column = min(temporal, key=lambda col_name: sample[col_name].isnull().sum())
+        return {'mode': 'partitioned', 'strategy': 'range', 'column': key_column}
+    return {'mode': 'partitioned', 'strategy': 'hash', 'partitions': PARTITION_HASH_COUNT}
+
+def partition_name(table_name, suffix):
+    """Name for one partition of a dataset table; dataset table names leave no room for a suffix"""
+    return f"part_{hashlib.sha1(table_name.encode('utf-8')).hexdigest()[:16]}_{suffix}"
+
+def read_partition_names(cursor, table_name):
+    """Names of the partitions attached to a partitioned table"""
+    cursor.execute("""
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = %s::regclass
+    """, (f'"{table_name}"',))
+    return {row[0] for row in cursor.fetchall()}
+
+def read_partitioned_months(cursor, table_name):
+    """UTC months ('YYYY-MM') a range partitioned table already has partitions for
+    
+    Read from the partition bounds rather than the partition names: a parallel load
+    creates its partitions under the staging table's name before renaming it.
+    """
+    # Bounds are printed in the session time zone; they were created as UTC month starts
+    cursor.execute("SET LOCAL TIME ZONE 'UTC'")
+    cursor.execute("""
+        SELECT pg_get_expr(child.relpartbound, child.oid)
+        FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = %s::regclass
+    """, (f'"{table_name}"',))
+    months = set()
+    for (bound,) in cursor.fetchall():
+        match = re.match(r"FOR VALUES FROM \('(\d{4}-\d{2})", bound or '')
+        if match:
+            months.add(match.group(1))
+    return months
+
+def add_range_partitions(conn, table_name, key_values):
+    """Create the monthly partitions a chunk's key values fall in, before the chunk is copied
+    
+    key_values is the key column as prepared for COPY (UTC timestamp strings). Parallel
+    loaders share the table, so creation holds the same advisory lock as column widening.
+    """
+    months = set(key_values.dropna().str[:7])
+    cursor = conn.cursor()
+    try:
+        existing = read_partitioned_months(cursor, table_name)
+        missing = sorted(months - existing)
+        if missing:
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (table_name,))
+            existing = read_partitioned_months(cursor, table_name)
+        for month in missing:
+            if month in existing:
+                continue
+            if len(existing) >= PARTITION_MAX_RANGES:
+                # Never create a partition once rows may have gone to the default one for its months
+                break
+            year, month_number = int(month[:4]), int(month[5:7])
+            cursor.execute(
+                f'CREATE TABLE "{partition_name(table_name, "p" + month.replace("-", ""))}" '
+                f'PARTITION OF "{table_name}" FOR VALUES FROM (%s) TO (%s)',
+                (f'{month}-01 00:00:00+00', f'{year + month_number // 12:04d}-{month_number % 12 + 1:02d}-01 00:00:00+00')
+            )
+            existing.add(month)
+        conn.commit()
+    finally:
+        cursor.close()
+
+def create_user_table(conn, table_name, columns_info, layout=None):
+    """Create a dynamic table for user's CSV data
+    
+    layout comes from choose_storage_layout; partitioned tables have no created_at and
+    no primary key (it would have to include the partition key), just an id to page by.
+    """
+    layout = layout or {'mode': 'heap'}
     cursor = conn.cursor()
     try:
         # Build CREATE TABLE statement
         columns_sql = []
         for col_name, postgres_type in columns_info:
-            safe_col_name = col_name.replace(' ', '_').replace('-', '_').lower()
-            safe_col_name = ''.join(c for c in safe_col_name if c.isalnum() or c == '_')
-            columns_sql.append(f'"{safe_col_name}" {postgres_type}')
-        
-        create_sql = f"""
-        CREATE TABLE "{table_name}" (
-            id SERIAL PRIMARY KEY,
-            {', '.join(columns_sql)},
-            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-        )
-        """
+            columns_sql.append(f'"{clean_column_name(col_name)}" {postgres_type}')
+        
+        if layout['mode'] == 'partitioned':
+            if layout['strategy'] == 'range':
+                partition_by = f'RANGE ("{clean_column_name(layout["column"])}")'
+            else:
+                partition_by = 'HASH (id)'
+            create_sql = f"""
+            CREATE TABLE "{table_name}" (
+                id SERIAL,
+                {', '.join(columns_sql)}
+            ) PARTITION BY {partition_by}
+            """
+        else:
+            create_sql = f"""
+            CREATE TABLE "{table_name}" (
+                id SERIAL PRIMARY KEY,
+                {', '.join(columns_sql)},
+                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+            )
+            """
         
         cursor.execute(create_sql)
+        if layout['mode'] == 'partitioned' and layout['strategy'] == 'range':
+            # Null keys, and months past PARTITION_MAX_RANGES, land in the default partition
+            cursor.execute(f'CREATE TABLE "{partition_name(table_name, "default")}" PARTITION OF "{table_name}" DEFAULT')
+        elif layout['mode'] == 'partitioned':
+            for remainder in range(layout['partitions']):
+                cursor.execute(
+                    f'CREATE TABLE "{partition_name(table_name, f"h{remainder}")}" PARTITION OF "{table_name}" '
+                    f'FOR VALUES WITH (MODULUS {layout["partitions"]}, REMAINDER {remainder})'
+                )
         conn.commit()
         print(f"Created table: {table_name}")
         return True
@@ -122,8 +1176,7 @@ def insert_csv_data(conn, table_name, df):
     cursor = conn.cursor()
     try:
         # Clean column names
-        df.columns = [col.replace(' ', '_').replace('-', '_').lower() for col in df.columns]
-        df.columns = [''.join(c for c in col if c.isalnum() or c == '_') for col in df.columns]
+        df.columns = [clean_column_name(col) for col in df.columns]
         
         # Convert dataframe to list of tuples
         data_tuples = []
@@ -147,54 +1200,1353 @@ def insert_csv_data(conn, table_name, df):
     finally:
         cursor.close()
 
-def ingest_csv_from_s3(s3_key, user_id, original_filename, dataset_id):
-    """Main CSV ingestion function"""
+def restore_default_dtypes(chunk):
+    """Give a chunk read with nullable dtypes the default parser's dtypes, except for Int64 columns"""
+    for col_name in chunk.columns:
+        column = chunk[col_name]
+        if isinstance(column.dtype, pd.Int64Dtype):
+            continue
+        if isinstance(column.dtype, pd.Float64Dtype):
+            chunk[col_name] = column.to_numpy(dtype=np.float64, na_value=np.nan)
+        else:
+            chunk[col_name] = pd.Series(column.to_numpy(dtype=object, na_value=np.nan), index=chunk.index).infer_objects()
+    return chunk
+
+def read_csv_chunks(source, **kwargs):
+    """Stream a CSV in CSV_CHUNK_ROWS chunks, keeping integer columns with blanks exact
+    
+    The default parser reads an integer column with missing values as float64, which
+    can't hold ids past 2**53. Those columns come back as nullable Int64 instead; every
+    other column is read as the default parser would have.
+    """
+    for chunk in pd.read_csv(source, chunksize=CSV_CHUNK_ROWS, dtype_backend='numpy_nullable', **kwargs):
+        yield restore_default_dtypes(chunk)
+
+def coerce_series_for_copy(series, postgres_type, type_hints=None):
+    """Convert a column to the text representation COPY expects for its PostgreSQL type"""
+    if postgres_type in INTEGER_TYPE_DIGITS:
+        if isinstance(series.dtype, pd.Int64Dtype):
+            return series
+        return pd.to_numeric(series, errors='coerce').round().astype('Int64')
+    if postgres_type == 'DECIMAL':
+        parsed = pd.to_numeric(series, errors='coerce')
+        if pd.api.types.is_numeric_dtype(series):
+            return parsed
+        # Numbers read as text (integers past BIGINT, long decimals) go to COPY as written, never through float
+        valid = parsed.notna() & np.isfinite(parsed.astype(np.float64))
+        return series.astype(str).str.strip().where(valid)
+    if postgres_type in TEMPORAL_COPY_FORMATS:
+        # Normalise everything to UTC so PostgreSQL never has to guess the format
+        parsed = parse_datetime_series(series, (type_hints or {}).get('datetime_format'))
+        return parsed.dt.strftime(TEMPORAL_COPY_FORMATS[postgres_type]).where(parsed.notna())
+    if postgres_type == 'BOOLEAN':
+        lowered = series.astype(str).str.strip().str.lower()
+        return lowered.map(BOOLEAN_COPY_VALUES).where(series.notna())
+    return series
+
+def prepare_copy_frame(df, columns_info, column_hints=None):
+    """Build a DataFrame whose columns are already coerced to their table types"""
+    column_hints = column_hints or [{} for _ in columns_info]
+    coerced = {}
+    for (col_name, postgres_type), column, type_hints in zip(columns_info, df.columns, column_hints):
+        coerced[clean_column_name(col_name)] = coerce_series_for_copy(df[column], postgres_type, type_hints)
+    return pd.DataFrame(coerced, index=df.index)
+
+def copy_csv_data(conn, table_name, df, columns_info, column_hints=None):
+    """Bulk load CSV data into the user's table with COPY FROM STDIN"""
+    return copy_frame_to_table(conn, table_name, prepare_copy_frame(df, columns_info, column_hints))
+
+def copy_frame_to_table(conn, table_name, copy_frame):
+    """COPY an already coerced frame (see prepare_copy_frame) into the user's table"""
+    cursor = conn.cursor()
+    try:
+        columns = ', '.join([f'"{col}"' for col in copy_frame.columns])
+        copy_sql = f'COPY "{table_name}" ({columns}) FROM STDIN WITH (FORMAT csv)'
+        
+        # Stream the frame in slices so the text buffer stays small
+        rows_copied = 0
+        for start in range(0, len(copy_frame), COPY_BATCH_ROWS):
+            batch = copy_frame.iloc[start:start + COPY_BATCH_ROWS]
+            buffer = io.StringIO()
+            batch.to_csv(buffer, index=False, header=False, na_rep='')
+            buffer.seek(0)
+            cursor.copy_expert(copy_sql, buffer)
+            rows_copied += len(batch)
+        
+        conn.commit()
+        print(f"Copied {rows_copied} rows into {table_name}")
+        return rows_copied
+    except psycopg2.Error as e:
+        print(f"Error copying data: {e}")
+        conn.rollback()
+        return 0
+    finally:
+        cursor.close()
+
+def new_column_stats():
+    """Running statistics for one column while its chunks stream through"""
+    return {
+        'non_null_count': 0,
+        'null_count': 0,
+        'sample_values': [],
+        'hll': np.zeros(1 << HLL_PRECISION, dtype=np.uint8),
+        'min_value': None,
+        'max_value': None
+    }
+
+def hll_add(registers, values):
+    """Add a non-null Series to a HyperLogLog register array in one vectorized pass"""
+    # Hash a canonical form so a column read as int in one chunk and float in the next agrees
+    if pd.api.types.is_numeric_dtype(values):
+        values = values.astype('float64')
+    else:
+        values = values.astype(str)
+    hashes = pd.util.hash_pandas_object(values, index=False).to_numpy(dtype=np.uint64)
+    buckets = (hashes >> np.uint64(64 - HLL_PRECISION)).astype(np.int64)
+    # A sentinel bit caps the rank at 65 - HLL_PRECISION
+    remaining = (hashes << np.uint64(HLL_PRECISION)) | np.uint64(1 << (HLL_PRECISION - 1))
+    ranks = 64 - np.floor(np.log2(remaining.astype(np.float64))).astype(np.int64)
+    np.maximum.at(registers, buckets, ranks.astype(np.uint8))
+
+def hll_count(registers):
+    """Estimate the number of distinct values added to a HyperLogLog register array"""
+    m = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / np.sum(np.power(2.0, -registers.astype(np.float64)))
+    empty_registers = int(np.count_nonzero(registers == 0))
+    if estimate <= 2.5 * m and empty_registers:
+        # Linear counting is more accurate for small cardinalities
+        estimate = m * math.log(m / empty_registers)
+    return int(round(estimate))
+
+def encode_hll_registers(registers):
+    """Serialize HyperLogLog registers for field_stats, so later appends can merge into them"""
+    return base64.b64encode(gzip.compress(registers.tobytes())).decode('ascii')
+
+def decode_hll_registers(encoded):
+    """Read registers written by encode_hll_registers, or None if they're from another precision"""
+    registers = np.frombuffer(gzip.decompress(base64.b64decode(encoded)), dtype=np.uint8)
+    return registers.copy() if len(registers) == 1 << HLL_PRECISION else None
+
+def update_column_stats(stats, series, coerced, logical_type):
+    """Fold one chunk of a column into its running statistics
+    
+    coerced is the same chunk as prepared for COPY, so min/max compare typed values
+    (timestamps are already normalised to sortable UTC strings).
+    """
+    non_null_values = series.dropna()
+    stats['non_null_count'] += len(non_null_values)
+    stats['null_count'] += len(series) - len(non_null_values)
+    if len(stats['sample_values']) < 5:
+        stats['sample_values'].extend(non_null_values.head(5 - len(stats['sample_values'])).tolist())
+    
+    non_null_coerced = coerced.dropna()
+    if len(non_null_coerced) == 0:
+        return
+    if logical_type in ('INTEGER', 'DECIMAL') and not pd.api.types.is_numeric_dtype(non_null_coerced):
+        # DECIMAL text kept exact for COPY; bounds and sketches compare it as numbers
+        non_null_coerced = pd.to_numeric(non_null_coerced)
+    hll_add(stats['hll'], non_null_coerced)
+    if logical_type not in ('INTEGER', 'DECIMAL', 'DATE'):
+        # Text ordering isn't meaningful for chart ranges, and widened columns lose their typed bounds
+        stats['min_value'] = stats['max_value'] = None
+        return
+    chunk_min, chunk_max = non_null_coerced.min(), non_null_coerced.max()
+    chunk_min = chunk_min.item() if hasattr(chunk_min, 'item') else chunk_min
+    chunk_max = chunk_max.item() if hasattr(chunk_max, 'item') else chunk_max
+    stats['min_value'] = chunk_min if stats['min_value'] is None else min(stats['min_value'], chunk_min)
+    stats['max_value'] = chunk_max if stats['max_value'] is None else max(stats['max_value'], chunk_max)
+
+def update_reservoir(reservoir, chunk, rows_seen, rng):
+    """Fold a chunk into a uniform reservoir sample of at most SAMPLE_ROWS rows (Algorithm R)"""
+    chunk = chunk.reset_index(drop=True)
+    if reservoir is None:
+        reservoir = chunk.iloc[0:0]
+    
+    # Fill the reservoir before any replacement happens
+    free_slots = max(SAMPLE_ROWS - len(reservoir), 0)
+    if free_slots:
+        reservoir = pd.concat([reservoir, chunk.iloc[:free_slots]], ignore_index=True)
+        rows_seen += min(free_slots, len(chunk))
+        chunk = chunk.iloc[free_slots:].reset_index(drop=True)
+    if len(chunk) == 0:
+        return reservoir
+    
+    # Row number i replaces slot j ~ U[0, i] whenever j lands inside the reservoir
+    positions = np.arange(rows_seen, rows_seen + len(chunk))
+    slots = (rng.random(len(chunk)) * (positions + 1)).astype(np.int64)
+    accepted = np.nonzero(slots < SAMPLE_ROWS)[0]
+    if len(accepted) == 0:
+        return reservoir
+    
+    # When several rows hit the same slot only the last one survives, as in the sequential algorithm
+    _, last_hits = np.unique(slots[accepted][::-1], return_index=True)
+    accepted = accepted[len(accepted) - 1 - last_hits]
+    kept = reservoir.drop(index=slots[accepted])
+    return pd.concat([kept, chunk.iloc[accepted]], ignore_index=True)
+
+def classification_confidence(data_type, cardinality_ratio, relative_error):
+    """Confidence that an estimated cardinality ratio sits on the same side of every role threshold as the true one
+    
+    Treats the estimate as normally distributed with the given relative standard error.
+    """
+    thresholds = ROLE_THRESHOLDS.get(data_type, (0.95,))
+    sigma = relative_error * cardinality_ratio
+    if sigma == 0:
+        return 1.0
+    distance = min(abs(cardinality_ratio - threshold) for threshold in thresholds)
+    return round(0.5 * (1 + math.erf(distance / (sigma * math.sqrt(2)))), 4)
+
+def count_distinct_exact(conn, table_name, col_names):
+    """Count distinct values for several columns of a loaded table in a single scan"""
+    cursor = conn.cursor()
+    try:
+        counts_sql = ', '.join([f'COUNT(DISTINCT "{clean_column_name(col)}")' for col in col_names])
+        cursor.execute(f'SELECT {counts_sql} FROM "{table_name}"')
+        return dict(zip(col_names, cursor.fetchone()))
+    finally:
+        cursor.close()
+
+def classify_field(data_type, cardinality_ratio, distinct_count):
+    """Suggest (field_role, semantic_type) with the same rules as analyze_field_characteristics"""
+    if cardinality_ratio > 0.95:
+        field_role = 'identifier'
+    elif data_type == 'TEXT' and cardinality_ratio < 0.5:
+        field_role = 'dimension'
+    elif data_type in ('DATE', 'BOOLEAN'):
+        field_role = 'dimension'
+    elif data_type == 'TEXT' and distinct_count <= 50:
+        field_role = 'dimension'
+    elif data_type in ('INTEGER', 'DECIMAL') and cardinality_ratio > 0.1:
+        field_role = 'measure'
+    else:
+        field_role = 'unknown'
+    
+    if data_type == 'TEXT' and cardinality_ratio < 0.2:
+        semantic_type = 'categorical'
+    elif data_type in ('INTEGER', 'DECIMAL'):
+        semantic_type = 'numerical'
+    elif data_type == 'DATE':
+        semantic_type = 'temporal'
+    elif data_type == 'BOOLEAN':
+        semantic_type = 'boolean'
+    else:
+        semantic_type = 'text'
+    return field_role, semantic_type
+
+def build_column_metadata(column_names, column_types, column_stats, reservoir, total_rows, conn, table_name):
+    """Derive dataset_columns metadata and field analysis from the running stats and the sample
+    
+    Distinct counts are exact when the reservoir holds every row and come from the
+    column's HyperLogLog sketch otherwise. Only columns whose estimate lands too close
+    to a role threshold are counted exactly against the loaded table, all in one scan.
+    """
+    relative_error = 1.04 / math.sqrt(1 << HLL_PRECISION)
+    estimates = {}
+    ambiguous_columns = []
+    for col_name, (logical_type, _), stats in zip(column_names, column_types, column_stats):
+        if total_rows <= len(reservoir):
+            estimates[col_name] = (int(reservoir[col_name].nunique()), 1.0, 'exact')
+            continue
+        estimate = min(hll_count(stats['hll']), stats['non_null_count'])
+        cardinality_ratio = estimate / total_rows if total_rows > 0 else 0
+        confidence = classification_confidence(logical_type, cardinality_ratio, relative_error)
+        estimates[col_name] = (estimate, confidence, 'hll')
+        if confidence < SAMPLE_MIN_CONFIDENCE:
+            ambiguous_columns.append(col_name)
+    
+    if ambiguous_columns:
+        print(f"Sample ambiguous for {len(ambiguous_columns)} columns, counting distinct values exactly")
+        for col_name, exact_count in count_distinct_exact(conn, table_name, ambiguous_columns).items():
+            estimates[col_name] = (exact_count, 1.0, 'full_scan')
+    
+    column_metadata = []
+    for i, (col_name, (logical_type, postgres_type), stats) in enumerate(zip(column_names, column_types, column_stats)):
+        distinct_count, confidence, method = estimates[col_name]
+        cardinality_ratio = distinct_count / total_rows if total_rows > 0 else 0
+        null_percentage = stats['null_count'] / total_rows * 100 if total_rows > 0 else 0
+        field_role, semantic_type = classify_field(logical_type, cardinality_ratio, distinct_count)
+        column_metadata.append({
+            'column_name': col_name,
+            'column_index': i,
+            'data_type': logical_type,
+            'postgres_type': postgres_type,
+            'is_nullable': stats['null_count'] > 0,
+            'sample_values': stats['sample_values'],
+            'unique_count': distinct_count,
+            'field_role': field_role,
+            'semantic_type': semantic_type,
+            'cardinality_ratio': round(cardinality_ratio, 4),
+            'contains_nulls_pct': round(null_percentage, 2),
+            'min_value': stats['min_value'],
+            'max_value': stats['max_value'],
+            'field_stats': {
+                'distinct_count': distinct_count,
+                'distinct_count_method': method,
+                'confidence': confidence,
+                'sample_size': len(reservoir),
+                'non_null_count': stats['non_null_count'],
+                'null_percentage': round(null_percentage, 2),
+                'min_value': stats['min_value'],
+                'max_value': stats['max_value'],
+                'data_type': logical_type,
+                'postgres_type': postgres_type,
+                'is_suitable_for_grouping': field_role == 'dimension',
+                'is_suitable_for_aggregation': field_role == 'measure',
+                'hll': encode_hll_registers(stats['hll'])
+            }
+        })
+    return column_metadata
+
+def bound_sort_key(value, logical_type):
+    """Comparable form of a stored or computed min/max bound, or None when it can't be parsed
+    
+    Bounds written by the SQL analyzer or older ingestions aren't always in the form
+    update_column_stats produces ('12.50', '1e+06', timestamps with another offset).
+    """
+    try:
+        if logical_type == 'DATE':
+            key = pd.Timestamp(str(value))
+            if key is pd.NaT:
+                return None
+            return key.tz_localize('UTC') if key.tzinfo is None else key.tz_convert('UTC')
+        key = decimal.Decimal(str(value).strip())
+        return key if key.is_finite() else None
+    except (ValueError, TypeError, decimal.InvalidOperation):
+        return None
+
+def typed_bound(key, column_type):
+    """A bound_sort_key turned back into the value update_column_stats would have produced"""
+    logical_type, postgres_type = column_type
+    if logical_type == 'DATE':
+        return key.strftime(TEMPORAL_COPY_FORMATS.get(postgres_type, TEMPORAL_COPY_FORMATS['TIMESTAMP WITH TIME ZONE']))
+    if logical_type == 'INTEGER' and key == key.to_integral_value():
+        return int(key)
+    return float(key)
+
+def merge_appended_column(stored, column_type, stats, old_rows, total_rows):
+    """Fold an appended file's stats for one column into its stored dataset_columns row
+    
+    Null counts add up and min/max compare typed values. Distinct counts come from the
+    stored HyperLogLog sketch merged with the new rows' one; columns profiled before
+    sketches were kept get a lower bound, the larger of the two counts.
+    """
+    logical_type = column_type[0]
+    field_stats = dict(stored['field_stats'] or {})
+    old_non_null = field_stats.get('non_null_count')
+    if old_non_null is None:
+        old_non_null = round(old_rows * (1 - float(stored['contains_nulls_pct'] or 0) / 100))
+    non_null_count = old_non_null + stats['non_null_count']
+    
+    bounds = {'min_value': stats['min_value'], 'max_value': stats['max_value']}
+    if logical_type in ('INTEGER', 'DECIMAL', 'DATE'):
+        for bound, pick in (('min_value', min), ('max_value', max)):
+            if stored[bound] is None:
+                continue
+            old_key = bound_sort_key(stored[bound], logical_type)
+            if old_key is None:
+                # Written in a form this analyzer can't read: only the appended rows' bound is known
+                field_stats['bounds_complete'] = False
+                continue
+            new_key = None if bounds[bound] is None else bound_sort_key(bounds[bound], logical_type)
+            if new_key is None or pick(old_key, new_key) != new_key:
+                bounds[bound] = typed_bound(old_key, column_type)
+    min_value, max_value = bounds['min_value'], bounds['max_value']
+    
+    registers = decode_hll_registers(field_stats['hll']) if field_stats.get('hll') else None
+    if registers is not None:
+        np.maximum(registers, stats['hll'], out=registers)
+        field_stats['hll'] = encode_hll_registers(registers)
+        method = 'hll'
+    else:
+        registers = stats['hll']
+        field_stats.pop('hll', None)
+        method = 'lower_bound'
+    distinct_count = max(int(stored['unique_count'] or 0), min(hll_count(registers), non_null_count))
+    
+    cardinality_ratio = distinct_count / total_rows if total_rows > 0 else 0
+    null_percentage = (total_rows - non_null_count) / total_rows * 100 if total_rows > 0 else 0
+    field_role, semantic_type = classify_field(logical_type, cardinality_ratio, distinct_count)
+    relative_error = 1.04 / math.sqrt(1 << HLL_PRECISION)
+    field_stats.update({
+        'distinct_count': distinct_count,
+        'distinct_count_method': method,
+        'confidence': classification_confidence(logical_type, cardinality_ratio, relative_error),
+        'non_null_count': non_null_count,
+        'null_percentage': round(null_percentage, 2),
+        'min_value': min_value,
+        'max_value': max_value,
+        'is_suitable_for_grouping': field_role == 'dimension',
+        'is_suitable_for_aggregation': field_role == 'measure'
+    })
+    return {
+        'column_name': stored['column_name'],
+        'is_nullable': non_null_count < total_rows,
+        'unique_count': distinct_count,
+        'field_role': field_role,
+        'semantic_type': semantic_type,
+        'cardinality_ratio': round(cardinality_ratio, 4),
+        'contains_nulls_pct': round(null_percentage, 2),
+        'min_value': min_value,
+        'max_value': max_value,
+        'field_stats': field_stats
+    }
+
+def write_column_metadata(cursor, dataset_id, column_metadata):
+    """Insert every dataset_columns row for a dataset in one multi-row INSERT
+    
+    dataset_columns is the only copy of the per-column metadata, so each column's
+    sample values and stats are serialized exactly once, here.
+    """
+    rows = [(
+        dataset_id, col_meta['column_name'], col_meta['column_index'],
+        col_meta['data_type'], col_meta['postgres_type'], col_meta['is_nullable'],
+        json.dumps(col_meta['sample_values'], default=json_serializer), col_meta['unique_count'],
+        None if col_meta['min_value'] is None else str(col_meta['min_value']),
+        None if col_meta['max_value'] is None else str(col_meta['max_value']),
+        col_meta['field_role'], col_meta['semantic_type'], col_meta['cardinality_ratio'],
+        col_meta['contains_nulls_pct'], json.dumps(col_meta['field_stats'], default=json_serializer)
+    ) for col_meta in column_metadata]
+    execute_values(cursor, """
+        INSERT INTO dataset_columns 
+        (dataset_id, column_name, column_index, data_type, postgres_type, 
+         is_nullable, sample_values, unique_count, min_value, max_value,
+         field_role, semantic_type, cardinality_ratio, contains_nulls_pct, field_stats)
+        VALUES %s
+    """, rows, page_size=max(len(rows), 1))
+
+def update_column_metadata(cursor, dataset_id, column_metadata):
+    """Rewrite the stats of a dataset's dataset_columns rows in one UPDATE ... FROM (VALUES ...)"""
+    rows = [(
+        dataset_id, col_meta['column_name'], col_meta['is_nullable'], col_meta['unique_count'],
+        None if col_meta['min_value'] is None else str(col_meta['min_value']),
+        None if col_meta['max_value'] is None else str(col_meta['max_value']),
+        col_meta['field_role'], col_meta['semantic_type'], col_meta['cardinality_ratio'],
+        col_meta['contains_nulls_pct'], json.dumps(col_meta['field_stats'], default=json_serializer)
+    ) for col_meta in column_metadata]
+    execute_values(cursor, """
+        UPDATE dataset_columns AS dc
+        SET is_nullable = v.is_nullable,
+            unique_count = v.unique_count,
+            min_value = v.min_value,
+            max_value = v.max_value,
+            field_role = v.field_role,
+            semantic_type = v.semantic_type,
+            cardinality_ratio = v.cardinality_ratio,
+            contains_nulls_pct = v.contains_nulls_pct,
+            field_stats = v.field_stats,
+            updated_at = CURRENT_TIMESTAMP
+        FROM (VALUES %s) AS v (dataset_id, column_name, is_nullable, unique_count, min_value, max_value,
+                               field_role, semantic_type, cardinality_ratio, contains_nulls_pct, field_stats)
+        WHERE dc.dataset_id = v.dataset_id AND dc.column_name = v.column_name
+    """, rows, template='(%s::uuid, %s, %s, %s::integer, %s, %s, %s, %s, %s::numeric, %s::numeric, %s::jsonb)',
+        page_size=max(len(rows), 1))
+
+def widen_column_type(current_type, chunk_type):
+    """The column's current (logical, postgres) type if it holds a new chunk's, else the type to widen to
+    
+    Widening goes straight to the widest type of the family (BIGINT, TIMESTAMP WITH TIME
+    ZONE, DECIMAL), so each column is rewritten at most once however many chunks follow.
+    """
+    if current_type == chunk_type or current_type[0] == 'TEXT':
+        return current_type
+    logical_types = {current_type[0], chunk_type[0]}
+    if logical_types == {'DATE'}:
+        if TEMPORAL_TYPE_ORDER.index(chunk_type[1]) <= TEMPORAL_TYPE_ORDER.index(current_type[1]):
+            return current_type
+        return 'DATE', TEMPORAL_TYPE_ORDER[-1]
+    if logical_types == {'INTEGER'}:
+        if INTEGER_TYPE_DIGITS[chunk_type[1]] <= INTEGER_TYPE_DIGITS[current_type[1]]:
+            return current_type
+        return 'INTEGER', INTEGER_TYPE_RANGES[-1][0]
+    if logical_types <= {'INTEGER', 'DECIMAL'}:
+        return 'DECIMAL', 'DECIMAL'
+    return 'TEXT', 'TEXT'
+
+class PartitionKeyChanged(Exception):
+    """A later chunk needs a wider type for the range partition key, which PostgreSQL can't alter"""
+
+def read_column_types(cursor, table_name):
+    """Read the current (logical, postgres) type of every column in a user table"""
+    cursor.execute("""
+        SELECT column_name, data_type
+        FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s
+    """, (table_name,))
+    return {col_name: POSTGRES_COLUMN_TYPES.get(data_type, ('TEXT', 'TEXT'))
+            for col_name, data_type in cursor.fetchall()}
+
+def alter_column_type(cursor, table_name, safe_col_name, current_type, widened):
+    """Rewrite one column of a user table to a wider type of the same family"""
+    # Naive timestamps and dates were normalised to UTC, so they gain a zone as UTC rather than the session's
+    using = f'"{safe_col_name}"::{widened[1]}'
+    if current_type[1] in ('DATE', 'TIMESTAMP') and widened[1] == 'TIMESTAMP WITH TIME ZONE':
+        using = f'"{safe_col_name}"::TIMESTAMP AT TIME ZONE \'UTC\''
+    cursor.execute(f'ALTER TABLE "{table_name}" ALTER COLUMN "{safe_col_name}" TYPE {widened[1]} USING {using}')
+    print(f"Widened column {safe_col_name} of {table_name} from {current_type[1]} to {widened[1]}")
+
+def fit_chunk_to_table(conn, table_name, column_types, column_hints, chunk):
+    """Widen any table column whose type can't hold the values in this chunk
+    
+    Parallel loaders share the table, so widening holds an advisory lock and starts
+    from the column's current type in the table rather than this loader's copy. Columns
+    hinted fixed_family only widen within their family (SMALLINT to BIGINT, DATE to
+    TIMESTAMP WITH TIME ZONE), never to another logical type.
+    """
+    cursor = conn.cursor()
+    try:
+        table_types = None
+        for i, col_name in enumerate(chunk.columns):
+            # TEXT holds anything, and an all-null chunk fits whatever type the column has
+            if column_types[i][0] == 'TEXT' or chunk[col_name].isnull().all():
+                continue
+            chunk_type = detect_storage_type(chunk[col_name], column_hints[i])
+            widened = widen_column_type(column_types[i], chunk_type)
+            if widened == column_types[i]:
+                continue
+            if column_hints[i].get('fixed_family') and widened[0] != column_types[i][0]:
+                raise ValueError(f"Column {col_name} has values that don't fit its {column_types[i][1]} type")
+            if column_hints[i].get('partition_key'):
+                raise PartitionKeyChanged(f"Partition column {col_name} no longer fits {column_types[i][1]}")
+            if table_types is None:
+                cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (table_name,))
+                table_types = read_column_types(cursor, table_name)
+            safe_col_name = clean_column_name(col_name)
+            current_type = table_types[safe_col_name]
+            widened = widen_column_type(current_type, chunk_type)
+            if widened != current_type:
+                alter_column_type(cursor, table_name, safe_col_name, current_type, widened)
+                table_types[safe_col_name] = widened
+            column_types[i] = widened
+        conn.commit()
+    finally:
+        cursor.close()
+
+def report_type_narrowing(conn, dataset_id, table_name, column_names, column_types, row_count):
+    """Measure the bytes type narrowing saved against the old INTEGER/TIMESTAMPTZ columns
+    
+    pg_column_size of each narrowed column and of the same value cast to its old type is
+    summed over a TABLESAMPLE of about SAMPLE_ROWS rows and scaled to the table; alignment
+    padding isn't counted. Best effort, like the indexing stage. The report lands in
+    datasets.metadata.type_narrowing.
+    """
+    measured = [(col_name, column_type) for col_name, column_type in zip(column_names, column_types)
+                if column_type[0] in LEGACY_COLUMN_TYPES and column_type[1] != LEGACY_COLUMN_TYPES[column_type[0]]]
+    if not measured or row_count == 0:
+        return None
+    cursor = conn.cursor()
+    try:
+        sums = []
+        for col_name, (logical_type, postgres_type) in measured:
+            safe_col_name = clean_column_name(col_name)
+            sums.append(f'SUM(pg_column_size("{safe_col_name}"))')
+            if postgres_type == 'BIGINT':
+                # The old INTEGER column couldn't hold these values at all
+                sums.append('NULL')
+            else:
+                sums.append(f'SUM(pg_column_size("{safe_col_name}"::{LEGACY_COLUMN_TYPES[logical_type]}))')
+        sample_percent = min(100.0, 100.0 * SAMPLE_ROWS / row_count)
+        cursor.execute(f'SELECT COUNT(*), {", ".join(sums)} FROM "{table_name}" TABLESAMPLE SYSTEM ({sample_percent})')
+        sampled_rows, *totals = cursor.fetchone()
+        conn.commit()
+        scale = row_count / sampled_rows if sampled_rows else 0
+        
+        report = {'columns': [], 'legacy_overflow': [], 'sampled_rows': sampled_rows}
+        for i, (col_name, (logical_type, postgres_type)) in enumerate(measured):
+            column_bytes, legacy_bytes = totals[2 * i], totals[2 * i + 1]
+            if legacy_bytes is None and postgres_type == 'BIGINT':
+                report['legacy_overflow'].append(col_name)
+                continue
+            report['columns'].append({
+                'column': col_name,
+                'postgres_type': postgres_type,
+                'legacy_type': LEGACY_COLUMN_TYPES[logical_type],
+                'bytes': int((column_bytes or 0) * scale),
+                'legacy_bytes': int((legacy_bytes or 0) * scale)
+            })
+        report['bytes'] = sum(column['bytes'] for column in report['columns'])
+        report['legacy_bytes'] = sum(column['legacy_bytes'] for column in report['columns'])
+        report['bytes_saved'] = report['legacy_bytes'] - report['bytes']
+        
+        cursor.execute("""
+            UPDATE datasets
+            SET metadata = COALESCE(metadata, '{}'::jsonb) || jsonb_build_object('type_narrowing', %s::jsonb)
+            WHERE dataset_id = %s
+        """, (json.dumps(report), dataset_id))
+        conn.commit()
+        print(f"Type narrowing saved about {report['bytes_saved']} bytes in {table_name}: {report}")
+        return report
+    except psycopg2.Error as e:
+        print(f"Type narrowing report failed for {table_name}: {e}")
+        conn.rollback()
+        return None
+    finally:
+        cursor.close()
+
+def choose_index_columns(columns, budget):
+    """Pick (column, index method) pairs: BRIN on temporal columns, then B-tree on the most selective low-cardinality dimensions"""
+    temporal = [(col, 'brin') for col in columns if col['semantic_type'] == 'temporal']
+    dimensions = sorted(
+        [col for col in columns
+         if col['field_role'] == 'dimension' and col['semantic_type'] in ('categorical', 'text', 'numerical')
+         and (col['cardinality_ratio'] or 0) <= INDEX_MAX_DIMENSION_CARDINALITY and (col['unique_count'] or 0) > 2],
+        key=lambda col: -col['unique_count']
+    )
+    return (temporal + [(col, 'btree') for col in dimensions])[:budget]
+
+def index_probe(table_name, col, method):
+    """A representative filter on a column about to be indexed, as (sql, params), or None"""
+    safe_col_name = clean_column_name(col['column_name'])
+    if method == 'brin':
+        if col['min_value'] is None or col['max_value'] is None:
+            return None
+        # The most recent tenth of the range, like a "last N days" chart filter
+        return (f'SELECT COUNT(*) FROM "{table_name}" WHERE "{safe_col_name}" >= '
+                f'%s::timestamptz + (%s::timestamptz - %s::timestamptz) * 0.9',
+                (col['min_value'], col['max_value'], col['min_value']))
+    if not col['sample_values']:
+        return None
+    return (f'SELECT COUNT(*) FROM "{table_name}" WHERE "{safe_col_name}" = CAST(%s AS {col["postgres_type"]})',
+            (str(col['sample_values'][0]),))
+
+def time_probe(cursor, probe):
+    """Best of two runs of a probe query in milliseconds, so a cold cache doesn't skew the comparison"""
+    timings = []
+    for _ in range(2):
+        start = time.perf_counter()
+        cursor.execute(*probe)
+        cursor.fetchall()
+        timings.append((time.perf_counter() - start) * 1000)
+    return round(min(timings), 2)
+
+def index_dataset_table(conn, dataset_id, table_name, row_count):
+    """Indexing stage after ingestion: index filter/group-by columns within INDEX_BUDGET, ANALYZE, record timings
+    
+    Reads the field analysis from dataset_columns. Best effort: a failure is logged and
+    leaves the dataset usable, just unindexed. The report lands in datasets.metadata.indexing.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT column_name, postgres_type, field_role, semantic_type, unique_count,
+                   cardinality_ratio, sample_values, min_value, max_value
+            FROM dataset_columns
+            WHERE dataset_id = %s
+            ORDER BY column_index
+        """, (dataset_id,))
+        fields = ['column_name', 'postgres_type', 'field_role', 'semantic_type', 'unique_count',
+                  'cardinality_ratio', 'sample_values', 'min_value', 'max_value']
+        columns = [dict(zip(fields, row)) for row in cursor.fetchall()]
+        chosen = choose_index_columns(columns, INDEX_BUDGET) if row_count >= INDEX_MIN_ROWS else []
+        
+        # Time a representative filter per column before indexing
+        probes = []
+        for col, method in chosen:
+            probe = index_probe(table_name, col, method)
+            if probe:
+                probes.append({'column': col['column_name'], 'method': method, 'sql': probe,
+                               'before_ms': time_probe(cursor, probe)})
+        
+        report = {'indexes': [], 'probes': []}
+        cursor.execute("SET LOCAL maintenance_work_mem = %s", (INDEX_MAINTENANCE_WORK_MEM,))
+        for col, method in chosen:
+            safe_col_name = clean_column_name(col['column_name'])
+            index_name = f"idx_{hashlib.sha1(table_name.encode('utf-8')).hexdigest()[:10]}_{safe_col_name[:40]}"
+            start = time.perf_counter()
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS "{index_name}" ON "{table_name}" USING {method} ("{safe_col_name}")')
+            report['indexes'].append({'column': col['column_name'], 'method': method, 'name': index_name,
+                                      'build_ms': round((time.perf_counter() - start) * 1000, 2)})
+        start = time.perf_counter()
+        cursor.execute(f'ANALYZE "{table_name}"')
+        report['analyze_ms'] = round((time.perf_counter() - start) * 1000, 2)
+        conn.commit()
+        
+        for probe in probes:
+            report['probes'].append({
+                'column': probe['column'],
+                'method': probe['method'],
+                'before_ms': probe['before_ms'],
+                'after_ms': time_probe(cursor, probe['sql'])
+            })
+        cursor.execute("""
+            UPDATE datasets
+            SET metadata = COALESCE(metadata, '{}'::jsonb) || jsonb_build_object('indexing', %s::jsonb)
+            WHERE dataset_id = %s
+        """, (json.dumps(report), dataset_id))
+        conn.commit()
+        print(f"Indexed {len(report['indexes'])} columns of {table_name}: {report}")
+        return report
+    except psycopg2.Error as e:
+        print(f"Indexing stage failed for {table_name}: {e}")
+        conn.rollback()
+        return None
+    finally:
+        cursor.close()
+
+class CountingReader:
+    """File-like wrapper around an S3 body that counts and hashes the bytes handed to the parser"""
+    
+    def __init__(self, body):
+        self.body = body
+        self.bytes_read = 0
+        self.sha256 = hashlib.sha256()
+    
+    def read(self, size=-1):
+        data = self.body.read(None if size is None or size < 0 else size)
+        self.bytes_read += len(data)
+        self.sha256.update(data)
+        return data
+    
+    def __iter__(self):
+        return iter(lambda: self.read(65536), b'')
+    
+    def close(self):
+        self.body.close()
+
+class RangedS3Reader:
+    """File-like reader that downloads an S3 object as concurrent byte-range GETs
+    
+    Parts are fetched on a thread pool with at most `concurrency` requests in flight and
+    handed out strictly in order, so a line split across two parts is reassembled by plain
+    concatenation before the parser sees it. At most concurrency + 1 parts sit in memory.
+    """
+    
+    def __init__(self, bucket, key, size, etag=None, part_size=None, concurrency=None, start=0):
+        self.bucket = bucket
+        self.key = key
+        self.etag = etag
+        part_size = part_size or S3_PART_SIZE
+        self.concurrency = concurrency or S3_DOWNLOAD_CONCURRENCY
+        # Reads bytes [start, size) of the object
+        self.ranges = [(first, min(first + part_size, size) - 1) for first in range(start, size, part_size)]
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self.pending = deque()
+        self.next_part = 0
+        self.buffer = b''
+        self.offset = 0
+        self.bytes_read = 0
+        self.sha256 = hashlib.sha256()
+        self._schedule()
+    
+    def _fetch(self, first_byte, last_byte):
+        params = {'Bucket': self.bucket, 'Key': self.key, 'Range': f'bytes={first_byte}-{last_byte}'}
+        if self.etag:
+            # Fail instead of stitching together parts of two different uploads
+            params['IfMatch'] = self.etag
+        return s3_client.get_object(**params)['Body'].read()
+    
+    def _schedule(self):
+        while len(self.pending) < self.concurrency and self.next_part < len(self.ranges):
+            self.pending.append(self.executor.submit(self._fetch, *self.ranges[self.next_part]))
+            self.next_part += 1
+    
+    def read(self, size=-1):
+        pieces = []
+        wanted = None if size is None or size < 0 else size
+        while wanted is None or wanted > 0:
+            if self.offset >= len(self.buffer):
+                if not self.pending:
+                    break
+                self.buffer = self.pending.popleft().result()
+                self.offset = 0
+                self._schedule()
+                continue
+            end = len(self.buffer) if wanted is None else min(len(self.buffer), self.offset + wanted)
+            pieces.append(self.buffer[self.offset:end])
+            if wanted is not None:
+                wanted -= end - self.offset
+            self.offset = end
+        data = b''.join(pieces)
+        self.bytes_read += len(data)
+        self.sha256.update(data)
+        return data
+    
+    def __iter__(self):
+        return iter(lambda: self.read(65536), b'')
+    
+    def close(self):
+        # Wait out in-flight GETs: ingestion forks workers right after closing the sample
+        # reader, and a fork mid-request would copy boto3/urllib3 locks in their held state
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=True)
+
+def open_s3_csv(s3_key):
+    """Open an uploaded CSV for streaming, using parallel ranged GETs for large objects
+    
+    Returns (reader, size in bytes, ETag). Small objects use a single GET since the
+    extra requests wouldn't pay for themselves.
+    """
+    head = s3_client.head_object(Bucket=BUCKET_NAME, Key=s3_key)
+    size = head['ContentLength']
+    etag = head.get('ETag')
+    if size < S3_MULTIPART_THRESHOLD:
+        response = s3_client.get_object(Bucket=BUCKET_NAME, Key=s3_key, IfMatch=etag)
+        return CountingReader(response['Body']), size, etag
+    print(f"Downloading {size} bytes in {S3_PART_SIZE}-byte parts, {S3_DOWNLOAD_CONCURRENCY} at a time")
+    return RangedS3Reader(BUCKET_NAME, s3_key, size, etag=etag), size, etag
+
+def hash_s3_object(s3_key):
+    """SHA-256 of an uploaded file, streamed through the ingestion readers without parsing it"""
+    body, _, _ = open_s3_csv(s3_key)
+    try:
+        for _ in body:
+            pass
+        return body.sha256.hexdigest()
+    finally:
+        body.close()
+
+def find_dataset_by_hash(cursor, content_hash, user_id, any_user=False):
+    """Find a completed dataset ingested from a file with this SHA-256, preferring the user's own"""
+    cursor.execute("""
+        SELECT dataset_id FROM datasets
+        WHERE content_hash = %s AND ingestion_status = 'completed' AND (user_id = %s OR %s)
+        ORDER BY user_id = %s DESC, upload_date
+        LIMIT 1
+    """, (content_hash, user_id, any_user, user_id))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def share_dataset_table(cursor, dataset_id, source_dataset_id, content_hash, reuse_file=False):
+    """Point a dataset at the table of an identical, already ingested one instead of loading it
+    
+    The dataset gets copies of the source's row and column metadata but no table of its
+    own until it changes (see unshare_dataset_table). Holds the table's advisory lock, and
+    only shares while the source still has content_hash, so a concurrent append to the
+    source can't slip in. Returns whether the dataset was shared; the caller commits.
+    """
+    cursor.execute("SELECT table_name FROM datasets WHERE dataset_id = %s", (source_dataset_id,))
+    row = cursor.fetchone()
+    if not row:
+        return False
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (row[0],))
+    cursor.execute("""
+        UPDATE datasets d
+        SET table_name = s.table_name,
+            source_dataset_id = s.dataset_id,
+            content_hash = s.content_hash,
+            s3_key = CASE WHEN %s THEN s.s3_key ELSE d.s3_key END,
+            file_size_bytes = s.file_size_bytes,
+            row_count = s.row_count,
+            column_count = s.column_count,
+            rows_loaded = s.row_count,
+            bytes_read = s.file_size_bytes,
+            progress_updated_at = CURRENT_TIMESTAMP,
+            ingestion_status = 'completed',
+            ingestion_date = CURRENT_TIMESTAMP,
+            error_message = NULL,
+            metadata = COALESCE(s.metadata, '{}'::jsonb) || jsonb_build_object('shared_from', s.dataset_id)
+        FROM datasets s
+        WHERE d.dataset_id = %s AND s.dataset_id = %s
+          AND s.content_hash = %s AND s.ingestion_status = 'completed'
+        RETURNING d.dataset_id
+    """, (reuse_file, dataset_id, source_dataset_id, content_hash))
+    if cursor.fetchone() is None:
+        return False
+    cursor.execute("""
+        INSERT INTO dataset_columns
+        (dataset_id, column_name, column_index, data_type, postgres_type, is_nullable, sample_values,
+         unique_count, min_value, max_value, field_role, semantic_type, cardinality_ratio,
+         contains_nulls_pct, field_stats)
+        SELECT %s, column_name, column_index, data_type, postgres_type, is_nullable, sample_values,
+               unique_count, min_value, max_value, field_role, semantic_type, cardinality_ratio,
+               contains_nulls_pct, field_stats
+        FROM dataset_columns
+        WHERE dataset_id = %s
+    """, (dataset_id, source_dataset_id))
+    return True
+
+def share_verified_duplicate(s3_key, user_id, dataset_id):
+    """Share another user's table when an upload is byte-identical to a file they ingested
+    
+    The hash the client sent at upload only picks the candidate: the uploaded file is
+    hashed here before anything is shared, since a hash alone must never grant access
+    to another user's data. Returns the ingestion result, or None to ingest as usual.
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT metadata->>'claimed_content_hash' FROM datasets WHERE dataset_id = %s AND user_id = %s
+        """, (dataset_id, user_id))
+        row = cursor.fetchone()
+        claimed_hash = row[0] if row else None
+        source_dataset_id = find_dataset_by_hash(cursor, claimed_hash, user_id, any_user=True) if claimed_hash else None
+        conn.commit()
+        if not source_dataset_id:
+            return None
+        
+        try:
+            content_hash = hash_s3_object(s3_key)
+        except Exception as e:
+            print(f"Couldn't hash uploaded file for dataset {dataset_id}, ingesting it: {e}")
+            return None
+        if content_hash != claimed_hash:
+            print(f"Uploaded file for dataset {dataset_id} doesn't match its claimed hash, ingesting it")
+            return None
+        if not share_dataset_table(cursor, dataset_id, source_dataset_id, content_hash):
+            conn.rollback()
+            return None
+        cursor.execute("SELECT table_name, column_count FROM datasets WHERE dataset_id = %s", (dataset_id,))
+        table_name, column_count = cursor.fetchone()
+        conn.commit()
+        print(f"Dataset {dataset_id} is identical to {source_dataset_id}, sharing table {table_name}")
+        return {'success': True, 'table_name': table_name, 'rows_inserted': 0, 'columns': column_count}
+    finally:
+        release_db_connection(conn)
+
+def read_partition_months(cursor, table_name, key_column):
+    """List the UTC months ('YYYY-MM') a range partitioned table's key values fall in"""
+    # Partition bounds are UTC months, so read the keys' months in UTC
+    cursor.execute("SET LOCAL TIME ZONE 'UTC'")
+    cursor.execute(f"""
+        SELECT DISTINCT to_char("{clean_column_name(key_column)}", 'YYYY-MM') FROM "{table_name}"
+    """)
+    return pd.Series([row[0] for row in cursor.fetchall()], dtype=object)
+
+def unshare_dataset_table(conn, dataset_id, column_names, layout):
+    """Copy-on-write for deduplicated datasets: copy a shared table before the dataset changes it
+    
+    Returns the table the dataset may change. The copy gets a fresh name, since the
+    shared table may be the one named after this dataset.
+    """
+    cursor = conn.cursor()
+    own_table = None
+    try:
+        cursor.execute("SELECT table_name, row_count FROM datasets WHERE dataset_id = %s", (dataset_id,))
+        table_name, row_count = cursor.fetchone()
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (table_name,))
+        cursor.execute("""
+            SELECT 1 FROM datasets WHERE table_name = %s AND dataset_id <> %s LIMIT 1
+        """, (table_name, dataset_id))
+        shared = cursor.fetchone() is not None
+        table_types = read_column_types(cursor, table_name)
+        conn.commit()
+        if not shared:
+            return table_name
+        
+        own_table = 'ds_' + uuid.uuid4().hex
+        columns_info = [(col_name, table_types[clean_column_name(col_name)][1]) for col_name in column_names]
+        if not create_user_table(conn, own_table, columns_info, layout):
+            raise Exception("Failed to create table")
+        if layout.get('strategy') == 'range':
+            add_range_partitions(conn, own_table, read_partition_months(cursor, table_name, layout['column']))
+        column_list = ', '.join(f'"{clean_column_name(col_name)}"' for col_name in column_names)
+        cursor.execute(f"""
+            INSERT INTO "{own_table}" (id, {column_list})
+            SELECT id, {column_list} FROM "{table_name}" ORDER BY id
+        """)
+        cursor.execute(f"""
+            SELECT setval(pg_get_serial_sequence(%s, 'id'), COALESCE(MAX(id), 0) + 1, false) FROM "{own_table}"
+        """, (own_table,))
+        if layout.get('mode') == 'partitioned':
+            cursor.execute(f'CREATE INDEX ON "{own_table}" (id)')
+        cursor.execute("""
+            UPDATE datasets SET table_name = %s, source_dataset_id = NULL WHERE dataset_id = %s
+        """, (own_table, dataset_id))
+        conn.commit()
+        print(f"Copied shared table {table_name} to {own_table} for dataset {dataset_id}")
+    except Exception:
+        conn.rollback()
+        if own_table:
+            cursor.execute(f'DROP TABLE IF EXISTS "{own_table}"')
+            conn.commit()
+        raise
+    finally:
+        cursor.close()
+    
+    index_dataset_table(conn, dataset_id, own_table, row_count or 0)
+    return own_table
+
+def record_ingestion_progress(conn, dataset_id, rows_loaded, bytes_read):
+    """Persist how far a running ingestion has got so the status action can report it"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            UPDATE datasets 
+            SET rows_loaded = %s,
+                bytes_read = %s,
+                progress_updated_at = CURRENT_TIMESTAMP
+            WHERE dataset_id = %s
+        """, (rows_loaded, bytes_read, dataset_id))
+        conn.commit()
+    finally:
+        cursor.close()
+
+def record_append_progress(conn, dataset_id, s3_key, rows_loaded, bytes_read):
+    """Persist how far a running append has got under metadata.append_progress
+    
+    The dataset stays completed with its earlier rows while a file is appended, so its
+    rows_loaded and bytes_read keep describing those.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            UPDATE datasets 
+            SET metadata = COALESCE(metadata, '{}'::jsonb) || jsonb_build_object('append_progress', %s::jsonb)
+            WHERE dataset_id = %s
+        """, (json.dumps({'s3_key': s3_key, 'rows_loaded': rows_loaded, 'bytes_read': bytes_read,
+                          'updated_at': datetime.utcnow().isoformat() + 'Z'}), dataset_id))
+        conn.commit()
+    finally:
+        cursor.close()
+
+def load_csv_chunks(conn, record_progress, table_name, reader, body, chunk, column_names, column_types, column_hints, layout):
+    """Load the remaining chunks of a streamed CSV one after another, profiling as they go
+    
+    record_progress(rows, bytes_read) is called every PROGRESS_UPDATE_INTERVAL seconds.
+    Returns (rows loaded, column types, column stats, reservoir sample, bytes read).
+    """
+    column_stats = [new_column_stats() for _ in column_names]
+    reservoir = None
+    rng = np.random.default_rng()
+    rows_inserted = 0
+    last_progress_update = time.monotonic()
+    while chunk is not None:
+        fit_chunk_to_table(conn, table_name, column_types, column_hints, chunk)
+        columns_info = [(col_name, postgres_type) for col_name, (_, postgres_type) in zip(column_names, column_types)]
+        copy_frame = prepare_copy_frame(chunk, columns_info, column_hints)
+        if layout.get('strategy') == 'range':
+            add_range_partitions(conn, table_name, copy_frame[clean_column_name(layout['column'])])
+        
+        # Profile every column in the same pass that loads it
+        for stats, col_name, copy_col, (logical_type, _) in zip(column_stats, column_names, copy_frame.columns, column_types):
+            update_column_stats(stats, chunk[col_name], copy_frame[copy_col], logical_type)
+        reservoir = update_reservoir(reservoir, chunk, rows_inserted, rng)
+        
+        # Insert data
+        if BULK_LOAD_METHOD == 'insert':
+            chunk_rows = insert_csv_data(conn, table_name, chunk)
+        else:
+            chunk_rows = copy_frame_to_table(conn, table_name, copy_frame)
+        if chunk_rows == 0:
+            raise Exception("Failed to insert data")
+        rows_inserted += chunk_rows
+        print(f"Loaded {rows_inserted} rows so far into {table_name}")
+        if time.monotonic() - last_progress_update >= PROGRESS_UPDATE_INTERVAL:
+            record_progress(rows_inserted, body.bytes_read)
+            last_progress_update = time.monotonic()
+        chunk = next(reader, None)
+    return rows_inserted, column_types, column_stats, reservoir, body.bytes_read
+
+def has_embedded_line_breaks(sample):
+    """Check whether any text value in the sample spans several lines of the file"""
+    for col_name in sample.columns:
+        column = sample[col_name]
+        if pd.api.types.is_numeric_dtype(column) or pd.api.types.is_bool_dtype(column):
+            continue
+        if column.dropna().astype(str).str.contains('[\r\n]', regex=True).any():
+            return True
+    return False
+
+def next_line_start(s3_key, offset, size, etag):
+    """Byte offset just past the first newline at or after offset in an S3 object"""
+    position = offset
+    while position < size:
+        response = s3_client.get_object(
+            Bucket=BUCKET_NAME, Key=s3_key, IfMatch=etag,
+            Range=f'bytes={position}-{min(position + 65536, size) - 1}'
+        )
+        data = response['Body'].read()
+        newline = data.find(b'\n')
+        if newline >= 0:
+            return position + newline + 1
+        position += len(data)
+    return size
+
+def plan_csv_ranges(s3_key, size, etag, workers):
+    """Split a CSV object into up to `workers` line-aligned byte ranges after the header line"""
+    starts = [next_line_start(s3_key, 0, size, etag)]
+    for i in range(1, workers):
+        starts.append(max(starts[-1], next_line_start(s3_key, size * i // workers - 1, size, etag)))
+    return [(start, end) for start, end in zip(starts, starts[1:] + [size]) if start < end]
+
+def reset_clients_after_fork():
+    """Give a forked ingestion worker its own connection pool and S3 client
+    
+    The inherited connections share sockets with the parent, so they stay referenced
+    (closing them here would end the parent's sessions) but are never used.
+    """
+    global _idle_connections, _pool_lock, _inherited_clients, s3_client
+    _inherited_clients = (_idle_connections, s3_client)
+    _idle_connections = []
+    _pool_lock = threading.Lock()
+    s3_client = boto3.client('s3', config=Config(max_pool_connections=max(10, S3_DOWNLOAD_CONCURRENCY)))
+
+def load_csv_range(job, sender):
+    """Worker process: parse one byte range of the CSV and COPY it into the shared table
+    
+    Reports ('progress', rows, bytes) after every chunk, then ('done', result) or ('error', message).
+    """
+    reset_clients_after_fork()
     conn = None
+    body = None
     try:
-        # Download CSV from S3
-        print(f"Downloading CSV from S3: {s3_key}")
-        response = s3_client.get_object(Bucket=BUCKET_NAME, Key=s3_key)
-        csv_content = response['Body'].read()
+        conn = get_db_connection()
+        body = RangedS3Reader(BUCKET_NAME, job['s3_key'], job['end'], etag=job['etag'],
+                              concurrency=job['concurrency'], start=job['start'])
+        column_names = job['column_names']
+        column_types = list(job['column_types'])
+        column_hints = job['column_hints']
+        column_stats = [new_column_stats() for _ in column_names]
+        reservoir = None
+        rng = np.random.default_rng()
+        rows_loaded = 0
+        for chunk in read_csv_chunks(body, header=None, names=column_names):
+            fit_chunk_to_table(conn, job['table_name'], column_types, column_hints, chunk)
+            columns_info = [(col_name, postgres_type) for col_name, (_, postgres_type) in zip(column_names, column_types)]
+            copy_frame = prepare_copy_frame(chunk, columns_info, column_hints)
+            if job['layout'].get('strategy') == 'range':
+                add_range_partitions(conn, job['table_name'], copy_frame[clean_column_name(job['layout']['column'])])
+            for stats, col_name, copy_col, (logical_type, _) in zip(column_stats, column_names, copy_frame.columns, column_types):
+                update_column_stats(stats, chunk[col_name], copy_frame[copy_col], logical_type)
+            reservoir = update_reservoir(reservoir, chunk, rows_loaded, rng)
+            if copy_frame_to_table(conn, job['table_name'], copy_frame) == 0:
+                raise Exception("Failed to insert data")
+            rows_loaded += len(chunk)
+            sender.send(('progress', rows_loaded, body.bytes_read))
+        sender.send(('done', {
+            'rows_loaded': rows_loaded,
+            'bytes_read': body.bytes_read,
+            'column_stats': column_stats,
+            'reservoir': reservoir
+        }))
+    except Exception as e:
+        print(f"Ingestion worker error for bytes {job['start']}-{job['end']}: {e}")
+        sender.send(('error', str(e), isinstance(e, PartitionKeyChanged)))
+    finally:
+        if body:
+            body.close()
+        if conn:
+            conn.close()
+        sender.close()
+
+def merge_column_stats(target, source):
+    """Fold one worker's running statistics for a column into another's"""
+    target['non_null_count'] += source['non_null_count']
+    target['null_count'] += source['null_count']
+    target['sample_values'].extend(source['sample_values'][:max(5 - len(target['sample_values']), 0)])
+    np.maximum(target['hll'], source['hll'], out=target['hll'])
+    for key, pick in (('min_value', min), ('max_value', max)):
+        values = [value for value in (target[key], source[key]) if value is not None]
+        target[key] = pick(values) if values else None
+
+def merge_reservoirs(reservoirs, row_counts, rng):
+    """Combine per-range reservoir samples into one uniform sample over all the rows"""
+    reservoirs = [(reservoir, rows) for reservoir, rows in zip(reservoirs, row_counts) if reservoir is not None]
+    if not reservoirs:
+        return None
+    # How many sampled rows each range contributes follows the hypergeometric split of the whole file
+    sample_size = min(SAMPLE_ROWS, sum(rows for _, rows in reservoirs))
+    picks = rng.multivariate_hypergeometric(np.array([rows for _, rows in reservoirs]), sample_size)
+    parts = [reservoir.iloc[rng.choice(len(reservoir), int(pick), replace=False)]
+             for (reservoir, _), pick in zip(reservoirs, picks)]
+    return pd.concat(parts, ignore_index=True)
+
+def load_csv_in_parallel(conn, dataset_id, s3_key, size, etag, table_name, column_names, column_types, column_hints, layout):
+    """Parse and COPY line-aligned byte ranges of the CSV in worker processes
+    
+    Workers are forked with plain Pipes (Lambda has no /dev/shm for multiprocessing
+    queues) and each loads over its own connection into the shared table, which the
+    caller renames into place. Returns the same tuple as load_csv_chunks.
+    """
+    ranges = plan_csv_ranges(s3_key, size, etag, INGEST_WORKERS)
+    header_bytes = ranges[0][0] if ranges else size
+    print(f"Loading {len(ranges)} byte ranges of {s3_key} in parallel")
+    context = multiprocessing.get_context('fork')
+    workers = []
+    try:
+        for start, end in ranges:
+            receiver, sender = context.Pipe(duplex=False)
+            job = {
+                's3_key': s3_key,
+                'etag': etag,
+                'start': start,
+                'end': end,
+                'concurrency': max(2, S3_DOWNLOAD_CONCURRENCY // len(ranges)),
+                'table_name': table_name,
+                'column_names': column_names,
+                'column_types': column_types,
+                'column_hints': column_hints,
+                'layout': layout
+            }
+            process = context.Process(target=load_csv_range, args=(job, sender), daemon=True)
+            process.start()
+            sender.close()
+            workers.append({'process': process, 'receiver': receiver, 'rows': 0, 'bytes': 0, 'result': None})
+        
+        pending = {worker['receiver']: worker for worker in workers}
+        last_progress_update = time.monotonic()
+        while pending:
+            for receiver in multiprocessing.connection.wait(list(pending), timeout=PROGRESS_UPDATE_INTERVAL):
+                worker = pending[receiver]
+                try:
+                    message = receiver.recv()
+                except EOFError:
+                    raise Exception("Ingestion worker exited without reporting a result")
+                if message[0] == 'error':
+                    error_type = PartitionKeyChanged if message[2] else Exception
+                    raise error_type(f"Ingestion worker failed: {message[1]}")
+                if message[0] == 'done':
+                    worker['result'] = message[1]
+                    del pending[receiver]
+                else:
+                    worker['rows'], worker['bytes'] = message[1], message[2]
+            if time.monotonic() - last_progress_update >= PROGRESS_UPDATE_INTERVAL:
+                record_ingestion_progress(conn, dataset_id, sum(w['rows'] for w in workers),
+                                          header_bytes + sum(w['bytes'] for w in workers))
+                last_progress_update = time.monotonic()
+    finally:
+        for worker in workers:
+            if worker['result'] is None and worker['process'].is_alive():
+                # A killed worker's connection drops, which rolls back its uncommitted COPY
+                worker['process'].terminate()
+            worker['process'].join()
+            worker['receiver'].close()
+    
+    # Workers may have widened columns, so the table is the authority on final types
+    cursor = conn.cursor()
+    table_types = read_column_types(cursor, table_name)
+    cursor.close()
+    column_types = [table_types[clean_column_name(col_name)] for col_name in column_names]
+    
+    results = [worker['result'] for worker in workers]
+    column_stats = [new_column_stats() for _ in column_names]
+    for result in results:
+        for target, source in zip(column_stats, result['column_stats']):
+            merge_column_stats(target, source)
+    for stats, (logical_type, _) in zip(column_stats, column_types):
+        if logical_type not in ('INTEGER', 'DECIMAL', 'DATE'):
+            stats['min_value'] = stats['max_value'] = None
+    row_counts = [result['rows_loaded'] for result in results]
+    reservoir = merge_reservoirs([result['reservoir'] for result in results], row_counts, np.random.default_rng())
+    bytes_read = header_bytes + sum(result['bytes_read'] for result in results)
+    return sum(row_counts), column_types, column_stats, reservoir, bytes_read
+
+def drop_unshared_table(cursor, dataset_id, table_name):
+    """Drop a dataset's table left by a failed load, unless another dataset's rows live in it"""
+    cursor.execute("""
+        SELECT 1 FROM datasets WHERE table_name = %s AND dataset_id <> %s LIMIT 1
+    """, (table_name, dataset_id))
+    if cursor.fetchone() is None:
+        cursor.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+
+def ingest_csv_from_s3(s3_key, user_id, original_filename, dataset_id, range_partitions=True):
+    """Main CSV ingestion function
+    
+    range_partitions=False is the retry after a range partition key turned out not to be
+    temporal in a later chunk; the dataset is then reloaded hash partitioned.
+    """
+    if DEDUP_ACROSS_USERS and range_partitions:
+        shared = share_verified_duplicate(s3_key, user_id, dataset_id)
+        if shared:
+            return shared
+    
+    conn = None
+    body = None
+    load_table = None
+    try:
+        # Stream CSV from S3 instead of reading the whole object into memory
+        print(f"Streaming CSV from S3: {s3_key}")
+        body, file_size_bytes, etag = open_s3_csv(s3_key)
+        reader = read_csv_chunks(body)
         
-        # Parse CSV with pandas
-        df = pd.read_csv(io.BytesIO(csv_content))
-        print(f"CSV loaded: {len(df)} rows, {len(df.columns)} columns")
+        # The first chunk is the sample used for type inference
+        first_chunk = next(reader, None)
+        if first_chunk is None or len(first_chunk) == 0:
+            raise Exception("CSV file contains no data rows")
+        column_names = list(first_chunk.columns)
+        print(f"CSV sample loaded: {len(first_chunk)} rows, {len(column_names)} columns")
         
         # Connect to database
         conn = get_db_connection()
         cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE datasets 
+            SET ingestion_status = 'processing',
+                ingestion_started_at = CURRENT_TIMESTAMP,
+                progress_updated_at = CURRENT_TIMESTAMP,
+                file_size_bytes = %s,
+                rows_loaded = 0,
+                bytes_read = 0,
+                error_message = NULL
+            WHERE dataset_id = %s
+            RETURNING table_name
+        """, (file_size_bytes, dataset_id))
+        # The table name was fixed at upload time
+        dataset_row = cursor.fetchone()
+        table_name = dataset_row[0] if dataset_row else dataset_table_name(dataset_id)
+        conn.commit()
         
-        # Generate table name
-        cursor.execute("SELECT generate_dataset_table_name(%s, %s)", (user_id, original_filename))
-        table_name = cursor.fetchone()[0]
+        # Analyze column types, narrowed to the smallest storage that holds the first chunk
+        column_hints = [{} for _ in column_names]
+        whole_file = len(first_chunk) < CSV_CHUNK_ROWS
+        column_types = [initial_storage_type(first_chunk[col_name], type_hints, whole_file)
+                        for col_name, type_hints in zip(column_names, column_hints)]
         
-        # Analyze column types
-        columns_info = []
-        column_metadata = []
-        for i, col_name in enumerate(df.columns):
-            logical_type, postgres_type = detect_column_type(df[col_name])
-            columns_info.append((col_name, postgres_type))
-            
-            # Collect metadata
-            non_null_values = df[col_name].dropna()
-            column_metadata.append({
-                'column_name': col_name,
-                'column_index': i,
-                'data_type': logical_type,
-                'postgres_type': postgres_type,
-                'is_nullable': bool(df[col_name].isnull().any()),
-                'sample_values': non_null_values.head(5).tolist() if len(non_null_values) > 0 else [],
-                'unique_count': int(len(non_null_values.unique())) if len(non_null_values) > 0 else 0
-            })
+        # Very large files get a partitioned table
+        layout = choose_storage_layout(file_size_bytes, first_chunk, column_names, column_types)
+        if layout['mode'] == 'partitioned' and not range_partitions:
+            layout = {'mode': 'partitioned', 'strategy': 'hash', 'partitions': PARTITION_HASH_COUNT}
+        if layout['mode'] == 'partitioned':
+            for col_name, type_hints in zip(column_names, column_hints):
+                type_hints['partition_key'] = col_name == layout.get('column')
+            print(f"Using partitioned storage: {layout}")
+        columns_info = [(col_name, postgres_type) for col_name, (_, postgres_type) in zip(column_names, column_types)]
+        
+        # Large files are loaded by worker processes into a staging table that is renamed into
+        # place with the metadata; a quoted line break would make byte ranges split rows, so
+        # files showing one in the sample stay serial
+        parallel = (BULK_LOAD_METHOD == 'copy' and INGEST_WORKERS > 1
+                    and file_size_bytes >= INGEST_PARALLEL_THRESHOLD
+                    and not has_embedded_line_breaks(first_chunk))
+        if parallel:
+            load_table = 'staging_' + uuid.UUID(str(dataset_id)).hex
+            cursor.execute(f'DROP TABLE IF EXISTS "{load_table}"')
+        else:
+            load_table = table_name
+        # A re-queued dataset may have left its table behind when an earlier attempt died
+        drop_unshared_table(cursor, dataset_id, table_name)
+        conn.commit()
         
         # Create table
-        if not create_user_table(conn, table_name, columns_info):
+        if not create_user_table(conn, load_table, columns_info, layout):
             raise Exception("Failed to create table")
         
-        # Insert data
-        rows_inserted = insert_csv_data(conn, table_name, df)
-        if rows_inserted == 0:
-            raise Exception("Failed to insert data")
+        # Load chunk by chunk, widening column types when a later chunk doesn't fit
+        if parallel:
+            # Closing joins the reader's download threads, so none are running when the workers fork
+            body.close()
+            body = None
+            rows_inserted, column_types, column_stats, reservoir, bytes_read = load_csv_in_parallel(
+                conn, dataset_id, s3_key, file_size_bytes, etag, load_table, column_names, column_types, column_hints, layout
+            )
+            # Workers only see their own byte ranges, so the file is streamed once more to hash it,
+            # after they have exited; files too big for the upload form to hash are never matched
+            content_hash = None
+            if file_size_bytes <= CONTENT_HASH_MAX_BYTES:
+                try:
+                    content_hash = hash_s3_object(s3_key)
+                except Exception as e:
+                    print(f"Couldn't hash {s3_key}, storing the dataset without a content hash: {e}")
+        else:
+            rows_inserted, column_types, column_stats, reservoir, bytes_read = load_csv_chunks(
+                conn, lambda rows, bytes_read: record_ingestion_progress(conn, dataset_id, rows, bytes_read),
+                table_name, reader, body, first_chunk, column_names, column_types, column_hints, layout
+            )
+            content_hash = body.sha256.hexdigest()
+        
+        # Collect metadata and field analysis from the sample
+        column_metadata = build_column_metadata(
+            column_names, column_types, column_stats, reservoir, rows_inserted, conn, load_table
+        )
+        if layout['mode'] == 'partitioned':
+            # No primary key on a partitioned table, so getData's keyset paging gets its own index
+            cursor.execute(f'CREATE INDEX ON "{load_table}" (id)')
+            layout['partition_count'] = len(read_partition_names(cursor, load_table))
+        if load_table != table_name:
+            cursor.execute(f'ALTER TABLE "{load_table}" RENAME TO "{table_name}"')
         
         # Update dataset metadata
         cursor.execute("""
@@ -202,38 +2554,51 @@ def ingest_csv_from_s3(s3_key, user_id, original_filename, dataset_id):
             SET table_name = %s,
                 row_count = %s,
                 column_count = %s,
+                rows_loaded = %s,
+                bytes_read = %s,
+                progress_updated_at = CURRENT_TIMESTAMP,
                 ingestion_status = 'completed',
                 ingestion_date = CURRENT_TIMESTAMP,
+                content_hash = %s,
                 metadata = %s
             WHERE dataset_id = %s
-        """, (table_name, len(df), len(df.columns), json.dumps({'columns': column_metadata}), dataset_id))
+        """, (table_name, rows_inserted, len(column_names), rows_inserted, bytes_read, content_hash,
+              json.dumps({'storage': layout}), dataset_id))
         
-        # Insert column metadata
-        for col_meta in column_metadata:
-            cursor.execute("""
-                INSERT INTO dataset_columns 
-                (dataset_id, column_name, column_index, data_type, postgres_type, 
-                 is_nullable, sample_values, unique_count)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            """, (
-                dataset_id, col_meta['column_name'], col_meta['column_index'],
-                col_meta['data_type'], col_meta['postgres_type'], col_meta['is_nullable'],
-                json.dumps(col_meta['sample_values']), col_meta['unique_count']
-            ))
+        # Insert column metadata, in the same transaction as the status update
+        write_column_metadata(cursor, dataset_id, column_metadata)
+        
+        # Results cached for an earlier load of this dataset are stale now
+        invalidate_result_cache(conn, dataset_id)
         
         conn.commit()
         print(f"Successfully ingested CSV into table: {table_name}")
+        
+        report_type_narrowing(conn, dataset_id, table_name, column_names, column_types, rows_inserted)
+        index_dataset_table(conn, dataset_id, table_name, rows_inserted)
         return {
             'success': True,
             'table_name': table_name,
             'rows_inserted': rows_inserted,
-            'columns': len(df.columns)
+            'columns': len(column_names)
         }
         
+    except PartitionKeyChanged as e:
+        print(f"{e}; reloading with hash partitions")
+        conn.rollback()
+        cursor = conn.cursor()
+        cursor.execute(f'DROP TABLE IF EXISTS "{load_table}"')
+        conn.commit()
     except Exception as e:
         print(f"CSV ingestion error: {e}")
         if conn:
+            conn.rollback()
             cursor = conn.cursor()
+            if load_table and load_table != table_name:
+                cursor.execute(f'DROP TABLE IF EXISTS "{load_table}"')
+            if load_table:
+                # Re-queuing the failed dataset creates the table again
+                drop_unshared_table(cursor, dataset_id, table_name)
             cursor.execute("""
                 UPDATE datasets 
                 SET ingestion_status = 'failed',
@@ -243,21 +2608,299 @@ def ingest_csv_from_s3(s3_key, user_id, original_filename, dataset_id):
             conn.commit()
         return {'success': False, 'error': str(e)}
     finally:
+        if body:
+            body.close()
+        release_db_connection(conn)
+    
+    # Only a PartitionKeyChanged gets here; the reload opens its own stream and connection
+    return ingest_csv_from_s3(s3_key, user_id, original_filename, dataset_id, range_partitions=False)
+
+def append_csv_from_s3(s3_key, user_id, dataset_id):
+    """Append a recurring upload's rows to a completed dataset
+    
+    The file must have the dataset's columns, in the same order, with values that fit
+    their current types. Rows are loaded into a staging table first and moved into the
+    dataset table in the transaction that merges the column stats, so queries see either
+    none or all of the new rows and the dataset stays queryable throughout. Old rows are
+    never rescanned.
+    """
+    conn = None
+    body = None
+    staging_table = None
+    try:
+        if not s3_key.startswith(f"{user_id}/"):
+            raise Exception("Appended file doesn't belong to this user")
+        print(f"Streaming CSV to append from S3: {s3_key}")
+        body, file_size_bytes, etag = open_s3_csv(s3_key)
+        reader = read_csv_chunks(body)
+        first_chunk = next(reader, None)
+        if first_chunk is None or len(first_chunk) == 0:
+            raise Exception("CSV file contains no data rows")
+        column_names = list(first_chunk.columns)
+        
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT table_name, metadata
+            FROM datasets
+            WHERE dataset_id = %s AND user_id = %s AND ingestion_status = 'completed'
+        """, (dataset_id, user_id))
+        dataset_row = cursor.fetchone()
+        if not dataset_row:
+            raise Exception("Dataset not found or not completed ingestion")
+        table_name, metadata = dataset_row
+        metadata = metadata or {}
+        if any(append['s3_key'] == s3_key for append in metadata.get('appends', [])):
+            # A duplicate delivery of a job that already ran
+            print(f"{s3_key} already appended to dataset {dataset_id}, skipping")
+            conn.commit()
+            return {'success': True, 'table_name': table_name, 'rows_inserted': 0, 'columns': len(column_names)}
+        
+        cursor.execute("""
+            SELECT column_name FROM dataset_columns WHERE dataset_id = %s ORDER BY column_index
+        """, (dataset_id,))
+        stored_names = [row[0] for row in cursor.fetchall()]
+        if stored_names != column_names:
+            raise Exception(f"Appended file's columns {column_names} don't match the dataset's {stored_names}")
+        
+        # A deduplicated dataset shares its table, so it gets its own copy before it changes
+        layout = metadata.get('storage') or {'mode': 'heap'}
+        table_name = unshare_dataset_table(conn, dataset_id, column_names, layout)
+        
+        # Earlier loads may have widened the table past what dataset_columns recorded, so
+        # the table is the source of truth. The staging table starts with those types and may
+        # widen within a family (a counter passing SMALLINT, dates gaining a time), never across
+        table_types = read_column_types(cursor, table_name)
+        conn.commit()
+        column_types = [table_types[clean_column_name(col_name)] for col_name in column_names]
+        column_hints = [{'fixed_family': True, 'partition_key': col_name == layout.get('column')}
+                        for col_name in column_names]
+        columns_info = [(col_name, postgres_type) for col_name, (_, postgres_type) in zip(column_names, column_types)]
+        
+        staging_table = 'staging_' + uuid.uuid4().hex
+        if not create_user_table(conn, staging_table, columns_info):
+            raise Exception("Failed to create staging table")
+        # Progress goes to metadata.append_progress, not the completed dataset's own counters
+        rows_appended, _, column_stats, _, _ = load_csv_chunks(
+            conn, lambda rows, bytes_read: record_append_progress(conn, dataset_id, s3_key, rows, bytes_read),
+            staging_table, reader, body, first_chunk, column_names, column_types, column_hints, {'mode': 'heap'}
+        )
+        
+        if layout.get('strategy') == 'range':
+            add_range_partitions(conn, table_name, read_partition_months(cursor, staging_table, layout['column']))
+        
+        # Lock the dataset row so concurrent appends merge one after another
+        cursor.execute("""
+            SELECT row_count, metadata FROM datasets WHERE dataset_id = %s FOR UPDATE
+        """, (dataset_id,))
+        old_rows, metadata = cursor.fetchone()
+        old_rows = old_rows or 0
+        metadata = metadata or {}
+        if any(append['s3_key'] == s3_key for append in metadata.get('appends', [])):
+            print(f"{s3_key} appended to dataset {dataset_id} by another delivery, skipping")
+            conn.rollback()
+            return {'success': True, 'table_name': table_name, 'rows_inserted': 0, 'columns': len(column_names)}
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (table_name,))
+        cursor.execute("""
+            SELECT 1 FROM datasets WHERE table_name = %s AND dataset_id <> %s LIMIT 1
+        """, (table_name, dataset_id))
+        if cursor.fetchone() is not None:
+            raise Exception("Another upload started sharing this dataset's table during the append; retry it")
+        
+        # Bring the dataset table up to any type the staging load widened to, under the table lock
+        table_types = read_column_types(cursor, table_name)
+        for i, col_name in enumerate(column_names):
+            safe_col_name = clean_column_name(col_name)
+            widened = widen_column_type(table_types[safe_col_name], column_types[i])
+            if widened != table_types[safe_col_name]:
+                alter_column_type(cursor, table_name, safe_col_name, table_types[safe_col_name], widened)
+                cursor.execute("""
+                    UPDATE dataset_columns SET postgres_type = %s, updated_at = CURRENT_TIMESTAMP
+                    WHERE dataset_id = %s AND column_name = %s
+                """, (widened[1], dataset_id, col_name))
+            column_types[i] = widened
+        cursor.execute("""
+            SELECT column_name, unique_count, min_value, max_value, contains_nulls_pct, field_stats
+            FROM dataset_columns WHERE dataset_id = %s ORDER BY column_index
+        """, (dataset_id,))
+        stored_columns = [dict(zip(['column_name', 'unique_count', 'min_value', 'max_value',
+                                    'contains_nulls_pct', 'field_stats'], row)) for row in cursor.fetchall()]
+        
+        column_list = ', '.join(f'"{clean_column_name(col_name)}"' for col_name in column_names)
+        cursor.execute(f"""
+            INSERT INTO "{table_name}" ({column_list})
+            SELECT {column_list} FROM "{staging_table}" ORDER BY id
+        """)
+        total_rows = old_rows + rows_appended
+        update_column_metadata(cursor, dataset_id, [
+            merge_appended_column(stored, column_type, stats, old_rows, total_rows)
+            for stored, column_type, stats in zip(stored_columns, column_types, column_stats)
+        ])
+        cursor.execute("""
+            UPDATE datasets 
+            SET row_count = %s,
+                rows_loaded = %s,
+                progress_updated_at = CURRENT_TIMESTAMP,
+                ingestion_date = CURRENT_TIMESTAMP,
+                error_message = NULL,
+                content_hash = NULL,
+                metadata = jsonb_set(COALESCE(metadata, '{}'::jsonb) - 'append_progress', '{appends}',
+                                     COALESCE(metadata->'appends', '[]'::jsonb) || %s::jsonb)
+            WHERE dataset_id = %s
+        """, (total_rows, total_rows, json.dumps([{
+            's3_key': s3_key, 'rows': rows_appended, 'file_size_bytes': file_size_bytes,
+            'appended_at': datetime.utcnow().isoformat() + 'Z'
+        }]), dataset_id))
+        cursor.execute(f'DROP TABLE "{staging_table}"')
+        staging_table = None
+        
+        # Results cached for the dataset before the append are stale now
+        invalidate_result_cache(conn, dataset_id)
+        
+        conn.commit()
+        print(f"Appended {rows_appended} rows to {table_name}, {total_rows} rows in total")
+        
+        # Refresh planner statistics from a sample; the indexes were maintained by the insert
+        cursor.execute(f'ANALYZE "{table_name}"')
+        conn.commit()
+        return {
+            'success': True,
+            'table_name': table_name,
+            'rows_inserted': rows_appended,
+            'columns': len(column_names)
+        }
+    
+    except Exception as e:
+        print(f"CSV append error: {e}")
         if conn:
-            conn.close()
+            # The dataset still holds its earlier rows, so it stays completed
+            conn.rollback()
+            cursor = conn.cursor()
+            if staging_table:
+                cursor.execute(f'DROP TABLE IF EXISTS "{staging_table}"')
+            cursor.execute("""
+                UPDATE datasets
+                SET error_message = %s,
+                    metadata = COALESCE(metadata, '{}'::jsonb) - 'append_progress'
+                WHERE dataset_id = %s AND user_id = %s
+            """, (str(e), dataset_id, user_id))
+            conn.commit()
+        return {'success': False, 'error': str(e)}
+    finally:
+        if body:
+            body.close()
+        release_db_connection(conn)
+
+def run_ingestion_job(job):
+    """Run one queued ingestion job, skipping it if another delivery already claimed it
+    
+    A dataset left 'processing' by a run that timed out or crashed is reclaimed once its
+    progress is older than INGESTION_STALE_AFTER, so the SQS redelivery picks it up again.
+    """
+    if job.get('mode') == 'append':
+        # Appends leave the dataset completed, so they dedupe on their S3 key instead of a claim
+        return append_csv_from_s3(job['s3Key'], job['userId'], job['datasetId'])
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        # Claim the job atomically so duplicate SQS deliveries don't ingest twice
+        cursor.execute("""
+            UPDATE datasets 
+            SET ingestion_status = 'processing',
+                progress_updated_at = CURRENT_TIMESTAMP
+            WHERE dataset_id = %s
+              AND (ingestion_status = 'queued'
+                   OR (ingestion_status = 'processing'
+                       AND progress_updated_at < CURRENT_TIMESTAMP - make_interval(secs => %s)))
+            RETURNING dataset_id
+        """, (job['datasetId'], INGESTION_STALE_AFTER))
+        claimed = cursor.fetchone() is not None
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+    
+    if not claimed:
+        print(f"Ingestion job for dataset {job['datasetId']} already claimed, skipping")
+        return None
+    return ingest_csv_from_s3(job['s3Key'], job['userId'], job['originalFilename'], job['datasetId'])
+
+def process_local_ingestion_queue():
+    """Worker loop for the in-process queue enabled by INGESTION_LOCAL_QUEUE"""
+    while True:
+        job = _local_ingestion_queue.get()
+        try:
+            run_ingestion_job(job)
+        except Exception as e:
+            print(f"Local ingestion job failed: {e}")
+        finally:
+            _local_ingestion_queue.task_done()
+
+def ingestion_queue_configured():
+    """Whether enqueueIngest has somewhere to send jobs that will actually run them"""
+    return bool(INGESTION_QUEUE_URL) or INGESTION_LOCAL_QUEUE
+
+def enqueue_ingestion_job(job):
+    """Hand an ingestion job to SQS, or to the in-process queue when it is enabled for local runs"""
+    global _local_ingestion_worker
+    if INGESTION_QUEUE_URL:
+        sqs_client.send_message(QueueUrl=INGESTION_QUEUE_URL, MessageBody=json.dumps(job))
+        return
+    if not INGESTION_LOCAL_QUEUE:
+        raise Exception("No ingestion queue configured: set INGESTION_QUEUE_URL, or INGESTION_LOCAL_QUEUE=true locally")
+    if _local_ingestion_worker is None:
+        _local_ingestion_worker = threading.Thread(target=process_local_ingestion_queue, daemon=True)
+        _local_ingestion_worker.start()
+    _local_ingestion_queue.put(job)
+
+def handle_ingestion_records(records):
+    """Process SQS ingestion messages, reporting only crashed jobs back for redelivery"""
+    failures = []
+    for record in records:
+        try:
+            run_ingestion_job(json.loads(record['body']))
+        except Exception as e:
+            print(f"Ingestion worker error for message {record.get('messageId')}: {e}")
+            failures.append({'itemIdentifier': record['messageId']})
+    return {'batchItemFailures': failures}
+
+def describe_ingestion_progress(row):
+    """Turn a datasets progress row into the status payload, including an ETA from bytes read"""
+    (dataset_id, status, rows_loaded, bytes_read, file_size_bytes,
+     started_at, progress_updated_at, row_count, error_message, append_progress) = row
+    progress = None
+    eta_seconds = None
+    if file_size_bytes and bytes_read is not None:
+        progress = min(bytes_read / file_size_bytes, 1.0)
+        if status == 'processing' and started_at and progress_updated_at and progress > 0:
+            elapsed = (progress_updated_at - started_at).total_seconds()
+            eta_seconds = round(elapsed * (1 - progress) / progress, 1)
+    return {
+        'datasetId': str(dataset_id),
+        'status': status,
+        'rowsLoaded': rows_loaded,
+        'bytesRead': bytes_read,
+        'fileSizeBytes': file_size_bytes,
+        'progress': progress,
+        'etaSeconds': eta_seconds,
+        'startedAt': started_at,
+        'updatedAt': progress_updated_at,
+        'rowCount': row_count,
+        'error': error_message,
+        'appendProgress': append_progress
+    }
 
 def handler(event, context):
     print('received event:')
     print(event)
+    
+    # SQS deliveries come from the ingestion queue, not API Gateway
+    records = event.get('Records') or []
+    if records and records[0].get('eventSource') == 'aws:sqs':
+        return handle_ingestion_records(records)
+    
     http_method = event.get('httpMethod')
-    test_internet_connectivity()
 
     conn = None
-    try:
-        conn = get_db_connection()
-    except Exception as e:
-        print(f"Database connection failed: {e}")
-        # Continue without DB for upload URL generation
     
     # CORS headers
     cors_headers = {
@@ -278,6 +2921,16 @@ def handler(event, context):
         # Parse request body
         body = json.loads(event['body']) if event['body'] else {}
         
+        query_params = event.get('queryStringParameters') or {}
+        
+        # Connect lazily, only for requests that touch the database
+        if http_method == 'GET' or (http_method == 'POST' and body.get('action', 'upload') in DB_ACTIONS):
+            try:
+                conn = get_db_connection()
+            except Exception as e:
+                print(f"Database connection failed: {e}")
+                # Continue without DB for upload URL generation
+        
         if http_method == 'POST':
             action = body.get('action', 'upload')  # 'upload' or 'ingest'
             print(f"Processing POST request with action: {action}")
@@ -297,6 +2950,16 @@ def handler(event, context):
                         })
                     }
                 
+                content_hash = (body.get('contentHash') or '').lower() or None
+                if content_hash and not CONTENT_HASH_PATTERN.fullmatch(content_hash):
+                    return {
+                        'statusCode': 400,
+                        'headers': cors_headers,
+                        'body': json.dumps({
+                            'error': 'contentHash must be a hex SHA-256 digest'
+                        })
+                    }
+                
                 # Validate file type
                 if not file_type.startswith('text/csv') and not file_name.lower().endswith('.csv'):
                     return {
@@ -312,26 +2975,71 @@ def handler(event, context):
                 safe_file_name = file_name.replace(' ', '_').replace('/', '_')
                 s3_key = f"{user_id}/{file_id}_{safe_file_name}"
                 
+                append_to = body.get('appendToDatasetId')
+                if append_to:
+                    # A recurring upload appended to an existing dataset keeps its record
+                    found = False
+                    if conn:
+                        cursor = conn.cursor()
+                        cursor.execute("""
+                            SELECT dataset_id FROM datasets
+                            WHERE dataset_id = %s AND user_id = %s AND ingestion_status = 'completed'
+                        """, (append_to, user_id))
+                        found = cursor.fetchone() is not None
+                        conn.commit()
+                    if not found:
+                        return {
+                            'statusCode': 404,
+                            'headers': cors_headers,
+                            'body': json.dumps({
+                                'error': 'Dataset to append to not found or not completed ingestion'
+                            })
+                        }
+                
                 # Create dataset record in database
-                dataset_id = str(uuid.uuid4())
-                if conn:
+                dataset_id = append_to or str(uuid.uuid4())
+                source_dataset_id = None
+                if conn and not append_to:
                     try:
                         cursor = conn.cursor()
                         
-                        # Generate table name first
-                        cursor.execute("SELECT generate_dataset_table_name(%s, %s)", (user_id, file_name))
-                        table_name = cursor.fetchone()[0]
+                        # Named after the dataset, so it's unique without asking the database
+                        table_name = dataset_table_name(dataset_id)
                         
-                        # Insert dataset record (user must already exist)
+                        # Insert dataset record (user must already exist); the claimed hash is
+                        # only trusted against the user's own files until ingestion verifies it
                         cursor.execute("""
                             INSERT INTO datasets 
-                            (dataset_id, user_id, original_filename, s3_key, table_name, ingestion_status)
-                            VALUES (%s, %s, %s, %s, %s, 'pending')
-                        """, (dataset_id, user_id, file_name, s3_key, table_name))
+                            (dataset_id, user_id, original_filename, s3_key, table_name, ingestion_status, metadata)
+                            VALUES (%s, %s, %s, %s, %s, 'pending', %s)
+                        """, (dataset_id, user_id, file_name, s3_key, table_name,
+                              json.dumps({'claimed_content_hash': content_hash}) if content_hash else None))
+                        
+                        # A file the user has already ingested shares that table and is never uploaded
+                        if content_hash:
+                            source_dataset_id = find_dataset_by_hash(cursor, content_hash, user_id)
+                            if source_dataset_id and not share_dataset_table(
+                                cursor, dataset_id, source_dataset_id, content_hash, reuse_file=True
+                            ):
+                                source_dataset_id = None
                         conn.commit()
                     except Exception as e:
                         print(f"Database insert error: {e}")
                         conn.rollback()
+                        source_dataset_id = None
+                
+                if source_dataset_id:
+                    print(f"Upload for dataset {dataset_id} is identical to {source_dataset_id}, skipping ingestion")
+                    return {
+                        'statusCode': 200,
+                        'headers': cors_headers,
+                        'body': json.dumps({
+                            'datasetId': dataset_id,
+                            'deduplicated': True,
+                            'sharedFrom': str(source_dataset_id),
+                            'status': 'completed'
+                        })
+                    }
                 
                 # Generate pre-signed POST
                 presigned_post = s3_client.generate_presigned_post(
@@ -340,7 +3048,7 @@ def handler(event, context):
                     Fields={
                         'Content-Type': file_type,
                         'x-amz-server-side-encryption': 'aws:kms',
-                        'x-amz-server-side-encryption-aws-kms-key-id': 'arn:aws:kms:eu-west-2:252326958099:key/602a7058-adf6-48c5-80bf-39ea7956742f',
+                        'x-amz-server-side-encryption-aws-kms-key-id': DATASETS_KMS_KEY_ID,
                         'x-amz-meta-user-id': user_id,
                         'x-amz-meta-original-name': file_name,
                         'x-amz-meta-file-id': file_id,
@@ -349,7 +3057,7 @@ def handler(event, context):
                     Conditions=[
                         {'Content-Type': file_type},
                         {'x-amz-server-side-encryption': 'aws:kms'},
-                        {'x-amz-server-side-encryption-aws-kms-key-id': 'arn:aws:kms:eu-west-2:252326958099:key/602a7058-adf6-48c5-80bf-39ea7956742f'},
+                        {'x-amz-server-side-encryption-aws-kms-key-id': DATASETS_KMS_KEY_ID},
                         ['starts-with', '$x-amz-meta-user-id', user_id],
                         ['starts-with', '$x-amz-meta-original-name', ''],
                         ['starts-with', '$x-amz-meta-file-id', ''],
@@ -388,7 +3096,10 @@ def handler(event, context):
                     }
                 
                 # Perform ingestion
-                result = ingest_csv_from_s3(s3_key, user_id, original_filename, dataset_id)
+                if body.get('mode') == 'append':
+                    result = append_csv_from_s3(s3_key, user_id, dataset_id)
+                else:
+                    result = ingest_csv_from_s3(s3_key, user_id, original_filename, dataset_id)
                 
                 if result['success']:
                     return {
@@ -411,13 +3122,141 @@ def handler(event, context):
                         })
                     }
             
+            elif action == 'enqueueIngest':
+                # Queue ingestion to run in the background and return immediately
+                job = {
+                    's3Key': body.get('s3Key'),
+                    'userId': body.get('userId'),
+                    'datasetId': body.get('datasetId'),
+                    'originalFilename': body.get('originalFilename')
+                }
+                
+                if not all(job.values()) or not conn:
+                    return {
+                        'statusCode': 400,
+                        'headers': cors_headers,
+                        'body': json.dumps({
+                            'error': 'Missing required parameters for ingestion or database connection'
+                        })
+                    }
+                
+                if not ingestion_queue_configured():
+                    # Checked before the dataset is marked queued, so it can't get stuck there
+                    print("enqueueIngest called without INGESTION_QUEUE_URL or INGESTION_LOCAL_QUEUE")
+                    return {
+                        'statusCode': 503,
+                        'headers': cors_headers,
+                        'body': json.dumps({
+                            'error': 'Background ingestion is not configured'
+                        })
+                    }
+                
+                cursor = conn.cursor()
+                if body.get('mode') == 'append':
+                    # Appends run against a completed dataset, which stays completed while they load
+                    job['mode'] = 'append'
+                    cursor.execute("""
+                        SELECT dataset_id FROM datasets
+                        WHERE dataset_id = %s AND user_id = %s AND ingestion_status = 'completed'
+                    """, (job['datasetId'], job['userId']))
+                    found = cursor.fetchone() is not None
+                    conn.commit()
+                    if not found:
+                        return {
+                            'statusCode': 409,
+                            'headers': cors_headers,
+                            'body': json.dumps({
+                                'error': 'Dataset not found or not completed ingestion'
+                            })
+                        }
+                    enqueue_ingestion_job(job)
+                    return {
+                        'statusCode': 202,
+                        'headers': cors_headers,
+                        'body': json.dumps({
+                            'message': 'CSV append queued',
+                            'datasetId': job['datasetId'],
+                            'status': 'completed'
+                        })
+                    }
+                
+                cursor.execute("""
+                    UPDATE datasets 
+                    SET ingestion_status = 'queued',
+                        rows_loaded = 0,
+                        bytes_read = 0,
+                        error_message = NULL
+                    WHERE dataset_id = %s AND user_id = %s
+                      AND (ingestion_status IN ('pending', 'failed')
+                           OR (ingestion_status = 'processing'
+                               AND progress_updated_at < CURRENT_TIMESTAMP - make_interval(secs => %s)))
+                    RETURNING dataset_id
+                """, (job['datasetId'], job['userId'], INGESTION_STALE_AFTER))
+                if cursor.fetchone() is None:
+                    conn.rollback()
+                    return {
+                        'statusCode': 409,
+                        'headers': cors_headers,
+                        'body': json.dumps({
+                            'error': 'Dataset not found or already queued, processing or completed'
+                        })
+                    }
+                conn.commit()
+                
+                enqueue_ingestion_job(job)
+                return {
+                    'statusCode': 202,
+                    'headers': cors_headers,
+                    'body': json.dumps({
+                        'message': 'CSV ingestion queued',
+                        'datasetId': job['datasetId'],
+                        'status': 'queued'
+                    })
+                }
+            
+            elif action == 'status':
+                # Poll ingestion progress for a dataset
+                dataset_id = body.get('datasetId')
+                
+                if not dataset_id or not conn:
+                    return {
+                        'statusCode': 400,
+                        'headers': cors_headers,
+                        'body': json.dumps({
+                            'error': 'Missing datasetId or database connection'
+                        })
+                    }
+                
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT dataset_id, ingestion_status, rows_loaded, bytes_read, file_size_bytes,
+                           ingestion_started_at, progress_updated_at, row_count, error_message,
+                           metadata->'append_progress'
+                    FROM datasets 
+                    WHERE dataset_id = %s
+                """, (dataset_id,))
+                row = cursor.fetchone()
+                
+                if not row:
+                    return {
+                        'statusCode': 404,
+                        'headers': cors_headers,
+                        'body': json.dumps({'error': 'Dataset not found'})
+                    }
+                
+                return {
+                    'statusCode': 200,
+                    'headers': cors_headers,
+                    'body': json.dumps(describe_ingestion_progress(row), default=json_serializer)
+                }
+            
             elif action == 'getData':
                 # Get data from a user's dataset table
                 print(f"getData action triggered")
                 dataset_id = body.get('datasetId')
                 table_name = body.get('tableName')
-                limit = body.get('limit', 1000)  # Default to 1000 rows
-                print(f"Parameters: dataset_id={dataset_id}, table_name={table_name}, limit={limit}")
+                page_token = body.get('cursor')
+                print(f"Parameters: dataset_id={dataset_id}, table_name={table_name}, limit={body.get('limit')}")
                 
                 if not dataset_id or not table_name or not conn:
                     return {
@@ -428,6 +3267,18 @@ def handler(event, context):
                         })
                     }
                 
+                try:
+                    limit = min(max(int(body.get('limit', 1000)), 1), GETDATA_MAX_PAGE_ROWS)  # Default to 1000 rows
+                    after_id = decode_page_token(page_token, table_name) if page_token else 0
+                except (ValueError, TypeError) as e:
+                    return {
+                        'statusCode': 400,
+                        'headers': cors_headers,
+                        'body': json.dumps({
+                            'error': f'Invalid limit or cursor: {e}'
+                        })
+                    }
+                
                 try:
                     cursor = conn.cursor()
                     print(f"Created cursor, about to verify dataset exists")
@@ -459,32 +3310,53 @@ def handler(event, context):
                     column_names = [col[0] for col in column_info if col[0] not in ['id', 'created_at']]
                     print(f"Filtered column names: {column_names}")
                     
-                    # Get the actual data (excluding id and created_at columns)
-                    columns_sql = ', '.join([f'"{col}"' for col in column_names])
-                    query = f'SELECT {columns_sql} FROM "{table_name}" LIMIT %s'
-                    print(f"About to execute data query: {query} with limit: {limit}")
-                    cursor.execute(query, (limit,))
+                    # Get the next page by keyset on id (id itself and created_at aren't returned);
+                    # one extra row tells us whether another page follows
+                    columns_sql = ', '.join(['id'] + [f'"{col}"' for col in column_names])
+                    query = f'SELECT {columns_sql} FROM "{table_name}" WHERE id > %s ORDER BY id LIMIT %s'
+                    print(f"About to execute data query: {query} after id {after_id} with limit: {limit}")
+                    page_cursor = conn.cursor(name=f'getdata_{uuid.uuid4().hex}')
+                    page_cursor.itersize = GETDATA_FETCH_BATCH
+                    page_cursor.execute(query, (after_id, limit + 1))
                     print(f"Data query executed successfully")
                     
-                    rows = cursor.fetchall()
-                    print(f"Fetched {len(rows) if rows else 0} rows from the table")
-                    
-                    # Convert to list format for JSON serialization
-                    data_rows = [list(row) for row in rows]
+                    # Pull the page from the server-side cursor in bounded batches
+                    page_rows = []
+                    last_id = after_id
+                    has_more = False
+                    while True:
+                        batch = page_cursor.fetchmany(GETDATA_FETCH_BATCH)
+                        if not batch:
+                            break
+                        for row in batch:
+                            if len(page_rows) == limit:
+                                has_more = True
+                                break
+                            last_id = row[0]
+                            page_rows.append(row[1:])
+                    description = page_cursor.description[1:]
+                    page_cursor.close()
+                    print(f"Fetched {len(page_rows)} rows from the table")
                     
                     response_data = {
                         'columns': column_names,
-                        'rows': data_rows,
                         'totalRows': dataset_info[2],  # row_count from dataset
-                        'returnedRows': len(data_rows)
+                        'returnedRows': len(page_rows),
+                        'hasMore': has_more,
+                        'nextCursor': encode_page_token(table_name, last_id) if has_more else None
                     }
-                    print(f"Returning successful response with {len(column_names)} columns and {len(data_rows)} rows")
+                    if wants_arrow(event, body):
+                        return arrow_response(build_arrow_table(column_names, page_rows, response_data), cors_headers)
                     
-                    return {
-                        'statusCode': 200,
-                        'headers': cors_headers,
-                        'body': json.dumps(response_data, default=json_serializer)
-                    }
+                    # Row lists by default, or {column: [values]} when the client asks for layout 'columns'
+                    columns = encode_result_columns(description, page_rows)
+                    if body.get('layout') == 'columns':
+                        response_data['data'] = dict(zip(column_names, columns))
+                    else:
+                        response_data['rows'] = [list(values) for values in zip(*columns)]
+                    print(f"Returning successful response with {len(column_names)} columns and {len(page_rows)} rows")
+                    
+                    return json_response(response_data, cors_headers, event)
                 
                 except Exception as e:
                     print(f"Error fetching dataset data: {e}")
@@ -503,10 +3375,13 @@ def handler(event, context):
                 dataset_id = body.get('datasetId')
                 table_name = body.get('tableName')
                 sql = body.get('sql')
-                limit = body.get('limit', 1000)  # Default to 1000 rows
-                print(f"Parameters: dataset_id={dataset_id}, table_name={table_name}, sql={sql[:100]}...")
+                try:
+                    limit = int(body.get('limit', 1000))  # Default to 1000 rows
+                except (TypeError, ValueError):
+                    limit = None
+                print(f"Parameters: dataset_id={dataset_id}, table_name={table_name}, sql={str(sql)[:100]}...")
                 
-                if not dataset_id or not table_name or not sql or not conn:
+                if not dataset_id or not table_name or not isinstance(sql, str) or not sql.strip() or not conn:
                     return {
                         'statusCode': 400,
                         'headers': cors_headers,
@@ -514,6 +3389,14 @@ def handler(event, context):
                             'error': 'Missing datasetId, tableName, sql, or database connection'
                         })
                     }
+                if limit is None or limit < 1:
+                    return {
+                        'statusCode': 400,
+                        'headers': cors_headers,
+                        'body': json.dumps({
+                            'error': 'limit must be a positive integer'
+                        })
+                    }
                 
                 try:
                     cursor = conn.cursor()
@@ -522,9 +3405,11 @@ def handler(event, context):
                     # First verify the dataset exists
                     print(f"Verifying dataset exists: {dataset_id}, {table_name}")
                     cursor.execute("""
-                        SELECT dataset_id, table_name, ingestion_status
-                        FROM datasets 
-                        WHERE dataset_id = %s AND table_name = %s AND ingestion_status = 'completed'
+                        SELECT d.dataset_id, d.table_name, d.ingestion_status, d.ingestion_date,
+                               up.query_cost_budget, up.query_row_budget, up.query_timeout_ms
+                        FROM datasets d
+                        LEFT JOIN user_profiles up ON up.user_id = d.user_id
+                        WHERE d.dataset_id = %s AND d.table_name = %s AND d.ingestion_status = 'completed'
                     """, (dataset_id, table_name))
                     
                     dataset_info = cursor.fetchone()
@@ -539,75 +3424,98 @@ def handler(event, context):
                             })
                         }
                     
-                    # Basic SQL safety checks
+                    # Parse the query once: one read-only SELECT over this table, LIMIT clamped structurally
                     print(f"Starting SQL safety checks")
-                    sql_lower = sql.lower().strip()
-                    # Allow SELECT queries and CTEs (Common Table Expressions) that start with WITH
-                    if not (sql_lower.startswith('select') or sql_lower.startswith('with')):
-                        print(f"SQL doesn't start with SELECT or WITH")
-                        return {
-                            'statusCode': 400,
-                            'headers': cors_headers,
-                            'body': json.dumps({
-                                'error': 'Only SELECT queries and CTEs (WITH) are allowed'
-                            })
-                        }
-                    
-                    # Check for dangerous operations
-                    dangerous_keywords = ['insert', 'update', 'delete', 'drop', 'alter', 'create', 'truncate', 'grant', 'revoke']
-                    found_dangerous = [kw for kw in dangerous_keywords if kw in sql_lower]
-                    if found_dangerous:
-                        print(f"Found dangerous keywords: {found_dangerous}")
+                    sql_error, sql = validate_select_sql(sql, table_name, limit)
+                    if sql_error:
+                        print(f"SQL rejected: {sql_error}")
                         return {
                             'statusCode': 400,
                             'headers': cors_headers,
                             'body': json.dumps({
-                                'error': 'Query contains forbidden operations'
+                                'error': sql_error
                             })
                         }
                     
-                    # Add LIMIT if not present (safety measure)
-                    if 'limit' not in sql_lower:
-                        sql = f"{sql} LIMIT {limit}"
-                        print(f"Added LIMIT to SQL")
-                    
-                    print(f"About to execute SQL: {sql[:200]}...")  # Log first 200 chars
-                    print(f"SQL safety checks passed, executing query")
-                    cursor.execute(sql)
-                    print(f"SQL execution completed, fetching results")
-                    
-                    rows = cursor.fetchall()
-                    print(f"Fetched {len(rows) if rows else 0} rows from SQL execution")
-                    
-                    # Get column names from cursor description
-                    column_names = [desc[0] for desc in cursor.description] if cursor.description else []
-                    print(f"Column names from cursor: {column_names}")
+                    # Datasets don't change after ingestion, so a repeated query is answered from the
+                    # chart's snapshot or the cache. Arrow responses keep native types and always run it.
+                    arrow = wants_arrow(event, body)
+                    cache_key = result_cache_key(dataset_id, dataset_info[3], sql, limit)
+                    cached, cache_tier = None, None
+                    admission = None
+                    if body.get('generationId') and not arrow:
+                        cached = find_snapshot_result(conn, body['generationId'], dataset_id, sql)
+                        cache_tier = 'snapshot' if cached else None
+                    if not cached and not arrow:
+                        cached, cache_tier = get_cached_result(conn, cache_key)
+                    if cached:
+                        print(f"Serving SQL result from the {cache_tier} cache")
+                        column_names, columns = cached['columns'], cached['values']
+                    else:
+                        # Admission control: EXPLAIN against the dataset owner's budgets, then run with a timeout
+                        decision, admitted_sql, estimate = admit_query(
+                            cursor, sql, query_budgets(*dataset_info[4:7]),
+                            {'source': 'executeSQL', 'dataset_id': dataset_id}
+                        )
+                        admission = {'decision': decision, 'estimatedCost': estimate['cost'], 'estimatedRows': estimate['rows']}
+                        if decision == 'rejected':
+                            return {
+                                'statusCode': 422,
+                                'headers': cors_headers,
+                                'body': json.dumps({
+                                    'error': 'Query is too expensive to run; aggregate or filter it further',
+                                    'admission': admission
+                                })
+                            }
+                        
+                        print(f"About to execute SQL: {admitted_sql[:200]}...")  # Log first 200 chars
+                        print(f"SQL safety checks passed, executing query")
+                        cursor.execute(admitted_sql)
+                        print(f"SQL execution completed, fetching results")
+                        
+                        rows = cursor.fetchall()
+                        print(f"Fetched {len(rows) if rows else 0} rows from SQL execution")
+                        
+                        # Get column names from cursor description
+                        column_names = [desc[0] for desc in cursor.description] if cursor.description else []
+                        print(f"Column names from cursor: {column_names}")
+                        
+                        # Columnar clients get the rows as-is, without per-row dicts
+                        if arrow:
+                            metadata = {'columns': column_names, 'returnedRows': len(rows), 'sql': sql}
+                            return arrow_response(build_arrow_table(column_names, rows, metadata), cors_headers)
+                        
+                        columns = encode_result_columns(cursor.description or [], rows)
+                        store_cached_result(conn, cache_key, dataset_id, {'columns': column_names, 'values': columns})
                     
-                    # Transform to objects ready for chart consumption
-                    print(f"Starting data transformation to objects")
-                    data_objects = [dict(zip(column_names, row)) for row in rows]
-                    print(f"Data transformation completed, created {len(data_objects)} objects")
+                    returned_rows = len(columns[0]) if columns else 0
                     
                     response_data = {
-                        'data': data_objects,  # Ready-to-use objects for charts
+                        'data': result_data(column_names, columns, body.get('layout')),
                         'columns': column_names,  # Keep for debugging/metadata
-                        'rows': data_objects,  # Alias for backwards compatibility during transition
-                        'returnedRows': len(data_objects),
-                        'sql': sql
+                        'returnedRows': returned_rows,
+                        'sql': sql,
+                        'cached': cache_tier is not None,
+                        'admission': admission
                     }
-                    print(f"Response data structure created, about to return")
-                    print(f"SQL executed successfully, returning {len(data_objects)} rows with columns: {column_names}")
+                    print(f"SQL executed successfully, returning {returned_rows} rows with columns: {column_names}")
                     
-                    return {
-                        'statusCode': 200,
-                        'headers': cors_headers,
-                        'body': json.dumps(response_data, default=json_serializer)
-                    }
+                    return json_response(response_data, cors_headers, event)
                 
                 except psycopg2.Error as e:
                     print(f"PostgreSQL error executing SQL: {e}")
                     print(f"Error code: {e.pgcode}")
                     print(f"Error sqlstate: {e.sqlstate if hasattr(e, 'sqlstate') else 'N/A'}")
+                    if e.pgcode == '57014':
+                        # statement_timeout set by admit_query
+                        return {
+                            'statusCode': 408,
+                            'headers': cors_headers,
+                            'body': json.dumps({
+                                'error': 'Query exceeded its time limit; aggregate or filter it further',
+                                'pgcode': e.pgcode
+                            })
+                        }
                     return {
                         'statusCode': 500,
                         'headers': cors_headers,
@@ -632,9 +3540,62 @@ def handler(event, context):
                         })
                     }
         
+            elif action in ('getChartData', 'materializeChart'):
+                # Saved charts read from their materialized snapshots; a dashboard is one request
+                generation_ids = body.get('generationIds') or ([body['generationId']] if body.get('generationId') else [])
+                if not generation_ids or len(generation_ids) > CHART_BATCH_MAX or not conn:
+                    return {
+                        'statusCode': 400,
+                        'headers': cors_headers,
+                        'body': json.dumps({
+                            'error': f'Provide between 1 and {CHART_BATCH_MAX} generationIds'
+                        })
+                    }
+                
+                try:
+                    limit = int(body.get('limit', 1000))
+                    charts, errors = load_chart_snapshots(
+                        conn, generation_ids, limit, refresh=action == 'materializeChart'
+                    )
+                except (psycopg2.Error, ValueError, TypeError) as e:
+                    print(f"Error loading chart snapshots: {e}")
+                    return {
+                        'statusCode': 500,
+                        'headers': cors_headers,
+                        'body': json.dumps({
+                            'error': 'Failed to load chart data',
+                            'details': str(e)
+                        })
+                    }
+                
+                for chart in charts.values():
+                    for result in chart['queries'].values():
+                        columns = result.pop('values')
+                        result['data'] = result_data(result['columns'], columns, body.get('layout'))
+                        result['returnedRows'] = len(columns[0]) if columns else 0
+                print(f"Returning {len(charts)} charts ({sum(c['refreshed'] for c in charts.values())} refreshed), {len(errors)} errors")
+                return json_response({'charts': charts, 'errors': errors}, cors_headers, event)
+        
+            elif action == 'health':
+                # Diagnostic checks run once per container; pass refresh to re-run them
+                health = run_health_checks(refresh=bool(body.get('refresh')))
+                return {
+                    'statusCode': 200 if health['status'] == 'ok' else 503,
+                    'headers': cors_headers,
+                    'body': json.dumps(dict(health, pool=get_pool_metrics()))
+                }
+            
+            elif action == 'metrics':
+                # Connection pool and result cache counters for this warm container
+                return {
+                    'statusCode': 200,
+                    'headers': cors_headers,
+                    'body': json.dumps({'pool': get_pool_metrics(), 'resultCache': get_result_cache_metrics()})
+                }
+        
         elif http_method == 'GET':
-            # Get user's datasets
-            user_id = event['queryStringParameters'].get('userId') if event.get('queryStringParameters') else None
+            # Get user's datasets, newest first, one keyset page at a time
+            user_id = query_params.get('userId')
             
             if not user_id or not conn:
                 return {
@@ -643,27 +3604,59 @@ def handler(event, context):
                     'body': json.dumps({'error': 'Missing userId or database connection'})
                 }
             
+            try:
+                list_limit = min(max(int(query_params.get('limit', DATASET_LIST_PAGE_SIZE)), 1), DATASET_LIST_MAX_PAGE_SIZE)
+            except ValueError:
+                list_limit = DATASET_LIST_PAGE_SIZE
+            try:
+                after = decode_dataset_list_token(query_params['cursor']) if query_params.get('cursor') else None
+            except ValueError as e:
+                return {
+                    'statusCode': 400,
+                    'headers': cors_headers,
+                    'body': json.dumps({'error': str(e)})
+                }
+            
+            # An unchanged page is answered from the user's list version alone
             cursor = conn.cursor()
+            list_etag = dataset_list_etag(cursor, user_id, query_params.get('cursor'), list_limit)
+            if list_etag and etag_matches(request_header(event, 'if-none-match'), list_etag):
+                return {
+                    'statusCode': 304,
+                    'headers': {**cors_headers, 'ETag': list_etag, 'Access-Control-Expose-Headers': 'ETag'},
+                    'body': ''
+                }
+            
+            # Served by an index-only scan of idx_datasets_user_listing; one extra row tells us whether another page follows
             cursor.execute("""
                 SELECT dataset_id, original_filename, row_count, column_count, 
                        upload_date, ingestion_status, table_name
                 FROM datasets 
                 WHERE user_id = %s
-                ORDER BY upload_date DESC
-            """, (user_id,))
+                  AND (%s::timestamptz IS NULL OR (upload_date, dataset_id) < (%s::timestamptz, %s::uuid))
+                ORDER BY upload_date DESC, dataset_id DESC
+                LIMIT %s
+            """, (user_id, after and after[0], after and after[0], after and after[1], list_limit + 1))
             
             datasets = cursor.fetchall()
+            has_more = len(datasets) > list_limit
+            datasets = datasets[:list_limit]
             
             # Convert tuples to dictionaries
             column_names = ['dataset_id', 'original_filename', 'row_count', 'column_count', 
                            'upload_date', 'ingestion_status', 'table_name']
             datasets_dict = [dict(zip(column_names, row)) for row in datasets]
             
+            headers = dict(cors_headers)
+            if list_etag:
+                headers.update({'ETag': list_etag, 'Cache-Control': 'private, no-cache', 'Access-Control-Expose-Headers': 'ETag'})
             return {
                 'statusCode': 200,
-                'headers': cors_headers,
+                'headers': headers,
                 'body': json.dumps({
-                    'datasets': datasets_dict
+                    'datasets': datasets_dict,
+                    'hasMore': has_more,
+                    'nextCursor': encode_dataset_list_token(datasets[-1][4], datasets[-1][0]) if has_more else None
                 }, default=json_serializer)
             }
         
@@ -694,5 +3687,4 @@ def handler(event, context):
             })
         }
     finally:
-        if conn:
-            conn.close()
\ No newline at end of file
+        release_db_connection(conn)
\ No newline at end of file
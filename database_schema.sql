@@ -11,7 +11,12 @@ CREATE TABLE user_profiles (
     email VARCHAR(255) UNIQUE NOT NULL,
     display_name VARCHAR(255),
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    -- executeSQL admission budgets; NULL uses the datasets Lambda defaults
+    query_cost_budget DOUBLE PRECISION, -- max planner cost before a query is rejected
+    query_row_budget INTEGER, -- estimated result rows before the result is clamped
+    query_timeout_ms INTEGER, -- statement_timeout for each query
+    dataset_list_version BIGINT NOT NULL DEFAULT 0 -- bumped by a trigger whenever a listed dataset changes; ETag source
 );
 
 -- Dataset Metadata - tracks each CSV file uploaded
@@ -23,12 +28,20 @@ CREATE TABLE datasets (
     file_size_bytes BIGINT,
     row_count INTEGER,
     column_count INTEGER,
-    table_name VARCHAR(255) NOT NULL, -- dynamically generated table name for this dataset
+    table_name VARCHAR(255) NOT NULL, -- ds_<dataset_id hex>, set at upload time; shared by deduplicated datasets
     upload_date TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-    ingestion_status VARCHAR(50) DEFAULT 'pending', -- pending, processing, completed, failed
+    ingestion_status VARCHAR(50) DEFAULT 'pending', -- pending, queued, processing, completed, failed
     ingestion_date TIMESTAMP WITH TIME ZONE,
     error_message TEXT,
-    metadata JSONB -- store column names, types, sample data, etc.
+    metadata JSONB, -- store column names, types, sample data, etc.
+    -- Background ingestion progress
+    rows_loaded BIGINT DEFAULT 0, -- rows copied into the dataset table so far
+    bytes_read BIGINT DEFAULT 0, -- bytes of the CSV parsed so far
+    ingestion_started_at TIMESTAMP WITH TIME ZONE,
+    progress_updated_at TIMESTAMP WITH TIME ZONE,
+    -- Content-hash deduplication
+    content_hash CHAR(64), -- SHA-256 of the ingested file; cleared once rows are appended
+    source_dataset_id UUID -- identical dataset whose table this one shares until it changes
 );
 
 -- Column Metadata - tracks each column in each dataset
@@ -80,7 +93,12 @@ CREATE TABLE chart_generations (
     sql_fields JSONB, -- Fields returned by SQL query (for field mapping validation)
     spec_fields JSONB, -- Fields expected by VChart spec (for field mapping validation) 
     fields_compatible BOOLEAN, -- Whether SQL fields match spec fields exactly
-    dynamic_fetch_ready BOOLEAN DEFAULT false -- Whether this chart is ready for dynamic data fetching
+    dynamic_fetch_ready BOOLEAN DEFAULT false, -- Whether this chart is ready for dynamic data fetching
+    -- Materialized chart data, served by getChartData instead of re-running the SQL
+    data_mapping JSONB, -- the spec's dataMapping: sql/target, or queries keyed by name
+    result_snapshot JSONB, -- query results keyed like data_mapping: columns, column-major values, sql
+    snapshot_ingestion_date TIMESTAMP WITH TIME ZONE, -- datasets.ingestion_date the snapshot was taken against
+    snapshot_refreshed_at TIMESTAMP WITH TIME ZONE
 );
 
 -- VMind-inspired table for chart generation attempts (including failures for learning)
@@ -115,14 +133,31 @@ CREATE TABLE chart_knowledge (
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Shared executeSQL result cache (datasets Lambda); keys include the dataset's ingestion_date
+CREATE TABLE query_result_cache (
+    cache_key CHAR(64) PRIMARY KEY, -- sha256 of dataset, ingestion version, limit and normalized SQL
+    dataset_id UUID NOT NULL REFERENCES datasets(dataset_id) ON DELETE CASCADE,
+    result TEXT NOT NULL, -- JSON: column names and column-major values
+    size_bytes INTEGER NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    last_hit_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP, -- drives size-based eviction
+    hit_count INTEGER DEFAULT 0
+);
+
 -- Indexes for performance
 CREATE INDEX idx_user_profiles_email ON user_profiles(email);
-CREATE INDEX idx_datasets_user_id ON datasets(user_id);
-CREATE INDEX idx_datasets_upload_date ON datasets(upload_date DESC);
+-- Covers the per-user dataset listing (keyset on upload_date, dataset_id) with an index-only scan
+CREATE INDEX idx_datasets_user_listing ON datasets(user_id, upload_date DESC, dataset_id DESC)
+    INCLUDE (original_filename, row_count, column_count, ingestion_status, table_name);
+-- Deduplicated datasets share their source's table, so only table owners are unique
+CREATE UNIQUE INDEX idx_datasets_table_name ON datasets(table_name) WHERE source_dataset_id IS NULL;
+CREATE INDEX idx_datasets_content_hash ON datasets(content_hash) WHERE content_hash IS NOT NULL;
 CREATE INDEX idx_dataset_columns_dataset_id ON dataset_columns(dataset_id);
 CREATE INDEX idx_chart_generations_user_id ON chart_generations(user_id);
 CREATE INDEX idx_chart_generations_dataset_id ON chart_generations(dataset_id);
 CREATE INDEX idx_chart_generations_date ON chart_generations(generation_date DESC);
+CREATE INDEX idx_query_result_cache_dataset_id ON query_result_cache(dataset_id);
+CREATE INDEX idx_query_result_cache_last_hit ON query_result_cache(last_hit_at DESC);
 
 -- VMind enhancement indexes
 CREATE INDEX idx_chart_generation_attempts_generation_id ON chart_generation_attempts(generation_id);
@@ -133,37 +168,16 @@ CREATE INDEX idx_chart_knowledge_category ON chart_knowledge(knowledge_category)
 CREATE INDEX idx_dataset_columns_field_role ON dataset_columns(field_role);
 CREATE INDEX idx_dataset_columns_semantic_type ON dataset_columns(semantic_type);
 
--- Function to generate unique table names for datasets
-CREATE OR REPLACE FUNCTION generate_dataset_table_name(user_uuid VARCHAR, original_name VARCHAR)
+-- Table name for a dataset, derived from its id so it is unique without a lookup.
+-- The datasets Lambda computes the same name at upload time (dataset_table_name).
+CREATE OR REPLACE FUNCTION generate_dataset_table_name(p_dataset_id UUID)
 RETURNS VARCHAR AS $$
-DECLARE
-    clean_name VARCHAR;
-    table_name VARCHAR;
-    counter INTEGER := 0;
-    final_name VARCHAR;
-BEGIN
-    clean_name := regexp_replace(lower(original_name), '[^a-z0-9_]', '_', 'g');
-    clean_name := regexp_replace(clean_name, '_+', '_', 'g');
-    clean_name := trim(both '_' from clean_name);
-    clean_name := regexp_replace(clean_name, '\.(csv|txt)$', '', 'i');
-    
-    clean_name := left(clean_name, 20);
-    
-    table_name := 'user_' || replace(user_uuid, '-', '_') || '_' || clean_name;
-    
-    final_name := table_name;
-    WHILE EXISTS (
-        SELECT 1 FROM datasets WHERE datasets.table_name = final_name
-    ) LOOP
-        counter := counter + 1;
-        final_name := table_name || '_' || counter::text;
-    END LOOP;
-    
-    RETURN final_name;
-END;
-$$ LANGUAGE plpgsql;
+    SELECT 'ds_' || replace(p_dataset_id::text, '-', '');
+$$ LANGUAGE sql IMMUTABLE;
 
 -- VMind-inspired function to calculate field statistics and roles
+-- All columns are profiled in a single scan of the dataset table. Distinct counts use
+-- HyperLogLog when the hll extension is installed, and MIN/MAX compare typed values.
 CREATE OR REPLACE FUNCTION analyze_field_characteristics(
     p_dataset_id UUID,
     p_table_name VARCHAR
@@ -178,41 +192,73 @@ CREATE OR REPLACE FUNCTION analyze_field_characteristics(
 DECLARE
     col_record RECORD;
     total_rows INTEGER;
+    use_hll BOOLEAN;
+    aggregates_sql TEXT;
+    values_sql TEXT;
     sql_query TEXT;
     stats_result RECORD;
 BEGIN
-    -- Get total row count
-    EXECUTE format('SELECT COUNT(*) FROM %I', p_table_name) INTO total_rows;
+    use_hll := EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'hll');
     
-    -- Loop through each column in the dataset
-    FOR col_record IN 
-        SELECT dc.column_name, dc.data_type, dc.postgres_type, dc.unique_count
-        FROM dataset_columns dc 
-        WHERE dc.dataset_id = p_dataset_id 
-        ORDER BY dc.column_index
+    -- Build one aggregate per statistic per column, named after the column position
+    SELECT
+        string_agg(format(
+            '%s AS d%s, COUNT(%I) AS n%s, %s AS mn%s, %s AS mx%s',
+            CASE WHEN use_hll
+                THEN format('hll_cardinality(hll_add_agg(hll_hash_any(%I)))::BIGINT', dc.safe_name)
+                ELSE format('COUNT(DISTINCT %I)', dc.safe_name)
+            END, dc.column_index,
+            dc.safe_name, dc.column_index,
+            CASE WHEN upper(dc.postgres_type) = 'BOOLEAN'
+                THEN format('bool_and(%I)::TEXT', dc.safe_name)
+                ELSE format('MIN(%I)::TEXT', dc.safe_name)
+            END, dc.column_index,
+            CASE WHEN upper(dc.postgres_type) = 'BOOLEAN'
+                THEN format('bool_or(%I)::TEXT', dc.safe_name)
+                ELSE format('MAX(%I)::TEXT', dc.safe_name)
+            END, dc.column_index
+        ), ', ' ORDER BY dc.column_index),
+        string_agg(format(
+            '(%L, %L, %L, %s::INTEGER, s.d%s, s.n%s, s.mn%s, s.mx%s)',
+            dc.column_name, dc.data_type, dc.postgres_type, dc.column_index,
+            dc.column_index, dc.column_index, dc.column_index, dc.column_index
+        ), ', ' ORDER BY dc.column_index)
+    INTO aggregates_sql, values_sql
+    FROM (
+        SELECT dc.*,
+               -- Same cleaning the datasets Lambda applies to CSV headers
+               regexp_replace(lower(replace(replace(dc.column_name, ' ', '_'), '-', '_')), '[^[:alnum:]_]', '', 'g') AS safe_name
+        FROM dataset_columns dc
+        WHERE dc.dataset_id = p_dataset_id
+    ) dc;
+    
+    IF aggregates_sql IS NULL THEN
+        RETURN;
+    END IF;
+    
+    sql_query := format('
+        SELECT v.*, s.total_count
+        FROM (SELECT COUNT(*) AS total_count, %s FROM %I) s
+        CROSS JOIN LATERAL (VALUES %s) AS v(column_name, data_type, postgres_type, column_index,
+                                             distinct_count, non_null_count, min_val, max_val)
+        ORDER BY v.column_index
+    ', aggregates_sql, p_table_name, values_sql);
+    
+    FOR stats_result IN EXECUTE sql_query
     LOOP
-        -- Build dynamic query to get column statistics
-        sql_query := format('
-            SELECT 
-                COUNT(DISTINCT %I) as distinct_count,
-                COUNT(%I) as non_null_count,
-                COUNT(*) as total_count,
-                (COUNT(*) - COUNT(%I))::FLOAT / COUNT(*) * 100 as null_pct,
-                MIN(%I::TEXT) as min_val,
-                MAX(%I::TEXT) as max_val
-            FROM %I
-        ', col_record.column_name, col_record.column_name, col_record.column_name, 
-           col_record.column_name, col_record.column_name, p_table_name);
-        
-        EXECUTE sql_query INTO stats_result;
+        total_rows := stats_result.total_count;
+        col_record := stats_result;
         
         -- Calculate cardinality ratio
-        column_name := col_record.column_name;
+        column_name := stats_result.column_name;
         cardinality_ratio := CASE 
             WHEN total_rows > 0 THEN stats_result.distinct_count::DECIMAL / total_rows 
             ELSE 0 
         END;
-        null_percentage := stats_result.null_pct;
+        null_percentage := CASE
+            WHEN total_rows > 0 THEN (total_rows - stats_result.non_null_count)::DECIMAL / total_rows * 100
+            ELSE 0
+        END;
         
         -- Determine field role based on data characteristics
         suggested_field_role := CASE 
@@ -222,7 +268,7 @@ BEGIN
             -- Dimension detection (categorical data)
             WHEN col_record.data_type IN ('TEXT') AND cardinality_ratio < 0.5 THEN 'dimension'
             WHEN col_record.data_type IN ('DATE') THEN 'dimension'
-            WHEN col_record.postgres_type = 'boolean' THEN 'dimension'
+            WHEN upper(col_record.postgres_type) = 'BOOLEAN' THEN 'dimension'
             WHEN col_record.data_type IN ('TEXT') AND stats_result.distinct_count <= 50 THEN 'dimension'
             
             -- Measure detection (numerical data suitable for aggregation)
@@ -236,16 +282,17 @@ BEGIN
         suggested_semantic_type := CASE
             WHEN col_record.data_type IN ('TEXT') AND cardinality_ratio < 0.2 THEN 'categorical'
             WHEN col_record.data_type IN ('INTEGER', 'DECIMAL', 'FLOAT', 'NUMERIC') THEN 'numerical'
-            WHEN col_record.data_type = 'DATE' OR col_record.postgres_type LIKE '%timestamp%' THEN 'temporal'
-            WHEN col_record.postgres_type = 'boolean' THEN 'boolean'
+            WHEN col_record.data_type = 'DATE' OR lower(col_record.postgres_type) LIKE '%timestamp%' THEN 'temporal'
+            WHEN upper(col_record.postgres_type) = 'BOOLEAN' THEN 'boolean'
             ELSE 'text'
         END;
         
         -- Build field statistics JSON
         field_statistics := json_build_object(
             'distinct_count', stats_result.distinct_count,
+            'distinct_count_method', CASE WHEN use_hll THEN 'hll' ELSE 'exact' END,
             'non_null_count', stats_result.non_null_count,
-            'null_percentage', stats_result.null_pct,
+            'null_percentage', null_percentage,
             'min_value', stats_result.min_val,
             'max_value', stats_result.max_val,
             'data_type', col_record.data_type,
@@ -264,29 +311,51 @@ $$ LANGUAGE plpgsql;
 -- VMind-inspired function to update field analysis for a dataset
 CREATE OR REPLACE FUNCTION update_field_analysis(p_dataset_id UUID, p_table_name VARCHAR)
 RETURNS VOID AS $$
-DECLARE
-    field_record RECORD;
 BEGIN
-    -- Update field characteristics for all columns in the dataset
-    FOR field_record IN 
-        SELECT * FROM analyze_field_characteristics(p_dataset_id, p_table_name)
-    LOOP
-        UPDATE dataset_columns 
-        SET 
-            field_role = field_record.suggested_field_role,
-            semantic_type = field_record.suggested_semantic_type,
-            cardinality_ratio = field_record.cardinality_ratio,
-            contains_nulls_pct = field_record.null_percentage,
-            field_stats = field_record.field_statistics,
-            updated_at = CURRENT_TIMESTAMP
-        WHERE dataset_id = p_dataset_id 
-        AND column_name = field_record.column_name;
-    END LOOP;
+    -- Update field characteristics for all columns in the dataset with one statement
+    UPDATE dataset_columns dc
+    SET 
+        field_role = fa.suggested_field_role,
+        semantic_type = fa.suggested_semantic_type,
+        cardinality_ratio = fa.cardinality_ratio,
+        contains_nulls_pct = fa.null_percentage,
+        unique_count = (fa.field_statistics->>'distinct_count')::INTEGER,
+        min_value = fa.field_statistics->>'min_value',
+        max_value = fa.field_statistics->>'max_value',
+        field_stats = fa.field_statistics,
+        updated_at = CURRENT_TIMESTAMP
+    FROM analyze_field_characteristics(p_dataset_id, p_table_name) fa
+    WHERE dc.dataset_id = p_dataset_id 
+    AND dc.column_name = fa.column_name;
     
     RAISE NOTICE 'Field analysis updated for dataset %', p_dataset_id;
 END;
 $$ LANGUAGE plpgsql;
 
+-- Bump the owner's dataset_list_version when a dataset is added, removed, or changes a listed
+-- column. Runs in the same transaction as the change, so a listing ETag can't outlive it.
+CREATE OR REPLACE FUNCTION bump_dataset_list_version()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE user_profiles SET dataset_list_version = dataset_list_version + 1 WHERE user_id = NEW.user_id;
+    ELSIF TG_OP = 'DELETE' THEN
+        UPDATE user_profiles SET dataset_list_version = dataset_list_version + 1 WHERE user_id = OLD.user_id;
+    ELSIF (OLD.user_id, OLD.original_filename, OLD.row_count, OLD.column_count,
+           OLD.upload_date, OLD.ingestion_status, OLD.table_name)
+        IS DISTINCT FROM (NEW.user_id, NEW.original_filename, NEW.row_count, NEW.column_count,
+                          NEW.upload_date, NEW.ingestion_status, NEW.table_name) THEN
+        UPDATE user_profiles SET dataset_list_version = dataset_list_version + 1
+        WHERE user_id IN (OLD.user_id, NEW.user_id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_datasets_list_version
+    AFTER INSERT OR DELETE OR UPDATE ON datasets
+    FOR EACH ROW EXECUTE FUNCTION bump_dataset_list_version();
+
 -- Insert standard pie chart knowledge base
 INSERT INTO chart_knowledge (chart_type, knowledge_category, name, description, data_requirements, vchart_template, sample_data, use_cases, priority_score)
 VALUES 
@@ -405,5 +474,6 @@ COMMENT ON TABLE dataset_columns IS 'Schema information for each column in uploa
 COMMENT ON TABLE chart_generations IS 'History of chart generation requests and results with VMind-inspired learning capabilities';
 COMMENT ON TABLE chart_generation_attempts IS 'Tracks all steps in chart generation workflow including failures for learning and debugging';
 COMMENT ON TABLE chart_knowledge IS 'Stores chart templates, examples, and rules for consistent chart generation';
-COMMENT ON FUNCTION analyze_field_characteristics IS 'Analyzes dataset columns to determine field roles and characteristics for intelligent chart generation';
-COMMENT ON FUNCTION update_field_analysis IS 'Updates field analysis for all columns in a dataset, should be called after data ingestion';
\ No newline at end of file
+COMMENT ON FUNCTION analyze_field_characteristics IS 'Analyzes dataset columns in a single table scan to determine field roles and characteristics for intelligent chart generation';
+COMMENT ON FUNCTION bump_dataset_list_version IS 'Trigger function keeping user_profiles.dataset_list_version in step with the datasets a user lists';
+COMMENT ON FUNCTION update_field_analysis IS 'Recomputes field analysis for all columns in a dataset with one bulk UPDATE; ingestion already fills these fields, so this is only needed to refresh them';
\ No newline at end of file
@@ -0,0 +1,14 @@
+-- Migration: Background ingestion with progress tracking
+-- Ingestion can now run from a queue worker. These columns let the status action report
+-- rows loaded, bytes read and an ETA while a dataset is being ingested.
+
+ALTER TABLE datasets ADD COLUMN IF NOT EXISTS rows_loaded BIGINT DEFAULT 0;
+ALTER TABLE datasets ADD COLUMN IF NOT EXISTS bytes_read BIGINT DEFAULT 0;
+ALTER TABLE datasets ADD COLUMN IF NOT EXISTS ingestion_started_at TIMESTAMP WITH TIME ZONE;
+ALTER TABLE datasets ADD COLUMN IF NOT EXISTS progress_updated_at TIMESTAMP WITH TIME ZONE;
+
+COMMENT ON COLUMN datasets.ingestion_status IS 'pending, queued, processing, completed or failed';
+COMMENT ON COLUMN datasets.rows_loaded IS 'Rows copied into the dataset table so far';
+COMMENT ON COLUMN datasets.bytes_read IS 'Bytes of the uploaded CSV parsed so far';
+COMMENT ON COLUMN datasets.ingestion_started_at IS 'When the current ingestion run started';
+COMMENT ON COLUMN datasets.progress_updated_at IS 'When rows_loaded/bytes_read were last written';
@@ -0,0 +1,14 @@
+-- Migration: Materialized chart data snapshots
+-- Saved charts keep their aggregated query results so a dashboard loads with one getChartData
+-- read instead of re-running every chart's SQL. A snapshot is recomputed only when the dataset's
+-- ingestion_date no longer matches the one it was taken against.
+
+ALTER TABLE chart_generations ADD COLUMN IF NOT EXISTS data_mapping JSONB;
+ALTER TABLE chart_generations ADD COLUMN IF NOT EXISTS result_snapshot JSONB;
+ALTER TABLE chart_generations ADD COLUMN IF NOT EXISTS snapshot_ingestion_date TIMESTAMP WITH TIME ZONE;
+ALTER TABLE chart_generations ADD COLUMN IF NOT EXISTS snapshot_refreshed_at TIMESTAMP WITH TIME ZONE;
+
+COMMENT ON COLUMN chart_generations.data_mapping IS 'The spec dataMapping: sql/target, or queries keyed by name';
+COMMENT ON COLUMN chart_generations.result_snapshot IS 'Materialized query results keyed like data_mapping';
+COMMENT ON COLUMN chart_generations.snapshot_ingestion_date IS 'datasets.ingestion_date the snapshot was computed against';
+COMMENT ON COLUMN chart_generations.snapshot_refreshed_at IS 'When result_snapshot was last recomputed';
@@ -0,0 +1,17 @@
+-- Migration: Content-hash deduplication of uploaded CSVs
+-- Ingestion records the SHA-256 of each file it loads. An upload of a file the user (or, with
+-- DEDUP_ACROSS_USERS, anyone) has already ingested gets a dataset record that shares the
+-- existing table instead of loading it again; the table is copied the first time such a
+-- dataset changes. Shared tables appear under several datasets, so table_name is now only
+-- unique among datasets that own their table.
+
+ALTER TABLE datasets ADD COLUMN IF NOT EXISTS content_hash CHAR(64);
+ALTER TABLE datasets ADD COLUMN IF NOT EXISTS source_dataset_id UUID;
+
+DROP INDEX IF EXISTS idx_datasets_table_name;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_datasets_table_name ON datasets(table_name) WHERE source_dataset_id IS NULL;
+CREATE INDEX IF NOT EXISTS idx_datasets_content_hash ON datasets(content_hash) WHERE content_hash IS NOT NULL;
+
+COMMENT ON COLUMN datasets.table_name IS 'Table holding the dataset rows: ds_<dataset_id hex>, set at upload time; shared by deduplicated datasets';
+COMMENT ON COLUMN datasets.content_hash IS 'SHA-256 of the ingested file; cleared once rows are appended';
+COMMENT ON COLUMN datasets.source_dataset_id IS 'Identical dataset whose table this one shares until it changes';
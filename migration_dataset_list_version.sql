@@ -0,0 +1,34 @@
+-- Migration: Dataset list version counter
+-- Dataset listing ETags were derived from a version marker object in S3, which cost a HEAD on
+-- every listing and served stale 304s whenever a bump failed. The version is now a counter on
+-- user_profiles that a trigger on datasets bumps in the same transaction as the change.
+
+ALTER TABLE user_profiles ADD COLUMN IF NOT EXISTS dataset_list_version BIGINT NOT NULL DEFAULT 0;
+
+-- Bump the owner's dataset_list_version when a dataset is added, removed, or changes a listed
+-- column. Runs in the same transaction as the change, so a listing ETag can't outlive it.
+CREATE OR REPLACE FUNCTION bump_dataset_list_version()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE user_profiles SET dataset_list_version = dataset_list_version + 1 WHERE user_id = NEW.user_id;
+    ELSIF TG_OP = 'DELETE' THEN
+        UPDATE user_profiles SET dataset_list_version = dataset_list_version + 1 WHERE user_id = OLD.user_id;
+    ELSIF (OLD.user_id, OLD.original_filename, OLD.row_count, OLD.column_count,
+           OLD.upload_date, OLD.ingestion_status, OLD.table_name)
+        IS DISTINCT FROM (NEW.user_id, NEW.original_filename, NEW.row_count, NEW.column_count,
+                          NEW.upload_date, NEW.ingestion_status, NEW.table_name) THEN
+        UPDATE user_profiles SET dataset_list_version = dataset_list_version + 1
+        WHERE user_id IN (OLD.user_id, NEW.user_id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_datasets_list_version ON datasets;
+CREATE TRIGGER trg_datasets_list_version
+    AFTER INSERT OR DELETE OR UPDATE ON datasets
+    FOR EACH ROW EXECUTE FUNCTION bump_dataset_list_version();
+
+COMMENT ON COLUMN user_profiles.dataset_list_version IS 'Bumped whenever one of the user''s listed datasets changes; the dataset listing ETag is derived from it';
+COMMENT ON FUNCTION bump_dataset_list_version IS 'Trigger function keeping user_profiles.dataset_list_version in step with the datasets a user lists';
@@ -0,0 +1,11 @@
+-- Migration: Paginated dataset listing
+-- The datasets GET now returns one keyset page at a time, newest first. A single composite
+-- index on (user_id, upload_date DESC, dataset_id DESC) that INCLUDEs the listed columns serves
+-- each page with an index-only scan. It replaces the separate user_id and upload_date indexes;
+-- the user_id prefix still serves lookups and cascades by user.
+
+CREATE INDEX IF NOT EXISTS idx_datasets_user_listing ON datasets(user_id, upload_date DESC, dataset_id DESC)
+    INCLUDE (original_filename, row_count, column_count, ingestion_status, table_name);
+
+DROP INDEX IF EXISTS idx_datasets_user_id;
+DROP INDEX IF EXISTS idx_datasets_upload_date;
@@ -0,0 +1,16 @@
+-- Migration: Dataset table names derived from dataset_id
+-- Table names used to come from a plpgsql loop that probed datasets.table_name (unindexed) until
+-- it found a free name, once at upload and again at ingestion, racing concurrent uploads. New
+-- datasets are named ds_<dataset_id hex> at upload time and ingestion reuses the stored name;
+-- existing datasets keep their tables. The unique index makes any collision fail loudly.
+
+DROP FUNCTION IF EXISTS generate_dataset_table_name(VARCHAR, VARCHAR);
+
+CREATE OR REPLACE FUNCTION generate_dataset_table_name(p_dataset_id UUID)
+RETURNS VARCHAR AS $$
+    SELECT 'ds_' || replace(p_dataset_id::text, '-', '');
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_datasets_table_name ON datasets(table_name);
+
+COMMENT ON COLUMN datasets.table_name IS 'Table holding the dataset rows: ds_<dataset_id hex>, set at upload time';
@@ -0,0 +1,12 @@
+-- Migration: Per-user budgets for executeSQL admission control
+-- The datasets Lambda EXPLAINs user SQL before running it: queries over the cost budget are
+-- rejected, queries estimated to return more rows than the row budget are clamped, and every
+-- query runs under a statement timeout. NULL budgets fall back to the Lambda's QUERY_* defaults.
+
+ALTER TABLE user_profiles ADD COLUMN IF NOT EXISTS query_cost_budget DOUBLE PRECISION;
+ALTER TABLE user_profiles ADD COLUMN IF NOT EXISTS query_row_budget INTEGER;
+ALTER TABLE user_profiles ADD COLUMN IF NOT EXISTS query_timeout_ms INTEGER;
+
+COMMENT ON COLUMN user_profiles.query_cost_budget IS 'Max planner cost for one executeSQL query (NULL = default)';
+COMMENT ON COLUMN user_profiles.query_row_budget IS 'Estimated result rows above which executeSQL clamps the result (NULL = default)';
+COMMENT ON COLUMN user_profiles.query_timeout_ms IS 'statement_timeout for executeSQL queries (NULL = default)';
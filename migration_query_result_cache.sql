@@ -0,0 +1,22 @@
+-- Migration: Shared executeSQL result cache
+-- Datasets never change after ingestion, so the datasets Lambda caches query results keyed on
+-- (dataset, ingestion_date, limit, normalized SQL). Warm containers keep an in-process LRU; this
+-- table is the tier shared between containers. Set RESULT_CACHE_SHARED=false to run without it.
+
+CREATE TABLE IF NOT EXISTS query_result_cache (
+    cache_key CHAR(64) PRIMARY KEY,
+    dataset_id UUID NOT NULL REFERENCES datasets(dataset_id) ON DELETE CASCADE,
+    result TEXT NOT NULL,
+    size_bytes INTEGER NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    last_hit_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    hit_count INTEGER DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS idx_query_result_cache_dataset_id ON query_result_cache(dataset_id);
+CREATE INDEX IF NOT EXISTS idx_query_result_cache_last_hit ON query_result_cache(last_hit_at DESC);
+
+COMMENT ON TABLE query_result_cache IS 'executeSQL results shared across Lambda containers, evicted by size';
+COMMENT ON COLUMN query_result_cache.cache_key IS 'sha256 of dataset, ingestion version, limit and normalized SQL';
+COMMENT ON COLUMN query_result_cache.result IS 'JSON with column names and column-major values';
+COMMENT ON COLUMN query_result_cache.last_hit_at IS 'Most recently hit entries are kept when over budget';
@@ -0,0 +1,165 @@
+-- Migration: Single-pass field analysis
+-- analyze_field_characteristics used to scan the dataset table once per column and compared
+-- MIN/MAX as text. It now profiles every column in one scan with typed MIN/MAX, and uses
+-- HyperLogLog distinct counts when the hll extension is installed.
+-- update_field_analysis becomes a single bulk UPDATE.
+
+-- VMind-inspired function to calculate field statistics and roles
+-- All columns are profiled in a single scan of the dataset table. Distinct counts use
+-- HyperLogLog when the hll extension is installed, and MIN/MAX compare typed values.
+CREATE OR REPLACE FUNCTION analyze_field_characteristics(
+    p_dataset_id UUID,
+    p_table_name VARCHAR
+) RETURNS TABLE (
+    column_name VARCHAR,
+    suggested_field_role VARCHAR,
+    suggested_semantic_type VARCHAR,
+    cardinality_ratio DECIMAL,
+    null_percentage DECIMAL,
+    field_statistics JSONB
+) AS $$
+DECLARE
+    col_record RECORD;
+    total_rows INTEGER;
+    use_hll BOOLEAN;
+    aggregates_sql TEXT;
+    values_sql TEXT;
+    sql_query TEXT;
+    stats_result RECORD;
+BEGIN
+    use_hll := EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'hll');
+    
+    -- Build one aggregate per statistic per column, named after the column position
+    SELECT
+        string_agg(format(
+            '%s AS d%s, COUNT(%I) AS n%s, %s AS mn%s, %s AS mx%s',
+            CASE WHEN use_hll
+                THEN format('hll_cardinality(hll_add_agg(hll_hash_any(%I)))::BIGINT', dc.safe_name)
+                ELSE format('COUNT(DISTINCT %I)', dc.safe_name)
+            END, dc.column_index,
+            dc.safe_name, dc.column_index,
+            CASE WHEN upper(dc.postgres_type) = 'BOOLEAN'
+                THEN format('bool_and(%I)::TEXT', dc.safe_name)
+                ELSE format('MIN(%I)::TEXT', dc.safe_name)
+            END, dc.column_index,
+            CASE WHEN upper(dc.postgres_type) = 'BOOLEAN'
+                THEN format('bool_or(%I)::TEXT', dc.safe_name)
+                ELSE format('MAX(%I)::TEXT', dc.safe_name)
+            END, dc.column_index
+        ), ', ' ORDER BY dc.column_index),
+        string_agg(format(
+            '(%L, %L, %L, %s::INTEGER, s.d%s, s.n%s, s.mn%s, s.mx%s)',
+            dc.column_name, dc.data_type, dc.postgres_type, dc.column_index,
+            dc.column_index, dc.column_index, dc.column_index, dc.column_index
+        ), ', ' ORDER BY dc.column_index)
+    INTO aggregates_sql, values_sql
+    FROM (
+        SELECT dc.*,
+               -- Same cleaning the datasets Lambda applies to CSV headers
+               regexp_replace(lower(replace(replace(dc.column_name, ' ', '_'), '-', '_')), '[^[:alnum:]_]', '', 'g') AS safe_name
+        FROM dataset_columns dc
+        WHERE dc.dataset_id = p_dataset_id
+    ) dc;
+    
+    IF aggregates_sql IS NULL THEN
+        RETURN;
+    END IF;
+    
+    sql_query := format('
+        SELECT v.*, s.total_count
+        FROM (SELECT COUNT(*) AS total_count, %s FROM %I) s
+        CROSS JOIN LATERAL (VALUES %s) AS v(column_name, data_type, postgres_type, column_index,
+                                             distinct_count, non_null_count, min_val, max_val)
+        ORDER BY v.column_index
+    ', aggregates_sql, p_table_name, values_sql);
+    
+    FOR stats_result IN EXECUTE sql_query
+    LOOP
+        total_rows := stats_result.total_count;
+        col_record := stats_result;
+        
+        -- Calculate cardinality ratio
+        column_name := stats_result.column_name;
+        cardinality_ratio := CASE 
+            WHEN total_rows > 0 THEN stats_result.distinct_count::DECIMAL / total_rows 
+            ELSE 0 
+        END;
+        null_percentage := CASE
+            WHEN total_rows > 0 THEN (total_rows - stats_result.non_null_count)::DECIMAL / total_rows * 100
+            ELSE 0
+        END;
+        
+        -- Determine field role based on data characteristics
+        suggested_field_role := CASE 
+            -- Identifier detection (high uniqueness)
+            WHEN cardinality_ratio > 0.95 THEN 'identifier'
+            
+            -- Dimension detection (categorical data)
+            WHEN col_record.data_type IN ('TEXT') AND cardinality_ratio < 0.5 THEN 'dimension'
+            WHEN col_record.data_type IN ('DATE') THEN 'dimension'
+            WHEN upper(col_record.postgres_type) = 'BOOLEAN' THEN 'dimension'
+            WHEN col_record.data_type IN ('TEXT') AND stats_result.distinct_count <= 50 THEN 'dimension'
+            
+            -- Measure detection (numerical data suitable for aggregation)
+            WHEN col_record.data_type IN ('INTEGER', 'DECIMAL') AND cardinality_ratio > 0.1 THEN 'measure'
+            WHEN col_record.data_type IN ('FLOAT', 'NUMERIC') THEN 'measure'
+            
+            ELSE 'unknown'
+        END;
+        
+        -- Determine semantic type
+        suggested_semantic_type := CASE
+            WHEN col_record.data_type IN ('TEXT') AND cardinality_ratio < 0.2 THEN 'categorical'
+            WHEN col_record.data_type IN ('INTEGER', 'DECIMAL', 'FLOAT', 'NUMERIC') THEN 'numerical'
+            WHEN col_record.data_type = 'DATE' OR lower(col_record.postgres_type) LIKE '%timestamp%' THEN 'temporal'
+            WHEN upper(col_record.postgres_type) = 'BOOLEAN' THEN 'boolean'
+            ELSE 'text'
+        END;
+        
+        -- Build field statistics JSON
+        field_statistics := json_build_object(
+            'distinct_count', stats_result.distinct_count,
+            'distinct_count_method', CASE WHEN use_hll THEN 'hll' ELSE 'exact' END,
+            'non_null_count', stats_result.non_null_count,
+            'null_percentage', null_percentage,
+            'min_value', stats_result.min_val,
+            'max_value', stats_result.max_val,
+            'data_type', col_record.data_type,
+            'postgres_type', col_record.postgres_type,
+            'is_suitable_for_grouping', (suggested_field_role = 'dimension'),
+            'is_suitable_for_aggregation', (suggested_field_role = 'measure')
+        );
+        
+        RETURN NEXT;
+    END LOOP;
+    
+    RETURN;
+END;
+$$ LANGUAGE plpgsql;
+
+-- VMind-inspired function to update field analysis for a dataset
+CREATE OR REPLACE FUNCTION update_field_analysis(p_dataset_id UUID, p_table_name VARCHAR)
+RETURNS VOID AS $$
+BEGIN
+    -- Update field characteristics for all columns in the dataset with one statement
+    UPDATE dataset_columns dc
+    SET 
+        field_role = fa.suggested_field_role,
+        semantic_type = fa.suggested_semantic_type,
+        cardinality_ratio = fa.cardinality_ratio,
+        contains_nulls_pct = fa.null_percentage,
+        unique_count = (fa.field_statistics->>'distinct_count')::INTEGER,
+        min_value = fa.field_statistics->>'min_value',
+        max_value = fa.field_statistics->>'max_value',
+        field_stats = fa.field_statistics,
+        updated_at = CURRENT_TIMESTAMP
+    FROM analyze_field_characteristics(p_dataset_id, p_table_name) fa
+    WHERE dc.dataset_id = p_dataset_id 
+    AND dc.column_name = fa.column_name;
+    
+    RAISE NOTICE 'Field analysis updated for dataset %', p_dataset_id;
+END;
+$$ LANGUAGE plpgsql;
+
+COMMENT ON FUNCTION analyze_field_characteristics IS 'Analyzes dataset columns in a single table scan to determine field roles and characteristics for intelligent chart generation';
+COMMENT ON FUNCTION update_field_analysis IS 'Recomputes field analysis for all columns in a dataset with one bulk UPDATE; ingestion already fills these fields, so this is only needed to refresh them';
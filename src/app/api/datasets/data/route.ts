@@ -10,6 +10,7 @@ export async function GET(request: NextRequest) {
     const { searchParams } = new URL(request.url);
     const datasetId = searchParams.get('datasetId');
     const tableName = searchParams.get('tableName');
+    const cursor = searchParams.get('cursor');
 
     if (!datasetId || !tableName) {
       return NextResponse.json(
@@ -27,7 +28,8 @@ export async function GET(request: NextRequest) {
           action: 'getData',
           datasetId,
           tableName,
-          limit: 1000 // Limit to first 1000 rows for performance
+          limit: 1000, // Page size; follow nextCursor for the rest
+          ...(cursor ? { cursor } : {})
         }
       }
     }).response;
@@ -1,7 +1,7 @@
 import { NextRequest, NextResponse } from 'next/server';
 import { Amplify } from 'aws-amplify';
 import awsExports from "../../../amplifyconfiguration.json";
-import { get, post } from 'aws-amplify/api';
+import { get, post, ApiError } from 'aws-amplify/api';
 
 const myAPI = "chartistryapi";
 const path = '/datasets';
@@ -63,6 +63,9 @@ export async function GET(request: NextRequest) {
   try {
     const { searchParams } = new URL(request.url);
     const userId = searchParams.get('userId');
+    const cursor = searchParams.get('cursor');
+    const limit = searchParams.get('limit');
+    const ifNoneMatch = request.headers.get('if-none-match');
     
     if (!userId) {
       return NextResponse.json(
@@ -83,12 +86,17 @@ export async function GET(request: NextRequest) {
       path: path,
       options: {
         queryParams: {
-          userId: userId
-        }
+          userId: userId,
+          ...(cursor ? { cursor } : {}),
+          ...(limit ? { limit } : {})
+        },
+        // The browser revalidates its cached page; pass that through so unchanged lists get a 304
+        ...(ifNoneMatch ? { headers: { 'If-None-Match': ifNoneMatch } } : {})
       }
     }).response;
 
     const data = await response.body.json();
+    const etag = response.headers['etag'];
     
     return NextResponse.json(data, { 
       status: response.statusCode,
@@ -96,9 +104,21 @@ export async function GET(request: NextRequest) {
         'Access-Control-Allow-Origin': '*',
         'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
         'Access-Control-Allow-Headers': 'Content-Type, Authorization',
+        ...(etag ? { 'ETag': etag, 'Cache-Control': 'private, no-cache' } : {}),
       },
     });
   } catch (error) {
+    // Amplify rejects anything outside 2xx, including the 304 for an unchanged page
+    if (error instanceof ApiError && error.response?.statusCode === 304) {
+      const etag = error.response.headers['etag'];
+      return new NextResponse(null, {
+        status: 304,
+        headers: {
+          'Access-Control-Allow-Origin': '*',
+          ...(etag ? { 'ETag': etag, 'Cache-Control': 'private, no-cache' } : {}),
+        },
+      });
+    }
     console.error('Dataset API error:', error);
     return NextResponse.json(
       { error: 'Failed to fetch datasets' },
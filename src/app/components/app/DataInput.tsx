@@ -2,7 +2,7 @@
 
 import { useState, useCallback, useEffect } from 'react';
 import { useAuth } from '@/contexts/UserContext';
-import { getUserDatasets, type Dataset } from '../../lib/api';
+import { getUserDatasets, enqueueIngestion, waitForIngestion, type Dataset } from '../../lib/api';
 
 interface DataInputProps {
   csv: string;
@@ -15,6 +15,18 @@ interface DataInputProps {
   selectedDataset?: Dataset | null;
 }
 
+// Files above this are uploaded without a content hash rather than read into memory to hash;
+// keep in step with CONTENT_HASH_MAX_BYTES in the datasets Lambda
+const MAX_HASHED_FILE_BYTES = 512 * 1024 * 1024;
+
+async function hashFile(file: File): Promise<string | undefined> {
+  if (file.size > MAX_HASHED_FILE_BYTES || !window.crypto?.subtle) {
+    return undefined;
+  }
+  const digest = await window.crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+  return Array.from(new Uint8Array(digest), (byte) => byte.toString(16).padStart(2, '0')).join('');
+}
+
 export default function DataInput({
   csv,
   setCsv,
@@ -31,6 +43,8 @@ export default function DataInput({
   const [datasets, setDatasets] = useState<Dataset[]>([]);
   const [showDatasets, setShowDatasets] = useState(false);
   const [loadingDatasets, setLoadingDatasets] = useState(false);
+  const [datasetsCursor, setDatasetsCursor] = useState<string | null>(null);
+  const [loadingMoreDatasets, setLoadingMoreDatasets] = useState(false);
   
   const { currentUser } = useAuth();
 
@@ -39,12 +53,27 @@ export default function DataInput({
     if (currentUser?.uid && showDatasets) {
       setLoadingDatasets(true);
       getUserDatasets(currentUser.uid)
-        .then(setDatasets)
+        .then((page) => {
+          setDatasets(page.datasets);
+          setDatasetsCursor(page.nextCursor);
+        })
         .catch(console.error)
         .finally(() => setLoadingDatasets(false));
     }
   }, [currentUser?.uid, showDatasets]);
 
+  const loadMoreDatasets = useCallback(() => {
+    if (!currentUser?.uid || !datasetsCursor) return;
+    setLoadingMoreDatasets(true);
+    getUserDatasets(currentUser.uid, datasetsCursor)
+      .then((page) => {
+        setDatasets((previous) => [...previous, ...page.datasets]);
+        setDatasetsCursor(page.nextCursor);
+      })
+      .catch(console.error)
+      .finally(() => setLoadingMoreDatasets(false));
+  }, [currentUser?.uid, datasetsCursor]);
+
 
   const uploadToS3 = useCallback(async (file: File) => {
     if (!currentUser?.uid) {
@@ -57,6 +86,9 @@ export default function DataInput({
     setUploadError('');
 
     try {
+      // Identical files already ingested are reused instead of uploaded again
+      const contentHash = await hashFile(file);
+
       // Step 1: Get pre-signed URL from our datasets API
       const uploadResponse = await fetch('/api/datasets', {
         method: 'POST',
@@ -67,7 +99,8 @@ export default function DataInput({
           action: 'upload',
           userId: currentUser.uid,
           fileName: file.name,
-          fileType: file.type
+          fileType: file.type,
+          contentHash
         }),
       });
 
@@ -76,7 +109,13 @@ export default function DataInput({
         throw new Error(errorData.error || 'Failed to get upload URL');
       }
 
-      const { uploadUrl, fields, fileId, datasetId, s3Key } = await uploadResponse.json();
+      const { uploadUrl, fields, fileId, datasetId, s3Key, deduplicated } = await uploadResponse.json();
+
+      if (deduplicated) {
+        setUploadProgress(100);
+        setUploadStatus('success');
+        return;
+      }
 
       // Step 2: Upload file using pre-signed POST with form data
       const formData = new FormData();
@@ -103,30 +142,12 @@ export default function DataInput({
 
         xhr.onload = async () => {
           if (xhr.status >= 200 && xhr.status < 300) {
-            // Step 3: Trigger ingestion after successful upload
+            // Step 3: Queue ingestion after successful upload and follow it to completion
             try {
-              const ingestResponse = await fetch('/api/datasets', {
-                method: 'POST',
-                headers: {
-                  'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({
-                  action: 'ingest',
-                  userId: currentUser.uid,
-                  datasetId: datasetId,
-                  s3Key: s3Key,
-                  originalFilename: file.name
-                }),
-              });
-
-              if (ingestResponse.ok) {
-                const ingestResult = await ingestResponse.json();
-                console.log('Ingestion successful:', ingestResult);
-                setUploadStatus('success');
-              } else {
-                console.warn('Upload successful but ingestion failed');
-                setUploadStatus('success'); // Still show success for upload
-              }
+              await enqueueIngestion(currentUser.uid, datasetId, s3Key, file.name);
+              const ingestResult = await waitForIngestion(datasetId);
+              console.log('Ingestion successful:', ingestResult);
+              setUploadStatus('success');
             } catch (ingestError) {
               console.warn('Upload successful but ingestion failed:', ingestError);
               setUploadStatus('success'); // Still show success for upload
@@ -302,6 +323,15 @@ export default function DataInput({
                   </div>
                 ))
               )}
+              {!loadingDatasets && datasetsCursor && (
+                <button
+                  onClick={loadMoreDatasets}
+                  disabled={loadingMoreDatasets}
+                  className="w-full text-sm text-blue-600 hover:text-blue-700 disabled:text-gray-400 py-1"
+                >
+                  {loadingMoreDatasets ? 'Loading...' : 'Load more'}
+                </button>
+              )}
             </div>
           )}
         </div>
@@ -37,7 +37,7 @@ export interface Dataset {
   row_count: number;
   column_count: number;
   upload_date: string;
-  ingestion_status: 'pending' | 'processing' | 'completed' | 'failed';
+  ingestion_status: 'pending' | 'queued' | 'processing' | 'completed' | 'failed';
   table_name?: string;
 }
 
@@ -64,6 +64,24 @@ export interface IngestionResponse {
   columns: number;
 }
 
+export interface IngestionStatus {
+  datasetId: string;
+  status: Dataset['ingestion_status'];
+  rowsLoaded: number | null;
+  bytesRead: number | null;
+  fileSizeBytes: number | null;
+  progress: number | null;
+  etaSeconds: number | null;
+  rowCount: number | null;
+  error: string | null;
+  // Set while a file is being appended to a completed dataset
+  appendProgress: { s3_key: string; rows_loaded: number; bytes_read: number; updated_at: string } | null;
+}
+
+const INGESTION_POLL_INTERVAL_MS = 2000;
+// Past this the job is left running in the background; the dataset list still shows its status
+const INGESTION_WAIT_TIMEOUT_MS = 30 * 60 * 1000;
+
 export async function generateChart(message: string): Promise<ChartResponse> {
   try {
     // Create abort controller for timeout (2 minutes for AI-driven chart generation)
@@ -174,9 +192,85 @@ export async function ingestDataset(userId: string, datasetId: string, s3Key: st
   }
 }
 
-export async function getUserDatasets(userId: string): Promise<Dataset[]> {
+export async function enqueueIngestion(userId: string, datasetId: string, s3Key: string, originalFilename: string): Promise<void> {
+  try {
+    const response = await fetch('/api/datasets', {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+      },
+      body: JSON.stringify({
+        action: 'enqueueIngest',
+        userId,
+        datasetId,
+        s3Key,
+        originalFilename
+      }),
+    });
+
+    if (!response.ok) {
+      const errorData: ApiError = await response.json();
+      throw new Error(errorData.error || 'Failed to queue dataset ingestion');
+    }
+  } catch (error) {
+    console.error('Error queueing dataset ingestion:', error);
+    throw error;
+  }
+}
+
+export async function getIngestionStatus(datasetId: string): Promise<IngestionStatus> {
+  const response = await fetch('/api/datasets', {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+    },
+    body: JSON.stringify({
+      action: 'status',
+      datasetId
+    }),
+  });
+
+  if (!response.ok) {
+    const errorData: ApiError = await response.json();
+    throw new Error(errorData.error || 'Failed to fetch ingestion status');
+  }
+
+  return await response.json();
+}
+
+export async function waitForIngestion(
+  datasetId: string,
+  onProgress?: (status: IngestionStatus) => void,
+  timeoutMs: number = INGESTION_WAIT_TIMEOUT_MS
+): Promise<IngestionStatus> {
+  // Poll the background job until it finishes one way or the other, or the deadline passes
+  const deadline = Date.now() + timeoutMs;
+  while (true) {
+    const status = await getIngestionStatus(datasetId);
+    onProgress?.(status);
+    if (status.status === 'completed') {
+      return status;
+    }
+    if (status.status === 'failed') {
+      throw new Error(status.error || 'Dataset ingestion failed');
+    }
+    if (Date.now() + INGESTION_POLL_INTERVAL_MS > deadline) {
+      throw new Error(`Dataset ingestion still ${status.status} after ${Math.round(timeoutMs / 60000)} minutes`);
+    }
+    await new Promise((resolve) => setTimeout(resolve, INGESTION_POLL_INTERVAL_MS));
+  }
+}
+
+export interface DatasetPage {
+  datasets: Dataset[];
+  nextCursor: string | null;
+}
+
+export async function getUserDatasets(userId: string, cursor?: string | null): Promise<DatasetPage> {
   try {
-    const response = await fetch(`/api/datasets?userId=${userId}`, {
+    // One page, newest first; pass nextCursor back in to load the next one
+    const query = cursor ? `&cursor=${encodeURIComponent(cursor)}` : '';
+    const response = await fetch(`/api/datasets?userId=${userId}${query}`, {
       method: 'GET',
       headers: {
         'Content-Type': 'application/json',
@@ -189,7 +283,7 @@ export async function getUserDatasets(userId: string): Promise<Dataset[]> {
     }
 
     const data = await response.json();
-    return data.datasets;
+    return { datasets: data.datasets, nextCursor: data.nextCursor || null };
   } catch (error) {
     console.error('Error fetching datasets:', error);
     throw error;
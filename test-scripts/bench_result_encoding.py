@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Benchmark the executeSQL result encoding used by the datasets Lambda: the old
+per-row dicts with json_serializer callbacks (returned twice, as data and rows)
+against the OID-typed column encoder in row and column layouts, plus gzip.
+
+    python bench_result_encoding.py            # 1k, 10k and 100k rows
+    python bench_result_encoding.py 250000
+"""
+
+import os
+import sys
+import json
+import gzip
+import time
+import decimal
+from datetime import datetime, date, timedelta, timezone
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-2')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'amplify', 'backend', 'function', 'datasets', 'src'))
+import index  # noqa: E402
+
+# (name, type_code) pairs shaped like psycopg2's cursor.description
+DESCRIPTION = [('region', 25), ('order_date', 1082), ('updated_at', 1184), ('orders', 20), ('revenue', 1700)]
+
+def create_test_rows(rows):
+    """
+    Create result rows shaped like a typical aggregation query
+    """
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    regions = ['North', 'South', 'East', 'West']
+    return [
+        (regions[i % 4], date(2024, 1, 1) + timedelta(days=i % 365), start + timedelta(minutes=i),
+         i * 3, decimal.Decimal(i) / 7 if i % 11 else None)
+        for i in range(rows)
+    ]
+
+def encode_legacy(rows):
+    column_names = [desc[0] for desc in DESCRIPTION]
+    data_objects = [dict(zip(column_names, row)) for row in rows]
+    return json.dumps({'data': data_objects, 'columns': column_names, 'rows': data_objects},
+                      default=index.json_serializer)
+
+def encode_rows(rows):
+    column_names = [desc[0] for desc in DESCRIPTION]
+    columns = index.encode_result_columns(DESCRIPTION, rows)
+    data = [dict(zip(column_names, values)) for values in zip(*columns)]
+    return index.json_response({'data': data, 'columns': column_names}, {}, {})['body']
+
+def encode_columns(rows):
+    column_names = [desc[0] for desc in DESCRIPTION]
+    columns = index.encode_result_columns(DESCRIPTION, rows)
+    return index.json_response({'data': dict(zip(column_names, columns)), 'columns': column_names}, {}, {})['body']
+
+def time_encoder(encoder, rows, repeats=3):
+    """
+    Best of a few runs, returning (seconds, body)
+    """
+    best, body = float('inf'), None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        body = encoder(rows)
+        best = min(best, time.perf_counter() - start)
+    return best, body
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+    print("[BENCH] executeSQL result encoding")
+    print("=" * 50)
+
+    for size in sizes:
+        rows = create_test_rows(size)
+        print(f"{size} rows:")
+        for label, encoder in [('legacy', encode_legacy), ('rows', encode_rows), ('columns', encode_columns)]:
+            elapsed, body = time_encoder(encoder, rows)
+            gzipped = len(gzip.compress(body.encode('utf-8'), compresslevel=6))
+            print(f"  {label:>8}: {elapsed * 1000:8.1f} ms, {len(body):>11,} bytes, {gzipped:>10,} gzipped")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Load a CSV into a range partitioned dataset table with the parallel workers, then
+append a second file whose months overlap the first, the way a recurring export
+does. The parallel load creates its partitions under the staging table's name, so
+the append has to find them by their bounds.
+
+Uses moto's in-memory S3 and a scratch PostgreSQL database that already has
+database_schema.sql applied:
+    pip install "moto[s3]"
+    TEST_DB_HOST=localhost TEST_DB_NAME=chartz_test TEST_DB_USER=postgres \\
+    TEST_DB_PASSWORD=... python test_partitioned_append.py
+"""
+
+import os
+import sys
+import uuid
+import numpy as np
+import pandas as pd
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-2')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+
+from moto import mock_aws  # noqa: E402
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'amplify', 'backend', 'function', 'datasets', 'src'))
+
+TEST_USER = 'test-partitioned-append'
+
+def create_test_csv(rows, start, seed):
+    """
+    Create a CSV with an integer id, a decimal and a timestamp spread over a few months
+    """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'id': np.arange(rows),
+        'amount': rng.normal(100, 25, rows).round(2),
+        'happened_at': pd.date_range(start, periods=rows, freq='5min', tz='UTC').strftime('%Y-%m-%dT%H:%M:%SZ'),
+    })
+    return df.to_csv(index=False).encode('utf-8')
+
+def main():
+    if not os.environ.get('TEST_DB_HOST'):
+        print("[SKIP] Set TEST_DB_HOST (and TEST_DB_NAME/USER/PASSWORD/PORT) to a scratch PostgreSQL database")
+        return
+
+    print("[TEST] Parallel range partitioned load followed by an append")
+    print("=" * 50)
+
+    with mock_aws():
+        import index
+        index.DB_CONFIG.update({
+            'host': os.environ['TEST_DB_HOST'],
+            'port': os.environ.get('TEST_DB_PORT', '5432'),
+            'dbname': os.environ.get('TEST_DB_NAME', 'chartz_test'),
+            'user': os.environ.get('TEST_DB_USER', 'postgres'),
+            'password': os.environ.get('TEST_DB_PASSWORD', ''),
+        })
+        # Force the partitioned layout and the parallel workers for a small file
+        index.PARTITIONED_STORAGE_THRESHOLD = 0
+        index.INGEST_PARALLEL_THRESHOLD = 0
+        index.INGEST_WORKERS = 2
+        index.CSV_CHUNK_ROWS = 2000
+
+        index.s3_client.create_bucket(Bucket=index.BUCKET_NAME,
+                                      CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+        first_key, appended_key = f'{TEST_USER}/first.csv', f'{TEST_USER}/appended.csv'
+        # ~70 days from mid-January, then a file reaching a month further
+        index.s3_client.put_object(Bucket=index.BUCKET_NAME, Key=first_key,
+                                   Body=create_test_csv(20000, '2024-01-15', 1))
+        index.s3_client.put_object(Bucket=index.BUCKET_NAME, Key=appended_key,
+                                   Body=create_test_csv(20000, '2024-03-01', 2))
+
+        dataset_id = str(uuid.uuid4())
+        table_name = index.dataset_table_name(dataset_id)
+        conn = index.get_db_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                INSERT INTO user_profiles (user_id, email) VALUES (%s, %s) ON CONFLICT (user_id) DO NOTHING
+            """, (TEST_USER, f'{TEST_USER}@example.com'))
+            cursor.execute("""
+                INSERT INTO datasets (dataset_id, user_id, original_filename, s3_key, table_name, ingestion_status)
+                VALUES (%s, %s, 'first.csv', %s, %s, 'queued')
+            """, (dataset_id, TEST_USER, first_key, table_name))
+            conn.commit()
+
+            result = index.ingest_csv_from_s3(first_key, TEST_USER, 'first.csv', dataset_id)
+            assert result['success'], result
+            cursor.execute("SELECT metadata->'storage' FROM datasets WHERE dataset_id = %s", (dataset_id,))
+            storage = cursor.fetchone()[0]
+            assert storage.get('strategy') == 'range', f"expected range partitions, got {storage}"
+            months = index.read_partitioned_months(cursor, table_name)
+            conn.commit()
+            print(f"  parallel load: {result['rows_inserted']} rows, partitions for {sorted(months)} OK")
+
+            result = index.append_csv_from_s3(appended_key, TEST_USER, dataset_id)
+            assert result['success'], result
+            cursor.execute(f'SELECT COUNT(*) FROM "{table_name}"')
+            total = cursor.fetchone()[0]
+            cursor.execute("SELECT row_count, error_message FROM datasets WHERE dataset_id = %s", (dataset_id,))
+            row_count, error_message = cursor.fetchone()
+            months = index.read_partitioned_months(cursor, table_name)
+            conn.commit()
+            assert total == row_count == 40000, (total, row_count)
+            assert error_message is None, error_message
+            print(f"  append over existing months: {total} rows, partitions for {sorted(months)} OK")
+        finally:
+            conn.rollback()
+            cursor.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+            cursor.execute("DELETE FROM datasets WHERE dataset_id = %s", (dataset_id,))
+            conn.commit()
+            index.release_db_connection(conn)
+
+if __name__ == "__main__":
+    main()
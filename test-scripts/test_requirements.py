@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Smoke check the datasets Lambda's requirements.txt: every line must name one
+package, and the optional dependencies the handler relies on must import, so a
+mangled requirement can't silently switch executeSQL to its keyword fallback.
+
+Run after installing the requirements the way the Lambda build does:
+    pip install -r ../amplify/backend/function/datasets/src/requirements.txt
+    python test_requirements.py
+"""
+
+import os
+import re
+import sys
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-2')
+
+SRC_DIR = os.path.join(os.path.dirname(__file__), '..', 'amplify', 'backend', 'function', 'datasets', 'src')
+sys.path.insert(0, SRC_DIR)
+
+# Packages the handler needs at runtime, by import name
+REQUIRED_MODULES = {'boto3': 'boto3', 'botocore': 'botocore', 'psycopg2-binary': 'psycopg2',
+                    'requests': 'requests', 'pandas': 'pandas', 'sqlglot': 'sqlglot'}
+
+def check_requirements_file():
+    """
+    Every requirement sits on its own line and the file ends with a newline,
+    so appending a package can't glue it onto the previous one
+    """
+    with open(os.path.join(SRC_DIR, 'requirements.txt')) as f:
+        content = f.read()
+    assert content.endswith('\n'), "requirements.txt must end with a newline"
+    names = [re.split(r'[<>=!~\[; ]', line.strip())[0] for line in content.splitlines() if line.strip()]
+    missing = [name for name in REQUIRED_MODULES if name not in names]
+    assert not missing, f"requirements.txt is missing {missing} (got {names})"
+    print(f"  requirements.txt lists {names} OK")
+
+def check_imports():
+    """
+    Import each runtime dependency, then the handler, and make sure it picked up sqlglot
+    """
+    for package, module in REQUIRED_MODULES.items():
+        __import__(module)
+        print(f"  import {module} ({package}) OK")
+    import index
+    assert index.sqlglot is not None, "index.py fell back to keyword SQL checks: sqlglot didn't import"
+    error, sql = index.validate_select_sql('SELECT * FROM ds_test', 'ds_test', 10)
+    assert error is None and 'LIMIT 10' in sql, (error, sql)
+    print("  executeSQL validation uses the sqlglot parser OK")
+    # The AST shapes these rely on differ between sqlglot major versions
+    error, sql = index.validate_select_sql('SELECT * FROM ds_test FETCH FIRST 5 ROWS ONLY', 'ds_test', 10)
+    assert error is None and 'LIMIT 5' in sql, (error, sql)
+    error, sql = index.validate_select_sql('SELECT * FROM DS_TEST', 'ds_test', 10)
+    assert error is None, error
+    error, _ = index.validate_select_sql('SELECT * FROM "DS_TEST"', 'ds_test', 10)
+    assert error is not None, "a quoted table name must match exactly"
+    print("  FETCH FIRST and identifier case handled by this sqlglot version OK")
+
+def main():
+    print("[TEST] datasets Lambda requirements")
+    print("=" * 50)
+    check_requirements_file()
+    check_imports()
+
+if __name__ == "__main__":
+    main()